@@ -0,0 +1,212 @@
+# Copyright (C) 2020 Basheer Subei
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Times each stage of the squad_map_randomizer pipeline on synthetic layers and configs, reports throughput and peak
+# memory, and compares the results against a stored baseline to flag regressions.
+#
+
+import argparse
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import squad_map_randomizer
+from benchmarks import synthetic
+
+# The default layer set sizes to benchmark.
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+# The configs to benchmark, as keyword arguments to synthetic.make_config.
+CONFIGS = {
+    'default': {'num_slots': 4, 'number_of_repeats': 5, 'tightness': 0.3},
+    'long': {'num_slots': 10, 'number_of_repeats': 20, 'tightness': 0.3},
+    'tight': {'num_slots': 4, 'number_of_repeats': 5, 'tightness': 0.9},
+}
+# The minimum number of seconds to spend timing each stage.
+DEFAULT_MIN_SECONDS = 0.2
+# A stage is flagged as a regression if it is this much slower (as a fraction) than the baseline.
+DEFAULT_TOLERANCE = 0.25
+# The default filepath of the stored baseline.
+DEFAULT_BASELINE_FILEPATH = pathlib.Path(__file__).parent / pathlib.Path('baseline.json')
+
+
+def time_stage(func, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Returns the mean number of seconds per call of func (calling it repeatedly for at least min_seconds) and the peak
+    number of bytes allocated during one call (measured separately, since tracing allocations slows calls down).
+    """
+    num_calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while num_calls < 1 or elapsed < min_seconds:
+        func()
+        num_calls += 1
+        elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed / num_calls, peak_bytes
+
+
+def get_stages(layers_path, layers, config, history_path):
+    """
+    Returns a dict of stage names to functions that run that stage once for the given layers, config and play history
+    (see synthetic.make_history).
+    """
+    layer_index = squad_map_randomizer.LayerIndex(layers)
+    plan = squad_map_randomizer.compile_config(config)
+    # Write the config next to the layers as JSON (which is valid YAML), named by its hash since configs share the
+    # directory.
+    config_path = layers_path.with_name(f'config_{squad_map_randomizer.get_config_hash(config)}.yml')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    cache_dir = layers_path.with_name(f'cache_{layers_path.stem}')
+
+    def compile_uncached():
+        squad_map_randomizer._COMPILED_PLANS.clear()
+        squad_map_randomizer.compile_config(config)
+
+    stages = {
+        'get_json_layers': lambda: squad_map_randomizer.get_json_layers(str(layers_path), None),
+        'get_layer_index': lambda: squad_map_randomizer.get_layer_index(str(layers_path), None),
+        'layer_schema': lambda: squad_map_randomizer.LayerSchema.from_layer_index(layer_index),
+        'validate_config': lambda: squad_map_randomizer.validate_config(config, layers, layer_index.schema),
+        'compile_config': compile_uncached,
+        'parse_config': lambda: squad_map_randomizer.parse_config(config_path, layers, layer_index.schema),
+        'parse_config_cached': lambda: squad_map_randomizer.parse_config(
+            config_path, layers, layer_index.schema, cache_dir, layer_index.layers_hash),
+        'get_map_rotation': lambda: squad_map_randomizer.get_map_rotation(plan, layers, layer_index=layer_index),
+        'get_map_rotation_backtrack': lambda: squad_map_randomizer.get_map_rotation(
+            plan, layers, layer_index=layer_index, solver='backtrack'),
+        # Reads the recent window of three years of daily rotations of ten servers.
+        'get_recently_played': lambda: squad_map_randomizer.get_recently_played(
+            history_path, squad_map_randomizer.DEFAULT_HISTORY_DAYS, 'Server 0'),
+    }
+    if squad_map_randomizer._import_numpy() is not None:
+        stages['get_map_rotation_numpy'] = lambda: squad_map_randomizer.get_map_rotation(
+            plan, layers, layer_index=layer_index, engine='numpy')
+    return stages
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, config_names=tuple(CONFIGS), min_seconds=DEFAULT_MIN_SECONDS, seed=0):
+    """
+    Runs every stage for every layer set size and config, and returns a dict of benchmark names (e.g.
+    'get_map_rotation[default,1000]') to dicts with the 'seconds' per call, the calls 'per_second' and the
+    'peak_bytes' allocated by one call.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            layers_path = pathlib.Path(temp_dir) / f'layers_{size}.json'
+            with open(layers_path, 'w') as f:
+                json.dump(synthetic.make_layers(size, seed=seed), f)
+            layers = squad_map_randomizer.get_json_layers(str(layers_path), None)
+            history_path = pathlib.Path(temp_dir) / f'history_{size}.jsonl'
+            synthetic.make_history(history_path, layers, seed=seed)
+            for config_name in config_names:
+                config = synthetic.make_config(layers, seed=seed, **CONFIGS[config_name])
+                for stage_name, stage in get_stages(layers_path, layers, config, history_path).items():
+                    seconds, peak_bytes = time_stage(stage, min_seconds)
+                    results[f'{stage_name}[{config_name},{size}]'] = {
+                        'seconds': seconds, 'per_second': 1 / seconds if seconds else float('inf'),
+                        'peak_bytes': peak_bytes}
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the names of the benchmarks in results that are slower than in the baseline by more than the tolerance
+    (a fraction, e.g. 0.25 for 25% slower). Benchmarks missing from either are ignored.
+    """
+    return [name for name, result in results.items()
+            if name in baseline and result['seconds'] > baseline[name]['seconds'] * (1 + tolerance)]
+
+
+def format_results(results, baseline=None):
+    """ Returns the results as a table (one benchmark per line), with the change from the baseline if given. """
+    lines = [f'{"benchmark":<50} {"ms/call":>10} {"calls/s":>12} {"peak KiB":>10} {"vs baseline":>12}']
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = f'{result["seconds"] / baseline[name]["seconds"] - 1:+.0%}'
+        lines.append(f'{name:<50} {result["seconds"] * 1000:>10.3f} {result["per_second"]:>12.1f} '
+                     f'{result["peak_bytes"] / 1024:>10.1f} {change:>12}')
+    return '\n'.join(lines)
+
+
+def parse_cli(argv=None):
+    """ Parses the given commandline args (sys.argv if None) and returns the parsed arguments. """
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks',
+                                     description='Benchmarks squad_map_randomizer on synthetic layers and configs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f'The numbers of layers to benchmark with. Defaults to {DEFAULT_SIZES}.')
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=list(CONFIGS),
+                        help='The synthetic configs to benchmark with. Defaults to all of them.')
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+                        help=f'The minimum time to spend timing each stage. Defaults to {DEFAULT_MIN_SECONDS}.')
+    parser.add_argument('--baseline', type=pathlib.Path, default=DEFAULT_BASELINE_FILEPATH,
+                        help=('Filepath of the baseline results to compare against. Defaults to'
+                              f' {DEFAULT_BASELINE_FILEPATH}.'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline instead of comparing against it.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=('The fraction a stage may be slower than the baseline by. Defaults to'
+                              f' {DEFAULT_TOLERANCE}.'))
+    parser.add_argument('-o', '--output-filepath', type=pathlib.Path, help='Filepath to write the results (JSON) to.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Run the benchmarks and return the exit code (1 if any benchmark regressed against the baseline). """
+    args = parse_cli(argv)
+    # Impossible slots in the synthetic configs are expected, so don't flood the output with their errors (but leave
+    # logging as it was for whoever called main).
+    disabled_level = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        results = run_benchmarks(args.sizes, args.configs, args.min_seconds)
+    finally:
+        logging.disable(disabled_level)
+    if args.output_filepath:
+        with open(args.output_filepath, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(format_results(results))
+        print(f'Saved baseline to {args.baseline}.')
+        return 0
+
+    baseline = None
+    if args.baseline.exists():
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if baseline is None:
+        print(f'WARNING: there is no baseline at {args.baseline} to compare against! Run with --save-baseline to store '
+              'these results as the baseline.', file=sys.stderr)
+    regressions = compare_to_baseline(results, baseline or {}, args.tolerance)
+    for name in regressions:
+        print(f'REGRESSION: {name} is more than {args.tolerance:.0%} slower than the baseline!')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
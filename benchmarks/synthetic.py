@@ -0,0 +1,123 @@
+# Copyright (C) 2020 Basheer Subei
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Generators for synthetic layers and rotation configs of any size (no network access needed).
+#
+
+import datetime
+import random
+
+import squad_map_randomizer
+
+# The gamemodes of the real layers. Synthetic layers use these first, then made up ones.
+GAMEMODES = ['Skirmish', 'AAS', 'RAAS', 'Invasion', 'Destruction', 'Insurgency', 'Territory Control']
+MAP_SIZES = ['small', 'medium', 'large']
+
+
+def make_layers(num_layers, num_maps=20, num_gamemodes=6, num_teams=8, bugged_fraction=0.02, seed=0):
+    """
+    Returns a list of num_layers synthetic layers (as dicts in the same format as the real layers JSON, see
+    https://github.com/bsubei/squad_map_layers) with the given number of distinct maps, gamemodes and teams.
+
+    :param num_layers: int The number of layers to make.
+    :param num_maps: int The number of distinct maps.
+    :param num_gamemodes: int The number of distinct gamemodes.
+    :param num_teams: int The number of distinct teams (at least two).
+    :param bugged_fraction: float The fraction of layers that are marked as bugged.
+    :param seed: int The seed for the random choices (the same seed gives the same layers).
+    """
+    rng = random.Random(seed)
+    maps = [f'Map {i}' for i in range(num_maps)]
+    map_sizes = {map_name: rng.choice(MAP_SIZES) for map_name in maps}
+    gamemodes = (GAMEMODES + [f'Gamemode {i}' for i in range(len(GAMEMODES), num_gamemodes)])[:num_gamemodes]
+    teams = [f'Team {i}' for i in range(max(2, num_teams))]
+
+    layers = []
+    for i in range(num_layers):
+        # Cycle through maps, then gamemodes, then versions so every layer name is unique.
+        map_name = maps[i % num_maps]
+        gamemode = gamemodes[(i // num_maps) % num_gamemodes]
+        version = f'v{i // (num_maps * num_gamemodes) + 1}'
+        team1, team2 = rng.sample(teams, 2)
+        layers.append({
+            'map': map_name,
+            'layer': f'{map_name} {gamemode} {version}',
+            'gamemode': gamemode,
+            'version': version,
+            'team1': team1,
+            'team2': team2,
+            'helicopters': map_sizes[map_name] != 'small' and rng.random() < 0.5,
+            'night': rng.random() < 0.1,
+            'RAA_Lanes': gamemode == 'RAAS' and rng.random() < 0.5,
+            'Invasion_Random': gamemode == 'Invasion' and rng.random() < 0.5,
+            'bugged': rng.random() < bugged_fraction,
+            'map_size': map_sizes[map_name],
+        })
+    return layers
+
+
+def make_config(layers, num_slots=4, number_of_repeats=5, tightness=0.5, num_starting_maps=2, seed=0):
+    """
+    Returns a synthetic rotation config for the given layers. Each slot gets a filter drawn from looser ('any', a map
+    size) to tighter (gamemodes and map size, or a single map and gamemode) filters, with tighter filters more likely
+    the higher the tightness.
+
+    :param layers: list(dict) The layers the config's filter values are drawn from.
+    :param num_slots: int The number of regular_maps slots.
+    :param number_of_repeats: int The number of times regular_maps is repeated.
+    :param tightness: float From 0 (mostly 'any') to 1 (mostly a single map and gamemode per slot).
+    :param num_starting_maps: int The number of starting_maps slots (Skirmish layers).
+    :param seed: int The seed for the random choices (the same seed gives the same config).
+    """
+    rng = random.Random(seed)
+    gamemodes = sorted({layer['gamemode'] for layer in layers})
+    map_sizes = sorted({layer['map_size'] for layer in layers})
+
+    def make_filter():
+        # The weights of each filter kind, from loosest to tightest.
+        weights = [1 - tightness, 1 - abs(0.5 - tightness), 1 - abs(0.75 - tightness), tightness]
+        kind = rng.choices(range(4), weights=weights)[0]
+        if kind == 0:
+            return 'any'
+        if kind == 1:
+            return {'map_size': rng.choice(map_sizes)}
+        if kind == 2:
+            return {'gamemode': rng.sample(gamemodes, min(2, len(gamemodes))), 'map_size': rng.choice(map_sizes)}
+        layer = rng.choice(layers)
+        return {'map': layer['map'], 'gamemode': layer['gamemode']}
+
+    config = {'number_of_repeats': number_of_repeats, 'regular_maps': [make_filter() for _ in range(num_slots)]}
+    if num_starting_maps:
+        config['starting_maps'] = [{'gamemode': 'Skirmish'}] * num_starting_maps
+    return config
+
+
+def make_history(history_path, layers, num_days=3 * 365, num_servers=10, rotation_length=22, now=None, seed=0):
+    """
+    Writes a synthetic play history (see squad_map_randomizer.append_play_history) to history_path, with one rotation
+    per day for each server over the given number of days up to now.
+
+    :param history_path: str The path to write the play history file to.
+    :param layers: list(dict) The layers the rotations are drawn from.
+    :param num_days: int The number of days of history.
+    :param num_servers: int The number of servers (named 'Server 0', 'Server 1', etc.).
+    :param rotation_length: int The number of layers in each rotation.
+    :param now: datetime.datetime The time of the last rotations. Defaults to now.
+    :param seed: int The seed for the random choices (the same seed gives the same history).
+    """
+    rng = random.Random(seed)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    for days_ago in range(num_days - 1, -1, -1):
+        for server_number in range(num_servers):
+            squad_map_randomizer.append_play_history(
+                history_path, rng.sample(layers, min(rotation_length, len(layers))), f'Server {server_number}',
+                played_at=now - datetime.timedelta(days=days_ago))
@@ -16,17 +16,30 @@
 #
 
 import argparse
+import array
 import collections
-import copy
+import collections.abc
+import contextlib
 import datetime
-from discord_webhook import DiscordWebhook
+import hashlib
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
 import pathlib
 import random
-from urllib import request
-import yaml
+import sys
+import threading
+import time
+
+# NOTE(bsubei): heavy or rarely needed modules (yaml, urllib.request, http.server, concurrent.futures and numpy) are
+# imported in the functions that use them, so the script starts fast (e.g. for a rotation from a local layers file,
+# which needs neither the network nor Discord).
+
+# NumPy is optional and only needed for the 'numpy' rotation engine. Imported on first use (see _import_numpy).
+numpy = None
 
 # The number of skirmish maps to add to beginning of map rotation.
 NUM_STARTING_SKIRMISH_MAPS = 2
@@ -47,183 +60,2115 @@ EXAMPLES_CONFIG_DIR = CONFIG_DIR / pathlib.Path('examples')
 DEFAULT_CONFIG_FILEPATH = CONFIG_DIR / pathlib.Path('default_config.yml')
 # The default URL to use to fetch the Squad map layers.
 DEFAULT_LAYERS_URL = 'https://raw.githubusercontent.com/bsubei/squad_map_layers/master/layers.json'
+# The default directory to cache downloaded layers files in.
+DEFAULT_CACHE_DIR = pathlib.Path.home() / pathlib.Path('.cache') / pathlib.Path('squad_map_randomizer')
+# The number of seconds a cached download is used without checking the server for a newer version.
+DEFAULT_CACHE_MAX_AGE_SECONDS = 3600
+# The number of seconds to wait for the server when downloading.
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 10
+# The first bytes of a layers snapshot file, and the version of its format (bump when the format changes).
+SNAPSHOT_MAGIC = b'SMRSNAP\n'
+SNAPSHOT_VERSION = 6
+# The value of a snapshot column for the layers that don't have the column's field.
+SNAPSHOT_MISSING = 0xFFFFFFFF
+# The version of the cached parsed configs (bump when the format of the cache changes).
+CONFIG_CACHE_VERSION = 1
+# The ways get_map_rotation can choose layers: one greedy pass, or a backtracking search that falls back to greedy.
+SOLVERS = ('greedy', 'backtrack')
+# The default wall-clock budget (in seconds) and step budget for the backtracking solver.
+DEFAULT_SOLVER_BUDGET_SECONDS = 1.0
+DEFAULT_SOLVER_MAX_STEPS = 100000
+# The implementations get_map_rotation can generate rotations with ('numpy' requires NumPy and the greedy solver).
+ENGINES = ('python', 'numpy')
+# The memory (in bytes) the numpy engine may use for each chunk of rotations it generates at once, and the (rough)
+# number of bytes it uses per rotation and layer (see get_numpy_chunk_size).
+NUMPY_ENGINE_MEMORY_BYTES = 64 * 2 ** 20
+NUMPY_ENGINE_BYTES_PER_LAYER = 24
+# The number of rejected draws from an alias table (of layers that were already used or break the duplicate map rule)
+# before the weighted sampler prunes the table to the layers that are left.
+MAX_ALIAS_REJECTIONS = 32
+# The formats RunMetrics can write metrics in, and the prefix of the metric names in the Prometheus format.
+METRICS_FORMATS = ('json', 'prometheus')
+METRICS_PREFIX = 'squad_map_randomizer_'
+# The counters that are always written to Prometheus textfiles (as zero if never recorded), so alerts can rely on them.
+METRICS_COUNTERS = ('skipped_slots_total', 'duplicate_map_rejections_total', 'duplicate_map_violations_total',
+                    'solver_fallbacks_total')
+# The default address the rotation service listens on, and how often (in seconds) it checks for changed files.
+DEFAULT_SERVICE_ADDRESS = 'localhost:8421'
+DEFAULT_SERVICE_POLL_SECONDS = 5.0
+# The maximum length of a Discord message, and the maximum number of Discord webhooks to post to at once.
+DISCORD_MESSAGE_MAX_LENGTH = 2000
+DISCORD_MAX_CONCURRENCY = 4
+# The number of times to retry a Discord message, the longest rate limit (in seconds) to wait out before giving up, and
+# the first wait (in seconds, doubled on every retry) after a server or network error.
+DISCORD_MAX_RETRIES = 5
+DISCORD_MAX_RETRY_WAIT_SECONDS = 60.0
+DISCORD_RETRY_BACKOFF_SECONDS = 1.0
+# The User-Agent to post to Discord with (Discord rejects requests without a descriptive one).
+DISCORD_USER_AGENT = 'squad_map_randomizer (https://github.com/bsubei/squad_map_randomizer)'
+# The maximum number of compiled configs to keep cached.
+MAX_COMPILED_PLANS = 128
+# The default number of days of play history to avoid repeating layers from (see --history-file).
+DEFAULT_HISTORY_DAYS = 2
+# The maximum number of generated rotations to keep in the on-disk rotation cache.
+MAX_CACHED_ROTATIONS = 256
+# The maximum number of parsed configs to keep in the on-disk config cache.
+MAX_CACHED_CONFIGS = 256
+# The number of rotations each worker task of the fairness analysis generates (see analyze_fairness).
+FAIRNESS_BATCH_SIZE = 1000
+# The maximum number of distinct filters whose every combination is checked by the feasibility analysis (see
+# get_matching_bound). With more, only single filters and all of them together are checked.
+MAX_ANALYSIS_FILTERS = 12
+
+# Maps config hashes to their compiled RotationPlan (see compile_config).
+_COMPILED_PLANS = collections.OrderedDict()
+# The functions called with every recorded metric (see add_metrics_hook).
+_METRICS_HOOKS = []
+# The shared layers, layer index and compiled configs of a rotation worker process.
+_WORKER_STATE = {}
+
+
+class InvalidConfigException(Exception):
+    """ Exception raised when a config is invalid. """
+    pass
+
+
+class _SolverBudgetExceeded(Exception):
+    """ Exception raised internally when the backtracking solver runs out of time or steps. """
+    pass
+
+
+class Layer(collections.abc.Mapping):
+    """
+    A compact, read-only layer (one element of the layers JSON) that behaves like a dict of its fields. The standard
+    fields are stored in slots (any other fields in a small dict), and string keys and values are interned, so layers
+    take a fraction of the memory of dicts and comparing equal values is an identity check.
+    """
+
+    # The standard fields of a layer in the layers JSON (see https://github.com/bsubei/squad_map_layers).
+    FIELDS = ('map', 'layer', 'gamemode', 'version', 'team1', 'team2', 'helicopters', 'night', 'RAA_Lanes',
+              'Invasion_Random', 'bugged', 'map_size')
+    __slots__ = FIELDS + ('_extra_fields',)
+    _FIELDS_SET = frozenset(FIELDS)
+
+    def __init__(self, fields):
+        """ :param fields: dict The layer's fields (e.g. one element of the parsed layers JSON). """
+        extra_fields = None
+        for key, value in fields.items():
+            if isinstance(value, str):
+                value = sys.intern(value)
+            if key in self._FIELDS_SET:
+                setattr(self, key, value)
+            else:
+                if extra_fields is None:
+                    extra_fields = {}
+                extra_fields[sys.intern(key) if isinstance(key, str) else key] = value
+        self._extra_fields = extra_fields
+
+    def __getitem__(self, key):
+        if key in self._FIELDS_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                # This layer doesn't have this standard field.
+                raise KeyError(key) from None
+        if self._extra_fields is None:
+            raise KeyError(key)
+        return self._extra_fields[key]
+
+    def get(self, key, default=None):
+        # Avoid raising and catching KeyError in Mapping.get, since filtering calls this for every layer.
+        if key in self._FIELDS_SET:
+            return getattr(self, key, default)
+        if self._extra_fields is None:
+            return default
+        return self._extra_fields.get(key, default)
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self._extra_fields is not None:
+            yield from self._extra_fields
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Layer({self.to_dict()!r})'
+
+    def to_dict(self):
+        """ Returns the layer as a plain dict (e.g. to write it out as JSON). """
+        return dict(self.items())
+
+
+class LayerIndex:
+    """
+    An inverted index over a list of layers, mapping each (field, value) pair to the ids of the layers with that value.
+    A layer's id is its position in the list of layers the index was built from. Filtering layers with a config filter
+    becomes a few set unions/intersections instead of a scan over every layer.
+    """
+
+    # The special filter key that matches either of these layer fields.
+    TEAM_FIELDS = ('team1', 'team2')
+
+    def __init__(self, layers):
+        """
+        :param layers: list(dict) The list of layers to index (e.g. the output of get_json_layers). Must not be mutated
+                       while the index is in use.
+        """
+        ids_by_field = {}
+        for layer_id, layer in enumerate(layers):
+            for field, value in layer.items():
+                try:
+                    ids_by_field.setdefault(field, {}).setdefault(value, set()).add(layer_id)
+                except TypeError:
+                    # Unhashable values (lists, dicts) are never used as filter values, so don't index them.
+                    continue
+        self._set_fields(layers, {id(layer): layer_id for layer_id, layer in enumerate(layers)},
+                         {field: {value: frozenset(ids) for value, ids in ids_by_value.items()}
+                          for field, ids_by_value in ids_by_field.items()})
+
+    def _set_fields(self, layers, ids_by_object, ids_by_field):
+        """ Sets the index's layers, the layer id of each layer object and the postings of each field. """
+        self.layers = layers
+        self.all_ids = frozenset(range(len(layers)))
+        # Maps id(layer) to its layer id so chosen layers can be mapped back to ids in constant time.
+        self._ids_by_object = ids_by_object
+        # Maps field name -> field value -> frozenset of layer ids.
+        self._ids_by_field = ids_by_field
+        # Maps a compiled SlotFilter to the frozenset of ids of the layers that pass it.
+        self._candidate_ids = {}
+        # Maps a tuple of WeightRule objects to the weight of each layer (or None if they are all 1), and a
+        # (SlotFilter, weight rules) pair to the AliasTable of the filter's candidates.
+        self._weights = {}
+        self._alias_tables = {}
+        # The LayerSchema of the layers, and the hash of their contents (computed when first needed).
+        self._schema = None
+        self._layers_hash = None
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def schema(self):
+        """ The LayerSchema of the indexed layers (computed once). """
+        if self._schema is None:
+            self._schema = LayerSchema.from_layer_index(self)
+        return self._schema
+
+    @property
+    def layers_hash(self):
+        """ A hash (str) of the contents of the indexed layers (computed once). """
+        if self._layers_hash is None:
+            layers_json = json.dumps([dict(layer) for layer in self.layers], sort_keys=True, default=str)
+            self._layers_hash = hashlib.sha256(layers_json.encode('utf-8')).hexdigest()
+        return self._layers_hash
+
+    def id_of(self, layer):
+        """ Returns the layer id of the given layer (which must be one of the indexed layer objects). """
+        return self._ids_by_object[id(layer)]
+
+    def get_ids(self, fields, values):
+        """ Returns the set of ids of layers where any of the given fields has any of the given values. """
+        matching_ids = set()
+        for field in fields:
+            ids_by_value = self._ids_by_field.get(field, {})
+            for value in values:
+                matching_ids.update(ids_by_value.get(value, ()))
+        return matching_ids
+
+    def candidate_ids(self, slot_filter):
+        """
+        Returns the frozenset of ids of layers that pass the given compiled SlotFilter. Results are memoized per filter,
+        so repeated slots with the same filter cost a single dict lookup.
+        """
+        candidate_ids = self._candidate_ids.get(slot_filter)
+        if candidate_ids is None:
+            # NOTE(bsubei): multiple filter keys apply an "AND" operation. However, multiple values in one filter key
+            # apply an "OR" operation.
+            # e.g. given filter 1 is {'gamemode': ['AAS', 'RAAS']} and filter 2 is {'map_size': 'small'}, then the
+            # chosen layer will be either AAS **or** RAAS **and** either way must be a small size map.
+            filtered_ids = set(self.all_ids)
+            for clause in slot_filter.clauses:
+                filtered_ids &= self.get_ids(clause.fields, clause.values)
+                # Stop early since no further filter can add layers back.
+                if not filtered_ids:
+                    break
+            candidate_ids = self._candidate_ids[slot_filter] = frozenset(filtered_ids)
+        return candidate_ids
+
+    def filter_ids(self, filter_config):
+        """
+        Returns the set of ids of layers that pass the given filter config (either the 'any' keyword or a dict of
+        filters, see README.md).
+        """
+        return set(self.candidate_ids(compile_filter(filter_config)))
+
+    def weights(self, weight_rules=()):
+        """
+        Returns the weight of each layer (a tuple indexed by layer id) for the given tuple of WeightRule objects, or
+        None if every layer has a weight of 1 (so callers can keep sampling uniformly). A layer's weight is its own
+        'weight' field (1 if it has none) times the weight of every rule whose filter it passes. Memoized per rules.
+        """
+        if weight_rules not in self._weights:
+            weights = [1.0] * len(self.layers)
+            for value, layer_ids in self._ids_by_field.get('weight', {}).items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value < math.inf:
+                    logging.warning(f'Ignoring invalid weight {value!r} of {len(layer_ids)} layers! Please use '
+                                    'positive numbers.')
+                    continue
+                for layer_id in layer_ids:
+                    weights[layer_id] *= value
+            for weight_rule in weight_rules:
+                for layer_id in self.candidate_ids(weight_rule.slot_filter):
+                    weights[layer_id] *= weight_rule.weight
+            self._weights[weight_rules] = None if all(weight == 1.0 for weight in weights) else tuple(weights)
+        return self._weights[weight_rules]
+
+    def alias_table(self, slot_filter, weight_rules=()):
+        """
+        Returns the AliasTable of the layers that pass the given SlotFilter, weighted by the given tuple of WeightRule
+        objects (see weights). Memoized per filter and rules, so every rotation of a config shares the same tables.
+        """
+        key = (slot_filter, weight_rules)
+        alias_table = self._alias_tables.get(key)
+        if alias_table is None:
+            alias_table = AliasTable.from_weights(sorted(self.candidate_ids(slot_filter)),
+                                                  self.weights(weight_rules) or [1.0] * len(self.layers))
+            self._alias_tables[key] = alias_table
+        return alias_table
+
+
+class LayerSchema:
+    """
+    A summary of the fields of a set of layers, computed once so configs can be validated with dict lookups instead of
+    scans over every layer: which fields every layer has, the values each field takes (its domain), and the types of
+    those values. The special 'team' field is valid if every layer has both 'team1' and 'team2', and its domain is the
+    union of theirs.
+    """
+
+    def __init__(self, layers):
+        """ :param layers: list(dict) The list of layers to summarize. """
+        # The number of layers that have each field (not None), and the hashable values of each field.
+        num_layers_with_field = collections.Counter()
+        domains = {}
+        for layer in layers:
+            for field, value in layer.items():
+                if value is None:
+                    continue
+                num_layers_with_field[field] += 1
+                try:
+                    domains.setdefault(field, set()).add(value)
+                except TypeError:
+                    # Unhashable values can't be filtered on, so they aren't part of the domain.
+                    continue
+        self._set_fields(len(layers), num_layers_with_field, domains)
+
+    @classmethod
+    def from_layer_index(cls, layer_index):
+        """
+        Returns the LayerSchema of the layers in the given LayerIndex, computed from the index's postings (so it costs
+        one step per distinct value instead of one per layer and field).
+        """
+        num_layers_with_field = collections.Counter()
+        domains = {}
+        for field, ids_by_value in layer_index._ids_by_field.items():
+            for value, ids in ids_by_value.items():
+                if value is not None:
+                    num_layers_with_field[field] += len(ids)
+                    domains.setdefault(field, set()).add(value)
+        schema = cls.__new__(cls)
+        schema._set_fields(len(layer_index), num_layers_with_field, domains)
+        return schema
+
+    def _set_fields(self, num_layers, num_layers_with_field, domains):
+        """ Sets the schema's fields from the number of layers with each field and each field's values. """
+        self.num_layers = num_layers
+        filter_keys = {field for field, count in num_layers_with_field.items() if count == num_layers}
+        if num_layers and all(field in filter_keys for field in LayerIndex.TEAM_FIELDS):
+            filter_keys.add('team')
+            domains['team'] = set().union(*(domains.get(field, ()) for field in LayerIndex.TEAM_FIELDS))
+        self.filter_keys = frozenset(filter_keys)
+        self.domains = {field: frozenset(values) for field, values in domains.items()}
+        self.types = {field: frozenset(value_type.__name__ for value_type in set(map(type, values)))
+                      for field, values in domains.items()}
+
+    def is_filter_key(self, key):
+        """ Returns whether configs can filter by the given key (i.e. every layer has it). """
+        return key in self.filter_keys
+
+    def matches_any_layer(self, key, value):
+        """ Returns whether any layer has the given value for the given key. """
+        try:
+            return value in self.domains.get(key, ())
+        except TypeError:
+            return False
+
+
+class LayerPool:
+    """
+    The pool of layer ids still available for sampling without replacement. The ids are kept in a swap-remove array
+    (with each id's position in it), so removing an id is constant time and the layers themselves are never copied or
+    mutated.
+    """
+
+    def __init__(self, num_layers):
+        """ :param num_layers: int The number of layers in the pool (ids 0 to num_layers - 1 start out available). """
+        self._ids = list(range(num_layers))
+        # The position of each id in self._ids, or None if the id was removed.
+        self._positions = list(range(num_layers))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, layer_id):
+        return self._positions[layer_id] is not None
+
+    def remove(self, layer_id):
+        """ Removes the given id from the pool by swapping it with the last id. Raises KeyError if already removed. """
+        position = self._positions[layer_id]
+        if position is None:
+            raise KeyError(layer_id)
+        last_id = self._ids.pop()
+        if last_id != layer_id:
+            self._ids[position] = last_id
+            self._positions[last_id] = position
+        self._positions[layer_id] = None
+
+    def available(self, candidate_ids):
+        """ Returns a list of the given candidate ids that are still in the pool. """
+        # Walk whichever of the two is smaller.
+        if len(candidate_ids) <= len(self._ids):
+            return [layer_id for layer_id in candidate_ids if self._positions[layer_id] is not None]
+        return [layer_id for layer_id in self._ids if layer_id in candidate_ids]
+
+
+class RecentMaps:
+    """
+    A sliding window over the map names of the last few chosen layers, with a count of each map name in the window so
+    checking whether a map was recently played is a single dict lookup. Updated incrementally as layers are chosen.
+    """
+
+    def __init__(self, size):
+        """ :param size: int The number of most recent layers to remember (clamped to at least one). """
+        self.size = max(1, size)
+        self._window = collections.deque()
+        self._counts = collections.Counter()
+
+    def __contains__(self, map_name):
+        return map_name in self._counts
+
+    def add(self, map_name):
+        """ Adds the map name of the newest chosen layer, forgetting the oldest one if the window is full. """
+        self._window.append(map_name)
+        self._counts[map_name] += 1
+        if len(self._window) > self.size:
+            oldest_map_name = self._window.popleft()
+            self._counts[oldest_map_name] -= 1
+            if not self._counts[oldest_map_name]:
+                del self._counts[oldest_map_name]
+
+
+class AliasTable(collections.namedtuple('AliasTable', ['ids', 'probabilities', 'aliases'])):
+    """
+    An alias table (Vose's alias method) over a set of weighted layer ids, so drawing an id with probability
+    proportional to its weight takes constant time regardless of the number of ids: pick a column uniformly, then
+    either its own id (with the column's probability) or its alias. Built once in linear time (see from_weights).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_weights(cls, ids, weights):
+        """
+        Builds the alias table of the given layer ids.
+
+        :param ids: list(int) The layer ids to draw from.
+        :param weights: The (positive) weight of each layer, indexed by layer id (see LayerIndex.weights).
+        """
+        ids = tuple(ids)
+        total_weight = sum(weights[layer_id] for layer_id in ids)
+        # Scale the weights so they average to 1, then fill every column up to 1 by pairing a column below 1 with
+        # (part of) a column above 1, which becomes its alias.
+        scaled = [weights[layer_id] * len(ids) / total_weight for layer_id in ids]
+        probabilities = [1.0] * len(ids)
+        aliases = list(ids)
+        small = [column for column, value in enumerate(scaled) if value < 1.0]
+        large = [column for column, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            small_column = small.pop()
+            large_column = large.pop()
+            probabilities[small_column] = scaled[small_column]
+            aliases[small_column] = ids[large_column]
+            scaled[large_column] -= 1.0 - scaled[small_column]
+            (small if scaled[large_column] < 1.0 else large).append(large_column)
+        # Any columns left over are full (up to rounding errors), so they keep a probability of 1.
+        return cls(ids, tuple(probabilities), tuple(aliases))
+
+    def draw(self, rng=random):
+        """ Returns a random id (which must exist) drawn by weight with the given random.Random. """
+        # One random number picks both the column (its integer part) and the coin flip (its fractional part).
+        value = rng.random() * len(self.ids)
+        column = int(value)
+        return self.ids[column] if value - column < self.probabilities[column] else self.aliases[column]
+
+
+class WeightedSampler:
+    """
+    Draws weighted layer ids from an AliasTable without replacement, for one rotation. Ids that were already used (not
+    in the LayerPool) or are otherwise invalid are rejected and drawn again, and after too many rejections in a row the
+    table is rebuilt from only the ids left in the pool, so each pick stays constant time on average as the pool
+    shrinks.
+    """
+
+    def __init__(self, alias_table, weights):
+        """
+        :param alias_table: AliasTable The table of the candidate layer ids to draw from.
+        :param weights: The weight of each layer, indexed by layer id (used to rebuild the table).
+        """
+        self.alias_table = alias_table
+        self.weights = weights
+
+    def sample(self, rng, pool, is_valid=None):
+        """
+        Returns a random id (drawn by weight with the given random.Random) that is in the given LayerPool and passes
+        the given is_valid function (if any), or None if there is no such id.
+        """
+        if not self.alias_table.ids:
+            return None
+        for _ in range(MAX_ALIAS_REJECTIONS):
+            layer_id = self.alias_table.draw(rng)
+            if layer_id in pool and (is_valid is None or is_valid(layer_id)):
+                return layer_id
+
+        # Too many rejections, so forget the used ids and choose directly from the valid ones that are left.
+        available_ids = [layer_id for layer_id in self.alias_table.ids if layer_id in pool]
+        if len(available_ids) < len(self.alias_table.ids):
+            self.alias_table = AliasTable.from_weights(available_ids, self.weights)
+        valid_ids = [layer_id for layer_id in available_ids if is_valid is None or is_valid(layer_id)]
+        if not valid_ids:
+            return None
+        return rng.choices(valid_ids, weights=[self.weights[layer_id] for layer_id in valid_ids])[0]
+
+
+# A compiled filter key: a layer passes if any of its fields has any of the values ("OR").
+FilterClause = collections.namedtuple('FilterClause', ['fields', 'values'])
+
+
+class SlotFilter(collections.namedtuple('SlotFilter', ['clauses', 'description'])):
+    """
+    A compiled, hashable filter for one slot of a rotation. A layer passes if it passes every clause ("AND"). The
+    'any' keyword compiles to a filter with no clauses. The description is the original filter config as a string.
+    """
+    __slots__ = ()
+
+    def matches(self, layer):
+        """ Returns whether the given layer passes this filter. """
+        return all(any(layer.get(field) in clause.values for field in clause.fields) for clause in self.clauses)
+
+
+# A compiled entry of the 'weights' config: the layers that pass the filter are chosen weight times as often.
+WeightRule = collections.namedtuple('WeightRule', ['slot_filter', 'weight'])
+
+
+class RotationPlan(collections.namedtuple('RotationPlan', ['starting_maps', 'regular_maps', 'number_of_repeats',
+                                                           'weights'], defaults=((),))):
+    """
+    An immutable, compiled rotation config (see compile_config). The starting_maps and regular_maps fields are tuples
+    of SlotFilter objects, and the weights field is a tuple of WeightRule objects.
+    """
+    __slots__ = ()
+
+    def slots(self):
+        """ Returns the SlotFilter of every slot in the rotation, in order. """
+        return self.starting_maps + self.regular_maps * self.number_of_repeats
+
+    def iter_slots(self):
+        """ Yields the SlotFilter of every slot in the rotation, in order (without building the whole tuple). """
+        repeated_regular_maps = itertools.repeat(self.regular_maps, self.number_of_repeats)
+        return itertools.chain(self.starting_maps, itertools.chain.from_iterable(repeated_regular_maps))
+
+
+def _import_numpy():
+    """ Returns the numpy module (importing it on first use), or None if NumPy is not installed. """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+    return numpy
+
+
+def compile_filter(filter_config):
+    """ Compiles one filter config (either the 'any' keyword or a dict of filters) into a SlotFilter. """
+    if isinstance(filter_config, str) and filter_config.casefold() == 'any':
+        return SlotFilter((), str(filter_config))
+
+    clauses = []
+    for key, value in filter_config.items():
+        # We upgrade the value to a list if it wasn't already so we can treat single and multiple values the same.
+        values = value if isinstance(value, list) else [value]
+        # The 'team' key is special and counts as either 'team1' or 'team2'.
+        fields = LayerIndex.TEAM_FIELDS if key == 'team' else (key,)
+        # Unhashable values (e.g. nested lists) can never match a layer's value, so they are dropped.
+        hashable_values = []
+        for v in values:
+            try:
+                hash(v)
+            except TypeError:
+                continue
+            hashable_values.append(v)
+        clauses.append(FilterClause(fields, frozenset(hashable_values)))
+    return SlotFilter(tuple(clauses), str(filter_config))
+
+
+def compile_weight_rule(weight_config):
+    """ Compiles one entry of the 'weights' config (a dict of filters and a 'weight') into a WeightRule. """
+    filter_config = {key: value for key, value in weight_config.items() if key != 'weight'}
+    return WeightRule(compile_filter(filter_config), float(weight_config['weight']))
+
+
+def get_config_hash(config):
+    """ Returns a hash (hex string) of the given config that is stable across runs and dict key orders. """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def compile_config(config):
+    """
+    Compiles the given (validated) rotation config into an immutable RotationPlan that can be executed many times by
+    get_map_rotation. Plans are cached by the config's hash, so compiling the same config again is a dict lookup.
+
+    :param config: dict The config that describes how to choose the rotation (e.g. the output of parse_config).
+    :return: RotationPlan The compiled config.
+    """
+    config_hash = get_config_hash(config)
+    plan = _COMPILED_PLANS.get(config_hash)
+    if plan is None:
+        plan = RotationPlan(
+            starting_maps=tuple(compile_filter(filter_config) for filter_config in config.get('starting_maps') or []),
+            regular_maps=tuple(compile_filter(filter_config) for filter_config in config.get('regular_maps')),
+            number_of_repeats=config.get('number_of_repeats', 1),
+            weights=tuple(compile_weight_rule(weight_config) for weight_config in config.get('weights') or []))
+        _COMPILED_PLANS[config_hash] = plan
+        # Evict the oldest plan so the cache stays bounded.
+        if len(_COMPILED_PLANS) > MAX_COMPILED_PLANS:
+            _COMPILED_PLANS.popitem(last=False)
+    return plan
+
+
+def add_metrics_hook(hook):
+    """
+    Registers the given hook to be called as hook(name, value, labels) with every metric recorded by this module (see
+    record_metric), and returns it. Metrics are only recorded in this process (not in worker processes).
+    """
+    _METRICS_HOOKS.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook):
+    """ Unregisters the given metrics hook (see add_metrics_hook). """
+    _METRICS_HOOKS.remove(hook)
+
+
+def record_metric(name, value, **labels):
+    """ Records a metric (e.g. a duration or a count) with the given labels by passing it to every metrics hook. """
+    for hook in _METRICS_HOOKS:
+        hook(name, value, labels)
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """ A context manager that records the wall time (in seconds) spent inside it as the 'stage_seconds' metric. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric('stage_seconds', time.perf_counter() - start, stage=stage)
+
+
+class RunMetrics:
+    """
+    A metrics hook (see add_metrics_hook) that collects the metrics of a run, and writes them out either as JSON lines
+    (one line per recorded metric) or as a Prometheus textfile (for the node exporter's textfile collector). In the
+    Prometheus textfile, metrics with names ending in '_total' are summed and other metrics keep their last value.
+    Can be used as a context manager to register and unregister itself.
+    """
+
+    def __init__(self):
+        # The recorded metrics as (timestamp, name, value, labels) tuples.
+        self.samples = []
+
+    def __call__(self, name, value, labels):
+        self.samples.append((time.time(), name, value, dict(labels)))
+
+    def __enter__(self):
+        return add_metrics_hook(self)
+
+    def __exit__(self, *exc_info):
+        remove_metrics_hook(self)
+
+    def get_json_lines(self):
+        """ Returns the recorded metrics as JSON lines. """
+        return ''.join(json.dumps({'timestamp': timestamp, 'name': name, 'value': value, 'labels': labels}) + '\n'
+                       for timestamp, name, value, labels in self.samples)
+
+    def get_prometheus_text(self):
+        """
+        Returns the recorded metrics in the Prometheus text format, with the samples of each metric grouped together
+        under a '# TYPE' line.
+        """
+        families = collections.OrderedDict((name, collections.OrderedDict([((), 0)])) for name in METRICS_COUNTERS)
+        for _, name, value, labels in self.samples:
+            values = families.setdefault(name, collections.OrderedDict())
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + value if name.endswith('_total') else value
+
+        lines = []
+        for name, values in families.items():
+            lines.append(f'# TYPE {METRICS_PREFIX}{name} {"counter" if name.endswith("_total") else "gauge"}')
+            for labels, value in values.items():
+                # Label values must escape backslashes and double quotes.
+                labels_string = ','.join(
+                    '{}="{}"'.format(label, str(label_value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for label, label_value in labels)
+                lines.append(f'{METRICS_PREFIX}{name}{{{labels_string}}} {value}' if labels_string else
+                             f'{METRICS_PREFIX}{name} {value}')
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, filepath, metrics_format='json'):
+        """ Writes the recorded metrics to the given filepath (atomically) in one of METRICS_FORMATS. """
+        text = self.get_prometheus_text() if metrics_format == 'prometheus' else self.get_json_lines()
+        filepath = pathlib.Path(filepath)
+        temp_path = filepath.with_name(f'{filepath.name}.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, filepath)
+
+
+def _parse_position(value):
+    """ Parses a rotation position (from 1) given on the commandline, for argparse to report an error if invalid. """
+    try:
+        position = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid position: {value!r}')
+    if position < 1:
+        raise argparse.ArgumentTypeError(f'invalid position: {value!r} (positions start from 1)')
+    return position
+
+
+def parse_cli():
+    """ Parses sys.argv (commandline args) and returns a parser with the arguments. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output-filepath', default=DEFAULT_MAP_ROTATION_FILEPATH, type=pathlib.Path,
+                        help=f'Filepath to write out map rotation to. Defaults to {DEFAULT_MAP_ROTATION_FILEPATH}')
+    parser.add_argument('-c', '--config-filepath', default=DEFAULT_CONFIG_FILEPATH, type=pathlib.Path,
+                        help=f'Filepath to read rotation config from. Defaults to {DEFAULT_CONFIG_FILEPATH}.')
+    parser.add_argument('--discord-webhook-url', action='append',
+                        help=('The URL to the Discord webhook if you want to post the latest rotation to a Discord'
+                              ' channel. Can be given more than once to post to several channels.'))
+    parser.add_argument('--solver', choices=SOLVERS, default='greedy',
+                        help=('How to choose layers: "greedy" fills each slot in order, "backtrack" searches for a'
+                              ' complete valid rotation first (falling back to greedy). Defaults to greedy.'))
+    parser.add_argument('--solver-budget', type=float, default=DEFAULT_SOLVER_BUDGET_SECONDS,
+                        help=('The number of seconds the backtrack solver may search for. Defaults to'
+                              f' {DEFAULT_SOLVER_BUDGET_SECONDS}.'))
+    parser.add_argument('--engine', choices=ENGINES, default='python',
+                        help=('The implementation to generate rotations with. "numpy" is much faster for many'
+                              ' rotations (requires NumPy and the greedy solver). Defaults to python.'))
+    parser.add_argument('-n', '--num-rotations', type=int, default=1,
+                        help=('The number of rotations to generate. If more than one, each is written to the output'
+                              ' filepath with its number appended (e.g. MapRotation_01.cfg). Defaults to 1.'))
+    parser.add_argument('--workers', type=int,
+                        help='The number of processes to generate rotations with. Defaults to the number of CPUs.')
+    parser.add_argument('--fleet-manifest', type=pathlib.Path,
+                        help=('Filepath to a fleet manifest listing the config, output filepath and optional Discord'
+                              ' webhook URL of many servers, which all get a rotation in one run (see'
+                              ' fleet.example.yml). Overrides --config-filepath, --output-filepath and'
+                              ' --discord-webhook-url.'))
+    parser.add_argument('--seed', type=int,
+                        help=('The seed to choose layers with. The same seed, config and layers always give the same'
+                              ' rotation, which is then loaded from the rotation cache in --cache-dir instead of being'
+                              ' generated again (e.g. use the date as the seed to get one rotation per day).'))
+    parser.add_argument('--history-file', type=pathlib.Path,
+                        help=('Filepath to a play history file. Rotations avoid the layers (and the last few maps)'
+                              ' played in the last --history-days days, and every written rotation is added to it.'))
+    parser.add_argument('--history-days', type=float, default=DEFAULT_HISTORY_DAYS,
+                        help=('The number of days of play history to avoid with --history-file. Defaults to'
+                              f' {DEFAULT_HISTORY_DAYS}.'))
+    parser.add_argument('--dry-run', nargs='*', type=pathlib.Path, metavar='CONFIG',
+                        help=('Instead of generating rotations, check whether the given configs (or the'
+                              ' --fleet-manifest configs, or the --config-filepath config if none are given) can give'
+                              ' complete rotations that follow all the rules, and print the number of candidate layers'
+                              ' of each slot. Exits with an error if any config is invalid or infeasible.'))
+    parser.add_argument('--reroll', type=_parse_position, nargs='+', metavar='POSITION',
+                        help=('Instead of generating a new rotation, choose the layers at the given positions (from 1)'
+                              ' of the existing rotation in --output-filepath again, keeping every other layer, and'
+                              ' write it back. The rotation must have been generated from the --config-filepath'
+                              ' config.'))
+    parser.add_argument('--fairness', type=int, metavar='NUM_ROTATIONS',
+                        help=('Instead of writing a rotation, generate this many rotations of the --config-filepath'
+                              ' config (across --workers processes) and report how often each layer, map, team and'
+                              ' gamemode is chosen (overall and per position) and how often slots are skipped or maps'
+                              ' are duplicated.'))
+    parser.add_argument('--fairness-report', type=pathlib.Path,
+                        help='Filepath to write the --fairness report to (as JSON). Defaults to printing it.')
+    parser.add_argument('--metrics', type=pathlib.Path,
+                        help=('Filepath to write the metrics of this run to (the time spent in each stage, number of'
+                              ' layers, candidates per slot, skipped slots, etc.).'))
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, default='json',
+                        help=('The format of the --metrics file: JSON lines, or a Prometheus textfile for the node'
+                              ' exporter. Defaults to json.'))
+    parser.add_argument('--serve', nargs='?', const=DEFAULT_SERVICE_ADDRESS, metavar='ADDRESS',
+                        help=('Run as a service that keeps the layers and configs in memory, reloads them when they'
+                              ' change, and serves rotations over HTTP at the given "host:port" or Unix socket path'
+                              f' (defaults to {DEFAULT_SERVICE_ADDRESS}). Serves the --fleet-manifest servers, or the'
+                              ' --config-filepath config.'))
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_SERVICE_POLL_SECONDS,
+                        help=('The number of seconds between checks for changed layers and configs with --serve.'
+                              f' Defaults to {DEFAULT_SERVICE_POLL_SECONDS}.'))
+    parser.add_argument('--schedule-interval', type=float,
+                        help=('With --serve, write (and post to Discord) a new rotation for every server every this'
+                              ' many seconds.'))
+    # Expect either an input filepath or URL.
+    input_group = parser.add_mutually_exclusive_group()
+    input_group.add_argument(
+        '--input-filepath', help='Filepath of JSON file to use for map layers.')
+    input_group.add_argument('--input-url', default=DEFAULT_LAYERS_URL,
+                             help=(f'URL to JSON file to use for map layers. Defaults to {DEFAULT_LAYERS_URL} if'
+                                   ' --input-filepath is not provided.'))
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, type=pathlib.Path,
+                        help=('Directory to cache the layers downloaded from --input-url (and the rotations generated'
+                              f' with --seed, and the parsed configs) in. Defaults to {DEFAULT_CACHE_DIR}.'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help=('Always download the layers from --input-url, and never use cached rotations or parsed'
+                              ' configs.'))
+    parser.add_argument('--cache-max-age', default=DEFAULT_CACHE_MAX_AGE_SECONDS, type=float,
+                        help=('The number of seconds to use the cached layers without checking for a newer version.'
+                              f' Defaults to {DEFAULT_CACHE_MAX_AGE_SECONDS}.'))
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help=('Always parse the layers JSON instead of loading the pre-parsed snapshot stored next to'
+                              ' it (or next to its cached download).'))
+    parser.add_argument('--request-timeout', default=DEFAULT_REQUEST_TIMEOUT_SECONDS, type=float,
+                        help=('The number of seconds to wait when downloading the layers. Defaults to'
+                              f' {DEFAULT_REQUEST_TIMEOUT_SECONDS}.'))
+    return parser.parse_args()
+
+
+def fetch_url(url, cache_dir=DEFAULT_CACHE_DIR, max_age=DEFAULT_CACHE_MAX_AGE_SECONDS,
+              timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+    """
+    Returns the body (bytes) at the given URL, using an on-disk cache of the body and its ETag/Last-Modified headers.
+    A cached body younger than max_age is used as is. Otherwise, the server is asked for the body only if it changed
+    (If-None-Match/If-Modified-Since). If the request fails or times out, the cached body is used (with a warning).
+
+    :param url: str The URL to fetch.
+    :param cache_dir: pathlib.Path The directory to cache downloads in. Caching is disabled if None.
+    :param max_age: float The number of seconds a cached body is used without asking the server.
+    :param timeout: float The number of seconds to wait for the server.
+    :raises urllib.error.URLError: If the request fails and there is no cached body.
+    """
+    from urllib import error, request
+
+    if cache_dir is None:
+        with request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+
+    cache_dir = pathlib.Path(cache_dir)
+    cache_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    body_path = cache_dir / f'{cache_key}.body'
+    metadata_path = cache_dir / f'{cache_key}.json'
+
+    # Load the cached body and its metadata, if any.
+    try:
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+        # Metadata without a valid fetch time (e.g. written by an older version) is a cache miss.
+        if not isinstance(metadata, dict) or isinstance(metadata.get('fetched_at'), bool) or \
+                not isinstance(metadata.get('fetched_at'), (int, float)):
+            raise ValueError(f'Invalid cache metadata in {metadata_path}')
+        with open(body_path, 'rb') as f:
+            cached_body = f.read()
+    except (OSError, ValueError):
+        metadata, cached_body = None, None
+
+    if metadata is not None and time.time() - metadata['fetched_at'] < max_age:
+        return cached_body
+
+    headers = {}
+    if metadata is not None:
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+
+    try:
+        with request.urlopen(request.Request(url, headers=headers), timeout=timeout) as response:
+            body = response.read()
+            metadata = {'url': url, 'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+    except error.HTTPError as e:
+        if e.code == 304 and cached_body is not None:
+            # The cached body is still current, so just note that we checked.
+            body = cached_body
+        elif cached_body is not None:
+            logging.warning(f'Could not fetch {url} ({e})! Using the cached copy instead.')
+            return cached_body
+        else:
+            raise
+    except OSError as e:
+        # This covers connection errors and timeouts.
+        if cached_body is None:
+            raise
+        logging.warning(f'Could not fetch {url} ({e})! Using the cached copy instead.')
+        return cached_body
+
+    # Write out the cache atomically so a concurrent run never reads a partial body.
+    metadata['fetched_at'] = time.time()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for path, contents, mode in ((body_path, body, 'wb'), (metadata_path, json.dumps(metadata), 'w')):
+            temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            with open(temp_path, mode) as f:
+                f.write(contents)
+            os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f'Could not cache the download of {url} in {cache_dir}: {e}')
+    return body
+
+
+def get_url_version(url, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+    """
+    Returns the version (str) of the body at the given URL that the server reports to a HEAD request (its ETag, or
+    else its Last-Modified date), without downloading the body, or None if the server reports neither.
+
+    :raises urllib.error.URLError: If the request fails.
+    """
+    from urllib import request
+
+    with request.urlopen(request.Request(url, method='HEAD'), timeout=timeout) as response:
+        return response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+
+def parse_json_layers(data):
+    """ Parses the given layers JSON (str or bytes) into a list of Layer objects, without the bugged layers. """
+    all_layers = json.loads(data)
+    # Filter out all the bugged layers and return that.
+    return [Layer(layer) for layer in all_layers if not layer['bugged']]
+
+
+def get_json_layers(input_filepath, input_url, cache_dir=DEFAULT_CACHE_DIR, max_age=DEFAULT_CACHE_MAX_AGE_SECONDS,
+                    timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+    """
+    Return the JSON object represented by the given filepath or URL (in the args) as a list of Layer objects. See
+    https://github.com/bsubei/squad_map_layers for an example layers JSON file. URLs are fetched through an on-disk
+    cache (see fetch_url for the cache_dir, max_age and timeout arguments).
+    """
+    # Parse the filepath as JSON if it's provided.
+    if input_filepath:
+        # Just read the JSON file from a filepath.
+        with open(input_filepath, 'rb') as f:
+            return parse_json_layers(f.read())
+    # Otherwise, fetch the JSON file from the URL and parse it into a list of layers.
+    elif input_url:
+        return parse_json_layers(fetch_url(input_url, cache_dir, max_age, timeout))
+    else:
+        raise ValueError('Sanity check failed! No input args provided!')
+
+
+class SnapshotLayers(collections.abc.Sequence):
+    """
+    The layers of a memory-mapped layers snapshot (see read_layers_snapshot). A layer is only built from the snapshot's
+    columns the first time it is used, and the layer id of every built layer is recorded in ids_by_object (see
+    LayerIndex.id_of). Compares equal to (and pickles as) a list of the same layers.
+    """
+
+    def __init__(self, num_layers, columns):
+        """
+        :param num_layers: int The number of layers in the snapshot.
+        :param columns: list(tuple) The name, distinct values and column (the position of each layer's value in the
+                        distinct values, or SNAPSHOT_MISSING) of every field.
+        """
+        self._columns = columns
+        self._layers = [None] * num_layers
+        self.ids_by_object = {}
+
+    def __len__(self):
+        return len(self._layers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[layer_id] for layer_id in range(*index.indices(len(self)))]
+        layer = self._layers[index]
+        if layer is None:
+            layer_id = index % len(self._layers)
+            fields = {}
+            for field, values, column in self._columns:
+                position = column[layer_id]
+                if position != SNAPSHOT_MISSING:
+                    fields[field] = values[position]
+            layer = self._layers[layer_id] = Layer(fields)
+            self.ids_by_object[id(layer)] = layer_id
+        return layer
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class SnapshotPostings(collections.abc.Mapping):
+    """
+    The postings (field name -> field value -> frozenset of layer ids) of a memory-mapped layers snapshot (see
+    read_layers_snapshot). The postings of a field are only built from the snapshot the first time they are used.
+    """
+
+    def __init__(self, postings):
+        """
+        :param postings: dict Maps each field name to its distinct values, the offsets of each value's layer ids, and
+                         the layer ids of all the values.
+        """
+        self._postings = postings
+        self._ids_by_field = {}
+
+    def __getitem__(self, field):
+        ids_by_value = self._ids_by_field.get(field)
+        if ids_by_value is None:
+            values, offsets, ids = self._postings[field]
+            ids_by_value = {}
+            for position, value in enumerate(values):
+                value_ids = frozenset(ids[offsets[position]:offsets[position + 1]])
+                try:
+                    # Equal values of different types (e.g. 1 and 1.0) share their postings, like in LayerIndex.
+                    if value in ids_by_value:
+                        value_ids |= ids_by_value[value]
+                    ids_by_value[value] = value_ids
+                except TypeError:
+                    # Unhashable values (lists, dicts) are never used as filter values, so don't index them.
+                    continue
+            self._ids_by_field[field] = ids_by_value
+        return ids_by_value
+
+    def __iter__(self):
+        return iter(self._postings)
+
+    def __len__(self):
+        return len(self._postings)
+
+
+def write_layers_snapshot(snapshot_path, source_key, layer_index):
+    """
+    Writes the layers of the given LayerIndex to a binary snapshot file, tagged with the given key of the source it was
+    built from. Every field is stored as a JSON array of its distinct values, a column of 32-bit integers with the
+    position of each layer's value in that array, and the ids of the layers with each value (with an offset table), so
+    the snapshot can be memory-mapped and read without running any code from it. The file is written atomically, so
+    readers never see a partial snapshot.
+    """
+    layers = layer_index.layers
+    sections = []
+    data_length = 0
+
+    def add_section(data):
+        nonlocal data_length
+        # Pad every section to 4 bytes so the integer sections can be cast in place when mapped.
+        padding = b'\0' * (-len(data) % 4)
+        sections.extend((data, padding))
+        data_length += len(data) + len(padding)
+        return [data_length - len(data) - len(padding), len(data)]
+
+    field_headers = []
+    for field in dict.fromkeys(field for layer in layers for field in layer):
+        positions, values, ids_by_position = {}, [], []
+        column = array.array('I')
+        for layer_id, layer in enumerate(layers):
+            if field not in layer:
+                column.append(SNAPSHOT_MISSING)
+                continue
+            value = layer[field]
+            # The type is part of the key so equal values of different types (e.g. 1 and True) are kept apart.
+            key = (type(value), value)
+            try:
+                position = positions.get(key)
+            except TypeError:
+                key = json.dumps(value, sort_keys=True)
+                position = positions.get(key)
+            if position is None:
+                position = positions[key] = len(values)
+                values.append(value)
+                ids_by_position.append([])
+            column.append(position)
+            ids_by_position[position].append(layer_id)
+        offsets, ids = array.array('I', [0]), array.array('I')
+        for value_ids in ids_by_position:
+            ids.extend(value_ids)
+            offsets.append(len(ids))
+        field_headers.append({'name': field, 'num_values': len(values),
+                              'values': add_section(json.dumps(values).encode('utf-8')),
+                              'column': add_section(column.tobytes()), 'offsets': add_section(offsets.tobytes()),
+                              'ids': add_section(ids.tobytes())})
+
+    header = json.dumps({'version': SNAPSHOT_VERSION, 'source_key': source_key, 'byteorder': sys.byteorder,
+                         'num_layers': len(layers), 'layers_hash': layer_index.layers_hash,
+                         'fields': field_headers}).encode('utf-8')
+    snapshot_path = pathlib.Path(snapshot_path)
+    temp_path = snapshot_path.with_name(f'{snapshot_path.name}.{os.getpid()}.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header).to_bytes(4, 'little'))
+        f.write(header)
+        # The sections start at the next multiple of 4 bytes.
+        f.write(b'\0' * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 4))
+        f.writelines(sections)
+    os.replace(temp_path, snapshot_path)
+
+
+def read_layers_snapshot(snapshot_path, source_key):
+    """
+    Returns a LayerIndex over the layers in the given snapshot file (see write_layers_snapshot), or None if the
+    snapshot is missing, unreadable, from another snapshot version, or was built from a source with a different key.
+    The file is memory-mapped and only the distinct values of each field are decoded up front (to build the schema):
+    the layers and the postings of each field are read from the mapped columns when they are first used.
+    """
+    try:
+        with open(snapshot_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_start = len(SNAPSHOT_MAGIC) + 4
+        if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            return None
+        header_end = header_start + int.from_bytes(mapped[len(SNAPSHOT_MAGIC):header_start], 'little')
+        header = json.loads(mapped[header_start:header_end])
+        if (header.get('version') != SNAPSHOT_VERSION or header.get('source_key') != source_key or
+                header.get('byteorder') != sys.byteorder):
+            return None
+
+        num_layers = header['num_layers']
+        data = memoryview(mapped)[header_end + -header_end % 4:]
+
+        def get_section(field_header, name, length=None):
+            start, section_length = field_header[name]
+            if start + section_length > len(data) or (length is not None and section_length != length):
+                raise ValueError(f'The {name} section of the snapshot is truncated!')
+            return data[start:start + section_length]
+
+        columns, postings = [], {}
+        num_layers_with_field, domains = collections.Counter(), {}
+        for field_header in header['fields']:
+            field, num_values = sys.intern(field_header['name']), field_header['num_values']
+            values = json.loads(bytes(get_section(field_header, 'values')))
+            column = get_section(field_header, 'column', 4 * num_layers).cast('I')
+            offsets = get_section(field_header, 'offsets', 4 * (num_values + 1)).cast('I')
+            ids = get_section(field_header, 'ids').cast('I')
+            if len(values) != num_values or offsets[-1] != len(ids):
+                raise ValueError('The snapshot is inconsistent!')
+            columns.append((field, values, column))
+            postings[field] = (values, offsets, ids)
+            # Summarize the field like LayerSchema.from_layer_index does, without building its postings.
+            try:
+                domain = set(values)
+                num_layers_with_field[field] = len(ids)
+            except TypeError:
+                # Unhashable values (lists, dicts) are never used as filter values, so leave them out.
+                domain = set()
+                for position, value in enumerate(values):
+                    with contextlib.suppress(TypeError):
+                        domain.add(value)
+                        num_layers_with_field[field] += offsets[position + 1] - offsets[position]
+            if None in domain:
+                position = values.index(None)
+                num_layers_with_field[field] -= offsets[position + 1] - offsets[position]
+                domain.discard(None)
+            if domain:
+                domains[field] = domain
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    layers = SnapshotLayers(num_layers, columns)
+    layer_index = LayerIndex.__new__(LayerIndex)
+    layer_index._set_fields(layers, layers.ids_by_object, SnapshotPostings(postings))
+    layer_index._schema = LayerSchema.__new__(LayerSchema)
+    layer_index._schema._set_fields(num_layers, num_layers_with_field, domains)
+    layer_index._layers_hash = header['layers_hash']
+    return layer_index
+
+
+def get_layer_index(input_filepath, input_url, cache_dir=DEFAULT_CACHE_DIR, max_age=DEFAULT_CACHE_MAX_AGE_SECONDS,
+                    timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS, use_snapshot=True):
+    """
+    Returns a LayerIndex over the layers from the given filepath or URL (see get_json_layers). With use_snapshot, the
+    layers are memory-mapped from a binary snapshot next to the source (the layers file, or its cached download) when
+    the snapshot is up to date, and the snapshot is rebuilt otherwise. Snapshots of files are keyed by the file's
+    modification time and size, and snapshots of downloads by the hash of their contents.
+    """
+    snapshot_path, source_key, data = None, None, None
+    if input_filepath:
+        if use_snapshot:
+            stat = os.stat(input_filepath)
+            snapshot_path = pathlib.Path(f'{input_filepath}.snapshot')
+            source_key = f'{stat.st_mtime_ns}:{stat.st_size}'
+    elif input_url:
+        with timed_stage('fetch_layers'):
+            data = fetch_url(input_url, cache_dir, max_age, timeout)
+        if use_snapshot and cache_dir is not None:
+            url_key = hashlib.sha256(input_url.encode('utf-8')).hexdigest()
+            snapshot_path = pathlib.Path(cache_dir) / f'{url_key}.snapshot'
+            source_key = hashlib.sha256(data).hexdigest()
+    else:
+        raise ValueError('Sanity check failed! No input args provided!')
+
+    if snapshot_path is not None:
+        with timed_stage('load_layers_snapshot'):
+            layer_index = read_layers_snapshot(snapshot_path, source_key)
+        if layer_index is not None:
+            return layer_index
+
+    with timed_stage('parse_layers'):
+        if data is None:
+            with open(input_filepath, 'rb') as f:
+                data = f.read()
+        layer_index = LayerIndex(parse_json_layers(data))
+
+    if snapshot_path is not None:
+        try:
+            write_layers_snapshot(snapshot_path, source_key, layer_index)
+        except OSError as e:
+            logging.warning(f'Could not write the layers snapshot {snapshot_path}: {e}')
+    return layer_index
+
+
+def get_random_skirmish_layer(input_filepath, input_url, rng=random):
+    """
+    Return one random skirmish layer as a string from either the given filepath or URL to the JSON layers file, chosen
+    with the given random.Random (the random module by default).
+    """
+    layers = get_json_layers(input_filepath, input_url)
+    remaining_skirmish_layers = list(
+        filter(lambda m: m['gamemode'] == 'Skirmish', layers))
+    return get_layers([rng.choice(remaining_skirmish_layers)])[0]
+
+
+def get_nonduplicate_map(available_layers, chosen_rotation, min_layers_before_duplicate_map, recent_maps=None,
+                         rng=random, is_preferred=None):
+    """
+    Given the available layers to choose from, the current chosen_rotation, and the number of layers to check behind
+    for a duplicate map, randomly chooses and returns a layer that follows the global filter rules (see README.md).
+
+    :param available_layers:  A list of available layers to choose from (as dicts derived from the JSON object).
+    :param chosen_rotation:  The list of currently chosen layers.
+    :param min_layers_before_duplicate_map:  The number of maps before a duplicate map is allowed.
+    :param recent_maps:  An optional RecentMaps window over chosen_rotation, kept up to date by the caller. If not
+                         given, it is built from the end of chosen_rotation.
+    :param rng:  The random.Random to choose with (the random module by default).
+    :param is_preferred:  An optional function of a layer. If any layer that follows the global filter rules is
+                          preferred (e.g. was not played recently), one of those is chosen.
+    :return: A randomly chosen layer that follows the global filter rules.
+    """
+    if recent_maps is None:
+        recent_maps = RecentMaps(min_layers_before_duplicate_map)
+        for layer in chosen_rotation[-recent_maps.size:]:
+            recent_maps.add(layer['map'])
+
+    # Only choose from the layers that don't break the global duplicate rules (layers with the same map must not be
+    # too close together). The same exact layer is never available since we sample without replacement.
+    valid_layers = [layer for layer in available_layers if layer['map'] not in recent_maps]
+    if _METRICS_HOOKS:
+        record_metric('duplicate_map_rejections_total', len(available_layers) - len(valid_layers))
+    if valid_layers:
+        if is_preferred is not None:
+            preferred_layers = [layer for layer in valid_layers if is_preferred(layer)]
+            if preferred_layers:
+                return rng.choice(preferred_layers)
+        return rng.choice(valid_layers)
+
+    # If there is no valid layer, return the best we can after printing an error.
+    candidate_layer = rng.choice(available_layers)
+    record_metric('duplicate_map_violations_total', 1)
+    logging.error(f'Could not get a valid map without duplicates! Choosing {candidate_layer["layer"]} anyways!')
+    return candidate_layer
+
+
+def get_weighted_nonduplicate_map(samplers, pool, all_layers, recent_maps, rng=random):
+    """
+    The weighted counterpart of get_nonduplicate_map: randomly chooses (by weight) and returns a layer left in the pool
+    that follows the global filter rules, or one that breaks the duplicate map rule (with an error) if there is none.
+
+    :param samplers: list(WeightedSampler) The samplers of the layers to choose from, in order of preference (e.g. the
+                     layers that were not played recently first). The first one with a valid layer left is used, and
+                     only if none has one, the first one with any layer left.
+    :param pool: LayerPool The ids of the layers not chosen yet.
+    :param all_layers: list(dict) The list of all layers (indexed by layer id).
+    :param recent_maps: RecentMaps The window over the maps of the last chosen layers.
+    :param rng: The random.Random to choose with (the random module by default).
+    :return: A randomly chosen layer, or None if no sampler has any layer left in the pool.
+    """
+    def is_valid(layer_id):
+        return all_layers[layer_id]['map'] not in recent_maps
+
+    for sampler in samplers:
+        layer_id = sampler.sample(rng, pool, is_valid)
+        if layer_id is not None:
+            return all_layers[layer_id]
+    for sampler in samplers:
+        layer_id = sampler.sample(rng, pool)
+        if layer_id is not None:
+            candidate_layer = all_layers[layer_id]
+            record_metric('duplicate_map_violations_total', 1)
+            logging.error(f'Could not get a valid map without duplicates! Choosing {candidate_layer["layer"]} anyways!')
+            return candidate_layer
+    return None
+
+
+def solve_rotation(
+        plan,
+        layer_index,
+        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP,
+        budget_seconds=DEFAULT_SOLVER_BUDGET_SECONDS,
+        max_steps=DEFAULT_SOLVER_MAX_STEPS,
+        rng=random,
+        played_ids=frozenset(),
+        played_maps=()):
+    """
+    Searches for a complete rotation for the given plan that follows all the global filter rules (see README.md), using
+    randomized backtracking. The most constrained slot (fewest candidates left) is filled first, and after every choice
+    the candidates of the other slots are pruned (forward checking) so dead ends are found early.
+
+    :param plan: RotationPlan The compiled config to solve.
+    :param layer_index: LayerIndex The index of the layers to choose from.
+    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+    :param budget_seconds: float The wall-clock time to search for before giving up.
+    :param max_steps: int The number of slot assignments to try before giving up.
+    :param rng: random.Random The random number generator to shuffle candidates with (the random module by default).
+    :param played_ids: frozenset(int) The ids of recently played layers, which are tried after the other candidates.
+    :param played_maps: list(str) The most recently played maps (oldest first), which count against the duplicate map
+                        rule as if they were played right before the rotation.
+    :return: list(int) The ids of the chosen layers in rotation order, or None if no complete rotation was found (either
+             there is none or the budget ran out).
+    """
+    slots = plan.slots()
+    window = max(1, num_min_layers_before_duplicate_map)
+    map_of = [layer['map'] for layer in layer_index.layers]
+    weights = layer_index.weights(plan.weights)
+    # The ids of the layers each slot can still choose from.
+    domains = [set(layer_index.candidate_ids(slot_filter)) for slot_filter in slots]
+    # The first slots can't use the maps played right before the rotation.
+    played_maps = list(played_maps)
+    for position, domain in enumerate(domains[:window] if played_maps else ()):
+        blocked_maps = set(played_maps[position - window:])
+        domain.difference_update([candidate for candidate in domain if map_of[candidate] in blocked_maps])
+    # A slot without any candidates can never be filled. Also avoid recursing deeper than Python allows.
+    if not all(domains) or len(slots) > sys.getrecursionlimit() - 100:
+        return None
+    assignment = [None] * len(slots)
+    deadline = time.monotonic() + budget_seconds
+    steps = 0
+
+    def forward_check(position, layer_id):
+        """
+        Removes the candidates that conflict with choosing layer_id at position from all unassigned slots. Returns the
+        removed candidates (so they can be restored) and whether every unassigned slot still has a candidate.
+        """
+        trail = []
+        layer_map = map_of[layer_id]
+        for other, domain in enumerate(domains):
+            if other == position or assignment[other] is not None:
+                continue
+            # Nearby slots can't use the same map, and no other slot can use the same layer.
+            if abs(other - position) <= window:
+                removed = [candidate for candidate in domain if map_of[candidate] == layer_map]
+            elif layer_id in domain:
+                removed = [layer_id]
+            else:
+                continue
+            if removed:
+                domain.difference_update(removed)
+                trail.append((other, removed))
+                if not domain:
+                    return trail, False
+        return trail, True
+
+    def search(num_assigned):
+        nonlocal steps
+        if num_assigned == len(slots):
+            return True
+        steps += 1
+        if steps > max_steps or time.monotonic() > deadline:
+            raise _SolverBudgetExceeded()
+
+        # Fill the most constrained slot first.
+        position = min((p for p in range(len(slots)) if assignment[p] is None), key=lambda p: len(domains[p]))
+        candidates = list(domains[position])
+        if weights is None:
+            rng.shuffle(candidates)
+        else:
+            # A weighted shuffle (Efraimidis-Spirakis): heavier layers tend to be tried first.
+            candidates.sort(key=lambda layer_id: rng.random() ** (1.0 / weights[layer_id]), reverse=True)
+        if played_ids:
+            # Try recently played layers last (the sort is stable, so the shuffle is kept otherwise).
+            candidates.sort(key=lambda layer_id: layer_id in played_ids)
+        for layer_id in candidates:
+            trail, is_consistent = forward_check(position, layer_id)
+            if is_consistent:
+                assignment[position] = layer_id
+                if search(num_assigned + 1):
+                    return True
+                assignment[position] = None
+            # Undo the pruning before trying the next candidate.
+            for other, removed in trail:
+                domains[other].update(removed)
+        return False
+
+    try:
+        return assignment if search(0) else None
+    except _SolverBudgetExceeded:
+        return None
+
+
+def get_numpy_chunk_size(num_layers):
+    """
+    Returns the number of rotations the numpy engine should generate at once for the given number of layers, so each
+    chunk uses about NUMPY_ENGINE_MEMORY_BYTES (its arrays have one row per rotation and one column per layer).
+    """
+    return max(1, NUMPY_ENGINE_MEMORY_BYTES // (max(1, num_layers) * NUMPY_ENGINE_BYTES_PER_LAYER))
+
+
+def get_map_rotation_ids_numpy(
+        plan,
+        layer_index,
+        n,
+        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP,
+        seed=None,
+        played_ids=frozenset(),
+        played_maps=()):
+    """
+    Generates n rotations at once with NumPy, following the same rules as the greedy solver of get_map_rotation. The
+    layers' maps are encoded as integers, and every slot is filled for all n rotations at once by masking out each
+    rotation's used layers and recent maps among the slot's candidates and drawing uniformly from what is left (by
+    weight if the layers or the plan have weights). Memory use grows with n times the number of layers, so callers
+    generate many rotations in chunks (see get_numpy_chunk_size). Requires NumPy.
+
+    :param plan: RotationPlan The compiled config to generate rotations for.
+    :param layer_index: LayerIndex The index of the layers to choose from.
+    :param n: int The number of rotations to generate.
+    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+    :param seed: int The seed for NumPy's random generator.
+    :param played_ids, played_maps: The recently played layers and maps (see get_map_rotation).
+    :return: list(list(int)) The layer ids of each rotation (without the slots that had no layers to choose from).
+    """
+    numpy = _import_numpy()
+    slots = plan.slots()
+    num_layers = len(layer_index)
+    window = max(1, num_min_layers_before_duplicate_map)
+    rng = numpy.random.default_rng(seed)
+    rows = numpy.arange(n)
+    weights = layer_index.weights(plan.weights)
+    if weights is not None:
+        weights = numpy.array(weights, dtype=numpy.float64)
+
+    # Encode each layer's map as an integer.
+    map_codes_by_name = {}
+    map_codes = numpy.array([map_codes_by_name.setdefault(layer['map'], len(map_codes_by_name))
+                             for layer in layer_index.layers], dtype=numpy.int64)
+
+    # The layers each rotation already used, and the chosen layer ids (-1 for skipped slots).
+    used = numpy.zeros((n, num_layers), dtype=bool)
+    chosen = numpy.full((n, len(slots)), -1, dtype=numpy.int64)
+    # The recent maps window of each rotation: a ring buffer of map codes (-1 if empty) and a count per map code.
+    recent_ring = numpy.full((n, window), -1, dtype=numpy.int64)
+    recent_map_counts = numpy.zeros((n, max(1, len(map_codes_by_name))), dtype=numpy.int32)
+    num_chosen = numpy.zeros(n, dtype=numpy.int64)
+    # Start every window with the most recently played maps (maps without layers can't be duplicated, so skip them).
+    for position, map_name in enumerate(list(played_maps)[-window:]):
+        map_code = map_codes_by_name.get(map_name, -1)
+        recent_ring[:, position] = map_code
+        if map_code >= 0:
+            recent_map_counts[:, map_code] += 1
+        num_chosen += 1
+    # The recently played layers, which are only chosen if a rotation has no other valid layers.
+    played_mask = None
+    if played_ids:
+        played_mask = numpy.zeros(num_layers, dtype=bool)
+        played_mask[numpy.fromiter(played_ids, dtype=numpy.int64, count=len(played_ids))] = True
+
+    candidate_ids_by_filter = {}
+    for slot_number, slot_filter in enumerate(slots):
+        candidate_ids = candidate_ids_by_filter.get(slot_filter)
+        if candidate_ids is None:
+            candidate_ids = numpy.array(sorted(layer_index.candidate_ids(slot_filter)), dtype=numpy.int64)
+            candidate_ids_by_filter[slot_filter] = candidate_ids
+
+        # Only the columns of the slot's candidates are used, so slots with narrow filters are cheap.
+        available = ~used[:, candidate_ids]
+        valid = available & (recent_map_counts[:, map_codes[candidate_ids]] == 0)
+        has_available = available.any(axis=1)
+        has_valid = valid.any(axis=1)
+        if _METRICS_HOOKS:
+            record_metric('slot_candidates', float(available.sum(axis=1).mean()), slot=slot_number)
+            record_metric('duplicate_map_rejections_total', int((available & ~valid).sum()))
+        if played_mask is not None:
+            # Prefer the valid layers that weren't played recently (the played ones are still valid).
+            fresh = valid & ~played_mask[candidate_ids][None, :]
+            valid = numpy.where(fresh.any(axis=1)[:, None], fresh, valid)
+
+        # Draw from the valid layers, or (like the python engine) from the available layers if none are valid.
+        if weights is None:
+            keys = rng.random((n, len(candidate_ids)), dtype=numpy.float32)
+            keys[~numpy.where(has_valid[:, None], valid, available)] = -1.0
+        else:
+            # With weights, the layer with the shortest exponential waiting time (scaled down by its weight) wins,
+            # which chooses each layer with probability proportional to its weight.
+            keys = -rng.standard_exponential((n, len(candidate_ids))) / weights[candidate_ids][None, :]
+            keys[~numpy.where(has_valid[:, None], valid, available)] = -numpy.inf
+        # Rows without any candidate get a placeholder choice, and skip the slot below.
+        choices = candidate_ids[keys.argmax(axis=1)] if len(candidate_ids) else numpy.zeros(n, dtype=numpy.int64)
+
+        # Rotations without any available layer skip this slot.
+        num_skipped = n - int(has_available.sum())
+        if num_skipped:
+            record_metric('skipped_slots_total', num_skipped)
+            logging.error(f'No maps to choose from after applying filter {slot_filter.description}! Skipping this '
+                          f'filter{"" if n == 1 else f" in {num_skipped} rotations"}!')
+        num_duplicates = int((has_available & ~has_valid).sum())
+        if num_duplicates:
+            record_metric('duplicate_map_violations_total', num_duplicates)
+            logging.error('Could not get a valid map without duplicates! Choosing ' + (
+                f'{layer_index.layers[choices[0]]["layer"]} anyways!' if n == 1 else
+                f'duplicates anyways in {num_duplicates} rotations!'))
+
+        picked_rows = rows[has_available]
+        picked_ids = choices[has_available]
+        chosen[picked_rows, slot_number] = picked_ids
+        used[picked_rows, picked_ids] = True
+
+        # Slide the recent maps window of the rotations that got a layer (each row appears once, so fancy indexing is
+        # safe).
+        ring_positions = num_chosen[picked_rows] % window
+        oldest_maps = recent_ring[picked_rows, ring_positions]
+        had_oldest = oldest_maps >= 0
+        recent_map_counts[picked_rows[had_oldest], oldest_maps[had_oldest]] -= 1
+        new_maps = map_codes[picked_ids]
+        recent_map_counts[picked_rows, new_maps] += 1
+        recent_ring[picked_rows, ring_positions] = new_maps
+        num_chosen[picked_rows] += 1
+
+    return [row[row >= 0].tolist() for row in chosen]
+
+
+def get_map_rotation(
+        rotation_config,
+        all_layers,
+        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP,
+        layer_index=None,
+        solver='greedy',
+        solver_budget_seconds=DEFAULT_SOLVER_BUDGET_SECONDS,
+        solver_max_steps=DEFAULT_SOLVER_MAX_STEPS,
+        engine='python',
+        rng=random,
+        played_layers=None,
+        played_maps=None):
+    """
+    Given all the layers to choose from, return a map rotation according to the global filters and the filters defined
+    in the given config.
+
+    With the default 'greedy' solver, each slot is filled in order and slots without valid layers are skipped (or break
+    the duplicate map rule) with an error. With the 'backtrack' solver, solve_rotation first searches for a complete,
+    valid rotation within the given budget, and the greedy result is returned only if it finds none.
+
+    :param rotation_config: dict or RotationPlan The config that describes how to choose the rotation, or the
+                            RotationPlan compiled from it by compile_config.
+    :param all_layers: list(dict) The list of layers to choose the rotation from.
+    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+    :param layer_index: LayerIndex An optional prebuilt index of all_layers (built from all_layers if not given).
+    :param solver: str One of SOLVERS.
+    :param solver_budget_seconds: float The wall-clock budget for the 'backtrack' solver.
+    :param solver_max_steps: int The step budget for the 'backtrack' solver.
+    :param engine: str One of ENGINES.
+    :param rng: random.Random The random number generator to choose layers with. Defaults to the random module, so
+                random.seed makes rotations reproducible too.
+    :param played_layers: list(str) The names of recently played layers (see get_recently_played). A slot only
+                          chooses one of them if it has no other layers to choose from.
+    :param played_maps: list(str) The most recently played maps (oldest first). The last few count against the
+                        duplicate map rule as if they were played right before the rotation.
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f'Unknown solver {solver}! Expected one of {SOLVERS}.')
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine}! Expected one of {ENGINES}.')
+    if engine == 'numpy' and solver != 'greedy':
+        raise ValueError('The numpy engine only supports the greedy solver!')
+    plan = rotation_config if isinstance(rotation_config, RotationPlan) else compile_config(rotation_config)
+
+    # Index the layers once so every slot's filter is a few set operations.
+    if layer_index is None:
+        layer_index = LayerIndex(all_layers)
+    played_ids = frozenset(layer_index.get_ids(('layer',), played_layers)) if played_layers else frozenset()
+    played_maps = played_maps or ()
+
+    if engine == 'numpy':
+        if _import_numpy() is not None:
+            # Seed NumPy from rng so the rotation is still reproducible.
+            layer_ids, = get_map_rotation_ids_numpy(
+                plan, layer_index, 1, num_min_layers_before_duplicate_map, seed=rng.getrandbits(64),
+                played_ids=played_ids, played_maps=played_maps)
+            return [all_layers[layer_id] for layer_id in layer_ids]
+        logging.warning('NumPy is not installed! Falling back to the python engine.')
+
+    if solver == 'backtrack':
+        layer_ids = solve_rotation(
+            plan, layer_index, num_min_layers_before_duplicate_map, solver_budget_seconds, solver_max_steps, rng,
+            played_ids, played_maps)
+        if layer_ids is not None:
+            return [all_layers[layer_id] for layer_id in layer_ids]
+        record_metric('solver_fallbacks_total', 1)
+        logging.warning('Could not find a complete valid rotation by backtracking! Falling back to the greedy solver.')
+
+    return list(iter_map_rotation(plan, all_layers, num_min_layers_before_duplicate_map, layer_index, rng,
+                                  played_layers, played_maps))
+
+
+def iter_map_rotation(
+        rotation_config,
+        all_layers,
+        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP,
+        layer_index=None,
+        rng=random,
+        played_layers=None,
+        played_maps=None):
+    """
+    Yields the layers of a map rotation one at a time as they are chosen, with the greedy solver of get_map_rotation
+    (see it for the arguments). Only the pool of unused layers and the window of recent maps are kept, never the
+    chosen layers, so memory use doesn't grow with number_of_repeats (e.g. to stream a very long rotation to a file
+    with write_rotation).
+    """
+    plan = rotation_config if isinstance(rotation_config, RotationPlan) else compile_config(rotation_config)
+    if layer_index is None:
+        layer_index = LayerIndex(all_layers)
+    played_ids = frozenset(layer_index.get_ids(('layer',), played_layers)) if played_layers else frozenset()
+
+    # The ids of the layers not chosen yet, so we can sample without replacement (all_layers is never mutated).
+    pool = LayerPool(len(all_layers))
+
+    # The map names of the last few chosen (or played) layers (to avoid duplicate maps that are too close together).
+    recent_maps = RecentMaps(num_min_layers_before_duplicate_map)
+    for map_name in list(played_maps or ())[-recent_maps.size:]:
+        recent_maps.add(map_name)
+
+    # With weights, each filter's layers are drawn from alias tables (see WeightedSampler) instead of uniformly.
+    weights = layer_index.weights(plan.weights)
+    samplers_by_filter = {}
+
+    # Fill up the rotation from the unused layers by applying the starting_maps filters, then the regular_maps filters
+    # number_of_repeats times.
+    for slot_number, slot_filter in enumerate(plan.iter_slots()):
+        candidate_ids = layer_index.candidate_ids(slot_filter)
+        if weights is not None:
+            samplers = samplers_by_filter.get(slot_filter)
+            if samplers is None:
+                # Avoid recently played layers unless every other layer breaks the duplicate map rule.
+                samplers = [WeightedSampler(layer_index.alias_table(slot_filter, plan.weights), weights)]
+                if played_ids:
+                    fresh_table = AliasTable.from_weights(sorted(candidate_ids - played_ids), weights)
+                    samplers.insert(0, WeightedSampler(fresh_table, weights))
+                samplers_by_filter[slot_filter] = samplers
+            if _METRICS_HOOKS:
+                record_metric('slot_candidates', len(pool.available(candidate_ids)), slot=slot_number)
+            chosen_layer = get_weighted_nonduplicate_map(samplers, pool, all_layers, recent_maps, rng)
+        else:
+            filtered_ids = pool.available(candidate_ids)
+            if _METRICS_HOOKS:
+                record_metric('slot_candidates', len(filtered_ids), slot=slot_number)
+            # After we've filtered layers according to the filter config, randomly choose a layer that follows the
+            # global filter rules (the recent maps window stands in for the chosen layers, which aren't kept), avoiding
+            # recently played layers unless every other layer breaks them.
+            is_preferred = (lambda layer: layer_index.id_of(layer) not in played_ids) if played_ids else None
+            chosen_layer = get_nonduplicate_map(
+                [all_layers[layer_id] for layer_id in filtered_ids], (),
+                num_min_layers_before_duplicate_map, recent_maps, rng, is_preferred) if filtered_ids else None
+
+        # If no layers pass the filters, print an error and move on.
+        if chosen_layer is None:
+            record_metric('skipped_slots_total', 1)
+            logging.error(f'No maps to choose from after applying filter {slot_filter.description}! Skipping this '
+                          'filter!')
+            continue
+        recent_maps.add(chosen_layer['map'])
+        # Remove it from the pool since we used it (using without replacement policy).
+        pool.remove(layer_index.id_of(chosen_layer))
+        yield chosen_layer
+
+
+def reroll_rotation(
+        map_rotation,
+        positions,
+        rotation_config,
+        all_layers,
+        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP,
+        layer_index=None,
+        rng=random):
+    """
+    Returns a copy of the given map rotation with the layers at the given positions chosen again, keeping every other
+    layer where it is. Each new layer passes the filter of its slot in the given config, is not used anywhere else in
+    the rotation (and is not the layer it replaces), and doesn't share its map with the layers within the duplicate map
+    distance on either side. Only those neighbors and the set of used layers are checked (instead of generating the
+    whole rotation again), so re-rolling is quick however long the rotation is. If no layer follows the rules, one
+    that breaks the duplicate map rule is chosen with an error, and if no layer is left at all, the old layer is kept
+    with an error.
+
+    :param map_rotation: list(dict) The rotation to re-roll (as layers from all_layers, e.g. from read_rotation), with
+                         one layer for each slot of the config.
+    :param positions: list(int) The positions (from 0) of the layers to re-roll.
+    :param rotation_config: dict or RotationPlan The config the rotation was generated from.
+    :param all_layers: list(dict) The list of layers to choose from.
+    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+    :param layer_index: LayerIndex An optional prebuilt index of all_layers (built from all_layers if not given).
+    :param rng: random.Random The random number generator to choose layers with (the random module by default).
+    :return: list(dict) The re-rolled rotation.
+    :raises ValueError: If the rotation doesn't have one layer per slot of the config, or a position is out of range.
+    """
+    plan = rotation_config if isinstance(rotation_config, RotationPlan) else compile_config(rotation_config)
+    slots = plan.slots()
+    if len(map_rotation) != len(slots):
+        raise ValueError(f'The rotation has {len(map_rotation)} layers but the config has {len(slots)} slots, so the '
+                         'slots of its layers are unknown!')
+    if layer_index is None:
+        layer_index = LayerIndex(all_layers)
+    weights = layer_index.weights(plan.weights)
+    window = max(1, num_min_layers_before_duplicate_map)
+    rotation = list(map_rotation)
+    # The re-rolled layers stay used so they are not chosen again.
+    used_ids = {layer_index.id_of(layer) for layer in rotation}
 
+    for position in sorted(set(positions)):
+        if not 0 <= position < len(rotation):
+            raise ValueError(f'Position {position} (from 0) is out of range for a rotation of {len(rotation)} layers!')
+        slot_filter = slots[position]
+        nearby_maps = {layer['map'] for layer in rotation[max(0, position - window):position] +
+                       rotation[position + 1:position + window + 1]}
+        candidate_ids = [layer_id for layer_id in sorted(layer_index.candidate_ids(slot_filter))
+                         if layer_id not in used_ids]
+        valid_ids = [layer_id for layer_id in candidate_ids if all_layers[layer_id]['map'] not in nearby_maps]
+        if not candidate_ids:
+            record_metric('skipped_slots_total', 1)
+            logging.error(f'No maps to choose from after applying filter {slot_filter.description}! Keeping '
+                          f'{rotation[position]["layer"]}!')
+            continue
+        choice_ids = valid_ids or candidate_ids
+        if weights is None:
+            layer_id = rng.choice(choice_ids)
+        else:
+            layer_id = rng.choices(choice_ids, weights=[weights[choice_id] for choice_id in choice_ids])[0]
+        if not valid_ids:
+            record_metric('duplicate_map_violations_total', 1)
+            logging.error(f'Could not get a valid map without duplicates! Choosing {all_layers[layer_id]["layer"]} '
+                          'anyways!')
+        rotation[position] = all_layers[layer_id]
+        used_ids.add(layer_id)
+    return rotation
 
-class InvalidConfigException(Exception):
-    """ Exception raised when a config is invalid. """
-    pass
 
+def _init_rotation_worker(plans, all_layers, rotation_kwargs):
+    """ Initializes a rotation worker process with the shared layers, their index and the compiled configs. """
+    _WORKER_STATE['plans'] = plans
+    _WORKER_STATE['layers'] = all_layers
+    _WORKER_STATE['layer_index'] = LayerIndex(all_layers)
+    _WORKER_STATE['rotation_kwargs'] = rotation_kwargs
 
-def parse_cli():
-    """ Parses sys.argv (commandline args) and returns a parser with the arguments. """
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-o', '--output-filepath', default=DEFAULT_MAP_ROTATION_FILEPATH, type=pathlib.Path,
-                        help=f'Filepath to write out map rotation to. Defaults to {DEFAULT_MAP_ROTATION_FILEPATH}')
-    parser.add_argument('-c', '--config-filepath', default=DEFAULT_CONFIG_FILEPATH, type=pathlib.Path,
-                        help=f'Filepath to read rotation config from. Defaults to {DEFAULT_CONFIG_FILEPATH}.')
-    parser.add_argument('--discord-webhook-url', required=False,
-                        help=('The URL to the Discord webhook if you want to post the latest rotation to a Discord'
-                              ' channel.'))
-    # Expect either an input filepath or URL.
-    input_group = parser.add_mutually_exclusive_group()
-    input_group.add_argument(
-        '--input-filepath', help='Filepath of JSON file to use for map layers.')
-    input_group.add_argument('--input-url', default=DEFAULT_LAYERS_URL,
-                             help=(f'URL to JSON file to use for map layers. Defaults to {DEFAULT_LAYERS_URL} if'
-                                   ' --input-filepath is not provided.'))
-    return parser.parse_args()
+
+def _generate_rotation_ids(task):
+    """
+    Returns the layer ids of one rotation generated from the worker's shared state, for the given task: a tuple of the
+    position of the compiled config in the worker's plans, the rotation's seed, and any keyword arguments to
+    get_map_rotation for this rotation only (e.g. its server's play history).
+    """
+    plan_number, rotation_seed, task_kwargs = task
+    layer_index = _WORKER_STATE['layer_index']
+    # The rotation only depends on its seed (and the global random state is left alone).
+    rotation = get_map_rotation(_WORKER_STATE['plans'][plan_number], _WORKER_STATE['layers'], layer_index=layer_index,
+                                rng=random.Random(rotation_seed), **{**_WORKER_STATE['rotation_kwargs'], **task_kwargs})
+    return [layer_index.id_of(layer) for layer in rotation]
 
 
-def get_json_layers(input_filepath, input_url):
+def _iter_rotation_tasks(plans, layers, tasks, workers, rotation_kwargs, task_function=_generate_rotation_ids):
     """
-    Return the JSON object represented by the given filepath or URL (in the args) as a list of dicts. See
-    https://github.com/bsubei/squad_map_layers for an example layers JSON file.
+    Runs the given rotation tasks with the given task function (_generate_rotation_ids by default) across a pool of
+    worker processes that share the given compiled configs and layers, and yields each task's result in order as soon
+    as it is ready (so the results don't all have to be kept in memory).
     """
-    # Parse the filepath as JSON if it's provided.
-    if input_filepath:
-        # Just read the JSON file from a filepath and
-        with open(input_filepath, 'rb') as f:
-            all_layers = json.load(f)
-    # Otherwise, fetch the JSON file from the URL and parse it into a list of dicts.
-    elif input_url:
-        text = request.urlopen(input_url).read().decode('utf-8')
-        all_layers = json.loads(text)
-    else:
-        raise ValueError('Sanity check failed! No input args provided!')
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        _init_rotation_worker(plans, layers, rotation_kwargs)
+        try:
+            for task in tasks:
+                yield task_function(task)
+        finally:
+            _WORKER_STATE.clear()
+        return
 
-    # Filter out all the bugged layers and return that.
-    return list(filter(lambda m: not m['bugged'], all_layers))
+    import concurrent.futures
 
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_rotation_worker,
+            initargs=(plans, layers, rotation_kwargs)) as executor:
+        # Send the tasks in chunks so each worker gets a few batches of work.
+        chunksize = max(1, len(tasks) // (workers * 4))
+        yield from executor.map(task_function, tasks, chunksize=chunksize)
 
-def get_random_skirmish_layer(input_filepath, input_url):
-    """ Return one random skirmish layer as a string from either the given filepath or URL to the JSON layers file. """
-    layers = get_json_layers(input_filepath, input_url)
-    remaining_skirmish_layers = list(
-        filter(lambda m: m['gamemode'] == 'Skirmish', layers))
-    return get_layers([random.choice(remaining_skirmish_layers)])[0]
+
+def _run_rotation_tasks(plans, layers, tasks, workers, rotation_kwargs):
+    """
+    Runs the given rotation tasks (see _generate_rotation_ids) across a pool of worker processes that share the given
+    compiled configs and layers, and returns the layer ids of each task's rotation in order.
+    """
+    return list(_iter_rotation_tasks(plans, layers, tasks, workers, rotation_kwargs))
 
 
-def get_nonduplicate_map(available_layers, chosen_rotation, min_layers_before_duplicate_map):
+def generate_rotations(config, layers, n, seed=None, workers=None, **rotation_kwargs):
     """
-    Given the available layers to choose from, the current chosen_rotation, and the number of layers to check behind
-    for a duplicate map, randomly chooses and returns a layer that follows the global filter rules (see README.md).
+    Returns n independent map rotations for the given config, generated across a pool of worker processes. The layers
+    and the compiled config are sent to each worker once, and each rotation gets its own seed derived from the given
+    seed, so the same seed gives the same rotations regardless of the number of workers. With engine='numpy' (and
+    NumPy installed), the rotations are instead generated in vectorized chunks in this process.
 
-    :param available_layers:  A list of available layers to choose from (as dicts derived from the JSON object).
-    :param chosen_rotation:  The list of currently chosen layers.
-    :param min_layers_before_duplicate_map:  The number of maps before a duplicate map is allowed.
-    :return: A randomly chosen layer that follows the global filter rules.
+    :param config: dict or RotationPlan The config that describes how to choose the rotations.
+    :param layers: list(dict) The list of layers to choose the rotations from.
+    :param n: int The number of rotations to generate.
+    :param seed: int The seed to derive the rotation seeds from. Random if not given.
+    :param workers: int The number of worker processes. Defaults to the number of CPUs. Uses no extra processes if 1.
+    :param rotation_kwargs: Any other keyword arguments to pass to get_map_rotation (e.g. solver).
+    :return: list(list(dict)) The generated rotations (as lists of layer dicts from the given layers).
     """
-    # Clamp min_layers_before_duplicate map so it doesn't go out of bounds.
-    min_layers_before_duplicate_map = max(
-        1, min(len(chosen_rotation), min_layers_before_duplicate_map))
-
-    # Attempt to get a valid layer that doesn't break the global duplicate rules (don't duplicate same exact layer, and
-    # layers with the same map must not be consecutive). If we can't, print an error and return the best choice we can.
-    layers_to_avoid_duplicating = chosen_rotation[-min_layers_before_duplicate_map:]
-    for _ in range(100):
-        candidate_layer = random.choice(available_layers)
-        if candidate_layer['map'] not in [layer['map'] for layer in layers_to_avoid_duplicating]:
-            # If the layers follows the rules, add it to the chosen rotation.
-            return candidate_layer
+    plan = config if isinstance(config, RotationPlan) else compile_config(config)
+    seed_generator = random.Random(seed)
+    if rotation_kwargs.get('engine') == 'numpy' and _import_numpy() is None:
+        # Warn once here instead of once per rotation in get_map_rotation.
+        logging.warning('NumPy is not installed! Falling back to the python engine.')
+        rotation_kwargs = dict(rotation_kwargs, engine='python')
+
+    if rotation_kwargs.get('engine') == 'numpy':
+        if rotation_kwargs.get('solver', 'greedy') != 'greedy':
+            raise ValueError('The numpy engine only supports the greedy solver!')
+        layer_index = LayerIndex(layers)
+        num_min_layers_before_duplicate_map = rotation_kwargs.get(
+            'num_min_layers_before_duplicate_map', NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+        played_layers = rotation_kwargs.get('played_layers')
+        played_ids = frozenset(layer_index.get_ids(('layer',), played_layers)) if played_layers else frozenset()
+        all_layer_ids = []
+        chunk_size = get_numpy_chunk_size(len(layer_index))
+        for chunk_start in range(0, n, chunk_size):
+            all_layer_ids.extend(get_map_rotation_ids_numpy(
+                plan, layer_index, min(chunk_size, n - chunk_start), num_min_layers_before_duplicate_map,
+                seed=seed_generator.getrandbits(64), played_ids=played_ids,
+                played_maps=rotation_kwargs.get('played_maps') or ()))
+        return [[layers[layer_id] for layer_id in layer_ids] for layer_ids in all_layer_ids]
+
+    tasks = [(0, seed_generator.getrandbits(64), {}) for _ in range(n)]
+    all_layer_ids = _run_rotation_tasks((plan,), layers, tasks, workers, rotation_kwargs)
+    return [[layers[layer_id] for layer_id in layer_ids] for layer_ids in all_layer_ids]
+
+
+class RotationStats:
+    """
+    Streaming statistics over many rotations of one config: how often each layer was chosen at each position, and how
+    often rotations skipped slots or duplicated maps too close together. Rotations are added as they are generated and
+    never kept, and the statistics of several workers can be merged, so memory does not grow with the number of
+    rotations. The layer, map, team and gamemode frequencies are all derived from the per-position layer counts.
+    """
+
+    def __init__(self, num_layers, num_slots, num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP):
+        """
+        :param num_layers: int The number of layers the rotations choose from.
+        :param num_slots: int The number of slots of the config (so the number of skipped slots can be counted).
+        :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+        """
+        self.num_layers = num_layers
+        self.num_slots = num_slots
+        self.window = max(1, num_min_layers_before_duplicate_map)
+        self.num_rotations = 0
+        self.num_complete_rotations = 0
+        self.skipped_slots = 0
+        self.duplicate_map_violations = 0
+        # Counts (position * num_layers + layer id), which is much cheaper to update than a counter per position.
+        self.position_layer_counts = collections.Counter()
+
+    def add(self, layer_ids, map_of):
+        """
+        Adds one rotation to the statistics.
+
+        :param layer_ids: list(int) The ids of the layers of the rotation, in order.
+        :param map_of: list(str) The map of each layer, indexed by layer id.
+        """
+        self.num_rotations += 1
+        num_skipped = self.num_slots - len(layer_ids)
+        self.skipped_slots += num_skipped
+        if not num_skipped:
+            self.num_complete_rotations += 1
+        self.position_layer_counts.update(
+            position * self.num_layers + layer_id for position, layer_id in enumerate(layer_ids))
+        maps = [map_of[layer_id] for layer_id in layer_ids]
+        self.duplicate_map_violations += sum(
+            1 for position, map_name in enumerate(maps) if map_name in maps[max(0, position - self.window):position])
+
+    def merge(self, other):
+        """ Adds the statistics of another RotationStats (of the same config and layers) to these. """
+        self.num_rotations += other.num_rotations
+        self.num_complete_rotations += other.num_complete_rotations
+        self.skipped_slots += other.skipped_slots
+        self.duplicate_map_violations += other.duplicate_map_violations
+        self.position_layer_counts.update(other.position_layer_counts)
+
+    def get_report(self, layers):
+        """
+        Returns a summary report (a JSON-serializable dict) of the statistics: the number of rotations (and complete
+        ones), the skipped slots and duplicate map violations, the number of times each layer, map, team and gamemode
+        was chosen (most common first), and the maps and gamemodes chosen at each position.
+
+        :param layers: list(dict) The layers the rotations were chosen from.
+        """
+        totals = {field: collections.Counter() for field in ('layer', 'map', 'team', 'gamemode')}
+        positions = []
+        for key, count in self.position_layer_counts.items():
+            position, layer_id = divmod(key, self.num_layers)
+            layer = layers[layer_id]
+            while len(positions) <= position:
+                positions.append({'map': collections.Counter(), 'gamemode': collections.Counter()})
+            totals['layer'][layer['layer']] += count
+            for field in ('map', 'gamemode'):
+                totals[field][layer.get(field)] += count
+                positions[position][field][layer.get(field)] += count
+            for team_field in LayerIndex.TEAM_FIELDS:
+                if layer.get(team_field) is not None:
+                    totals['team'][layer[team_field]] += count
+        return {
+            'rotations': self.num_rotations,
+            'complete_rotations': self.num_complete_rotations,
+            'skipped_slots': self.skipped_slots,
+            'duplicate_map_violations': self.duplicate_map_violations,
+            **{f'{field}s': dict(counts.most_common()) for field, counts in totals.items()},
+            'positions': [{f'{field}s': dict(counts.most_common()) for field, counts in position_counts.items()}
+                          for position_counts in positions],
+        }
+
+
+def _analyze_rotation_batch(task):
+    """
+    Returns the RotationStats of a batch of rotations generated from the worker's shared state, for the given task: a
+    tuple of the position of the compiled config in the worker's plans, the batch's seed, and the number of rotations.
+    """
+    plan_number, batch_seed, num_rotations = task
+    plan = _WORKER_STATE['plans'][plan_number]
+    layer_index = _WORKER_STATE['layer_index']
+    rotation_kwargs = _WORKER_STATE['rotation_kwargs']
+    num_min_layers_before_duplicate_map = rotation_kwargs.get(
+        'num_min_layers_before_duplicate_map', NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+    stats = RotationStats(len(layer_index), len(plan.slots()), num_min_layers_before_duplicate_map)
+    map_of = [layer['map'] for layer in layer_index.layers]
+    rng = random.Random(batch_seed)
+
+    # Broken rules are counted in the statistics instead of logged for every rotation (keeping any higher level the
+    # caller disabled).
+    disabled_level = logging.root.manager.disable
+    logging.disable(max(disabled_level, logging.ERROR))
+    try:
+        if rotation_kwargs.get('engine') == 'numpy' and _import_numpy() is not None:
+            chunk_size = get_numpy_chunk_size(len(layer_index))
+            for chunk_start in range(0, num_rotations, chunk_size):
+                for layer_ids in get_map_rotation_ids_numpy(
+                        plan, layer_index, min(chunk_size, num_rotations - chunk_start),
+                        num_min_layers_before_duplicate_map, seed=rng.getrandbits(64)):
+                    stats.add(layer_ids, map_of)
         else:
-            # Otherwise, try again.
-            previous_layers_string = ', '.join(
-                [layer['layer'] for layer in layers_to_avoid_duplicating])
-            logging.debug('Discarding chosen layer {} because it has the same map as the previous layers {}.'.format(
-                candidate_layer['layer'], previous_layers_string))
+            for _ in range(num_rotations):
+                rotation = get_map_rotation(plan, layer_index.layers, layer_index=layer_index, rng=rng,
+                                            **rotation_kwargs)
+                stats.add([layer_index.id_of(layer) for layer in rotation], map_of)
+    finally:
+        logging.disable(disabled_level)
+    return stats
 
-    # If we still can't find a valid layer, return the best we can after printing an error.
-    logging.error(f'Could not get a valid map without duplicates! Choosing {candidate_layer["layer"]} anyways!')
-    return candidate_layer
 
+def analyze_fairness(config, layers, n, seed=None, workers=None, batch_size=FAIRNESS_BATCH_SIZE, **rotation_kwargs):
+    """
+    Generates n rotations for the given config across a pool of worker processes and returns a summary report of how
+    often each layer, map, team and gamemode was chosen (overall and per position), and how often rotations skipped
+    slots or duplicated maps (see RotationStats.get_report). Each worker aggregates its own batches of rotations, so
+    only the statistics are sent back and no rotation is kept. The same seed gives the same report regardless of the
+    number of workers.
 
-def get_map_rotation(
-        rotation_config,
-        all_layers,
-        num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP):
+    :param config: dict or RotationPlan The config that describes how to choose the rotations.
+    :param layers: list(dict) The list of layers to choose the rotations from.
+    :param n: int The number of rotations to generate.
+    :param seed: int The seed to derive the seed of each batch of rotations from. Random if not given.
+    :param workers: int The number of worker processes. Defaults to the number of CPUs. Uses no extra processes if 1.
+    :param batch_size: int The number of rotations each task generates.
+    :param rotation_kwargs: Any other keyword arguments to pass to get_map_rotation (e.g. solver or engine).
+    :return: dict The summary report.
     """
-    Given all the layers to choose from, return a map rotation according to the global filters and the filters defined
-    in the given config.
+    plan = config if isinstance(config, RotationPlan) else compile_config(config)
+    seed_generator = random.Random(seed)
+    if rotation_kwargs.get('engine') == 'numpy' and _import_numpy() is None:
+        # The workers don't log warnings, so warn here (once).
+        logging.warning('NumPy is not installed! Falling back to the python engine.')
+        rotation_kwargs = dict(rotation_kwargs, engine='python')
+    tasks = [(0, seed_generator.getrandbits(64), min(batch_size, n - batch_start))
+             for batch_start in range(0, n, batch_size)]
+    stats = RotationStats(len(layers), len(plan.slots()), rotation_kwargs.get(
+        'num_min_layers_before_duplicate_map', NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP))
+    for batch_stats in _iter_rotation_tasks((plan,), layers, tasks, workers, rotation_kwargs, _analyze_rotation_batch):
+        stats.merge(batch_stats)
+    return stats.get_report(layers)
 
-    :param rotation_config: dict The config that describes how to choose the rotation.
-    :param all_layers: list(dict) The list of layers to choose the rotation from.
-    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+
+def get_rotation_cache_key(config, layer_index, seed, **rotation_kwargs):
+    """
+    Returns the key (str) of a rotation in the rotation cache (see get_cached_map_rotation): a hash of the seed, the
+    config's hash, the layers' hash and the keyword arguments to get_map_rotation.
     """
+    key = json.dumps([seed, get_config_hash(config), layer_index.layers_hash, rotation_kwargs], sort_keys=True,
+                     default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
-    def upgrade_to_list(value):
-        return value if isinstance(value, list) else [value]
-
-    def apply_filter_config(remaining_layers, filter_config):
-        """ From the remaining_layers, filter using the config and return the filtered layers.  """
-        # Use filtered_layers as the result of filtering remaining_layers based on the config.
-        filtered_layers = remaining_layers
-
-        # NOTE(bsubei): multiple filter keys apply an "AND" operation. However, multiple values in one filter key apply
-        # an "OR" operation.
-        # e.g. given filter 1 is {'gamemode': ['AAS', 'RAAS']} and filter 2 is {'map_size': 'small'}, then the chosen
-        # layer will be either AAS **or** RAAS **and** either way must be a small size map.
-
-        # Skips filters if the special 'any' keyword is used.
-        should_skip_filter = isinstance(
-            filter_config, str) and filter_config.casefold() == 'any'
-        if not should_skip_filter:
-            for key, value in filter_config.items():
-                # We upgrade key and value to lists if they weren't already so we can use "in" instead of "==".
-                value = upgrade_to_list(value)
-                key = upgrade_to_list(key)
-                # The 'team' key is special and counts as either 'team1' or 'team2'.
-                if 'team' in key:
-                    key = ['team1', 'team2']
-                # Apply the current filter again and again until filtered_layers passes all the filters "AND"ed
-                # together.
-                filtered_layers = [
-                    layer for layer in filtered_layers for k in key if layer.get(k) in value]
-        return filtered_layers
-
-    def populate_chosen_rotation(chosen_rotation, remaining_layers, maps_config):
-        """
-        Populate the given chosen_rotation list from remaining_layers (using sample without replacement) by applying the
-        maps_config filters.
-        NOTE: this mutates both chosen_rotation and remaining_layers as they are passed by reference.
-        """
-        for idx, filter_config in enumerate(maps_config):
-            filtered_layers = apply_filter_config(
-                remaining_layers, filter_config)
-            # If no layers pass the filters, print an error and move on.
-            if not filtered_layers:
-                logging.error(f'No maps to choose from after applying filter {filter_config}! Skipping this filter!')
-                continue
 
-            # After we've filtered layers according to the filter config, randomly choose a layer that follows the
-            # global filter rules.
-            chosen_layer = get_nonduplicate_map(
-                filtered_layers, chosen_rotation, num_min_layers_before_duplicate_map)
-            chosen_rotation.append(chosen_layer)
-            # Remove it from the pool since we used it (using without replacement policy).
-            remaining_layers.remove(chosen_layer)
+def get_cached_map_rotation(config, layer_index, seed, cache_dir, max_entries=MAX_CACHED_ROTATIONS,
+                            **rotation_kwargs):
+    """
+    Returns the map rotation that get_map_rotation generates for the given config and layers with the given seed, from
+    an on-disk cache of rotations keyed by the seed, config and layers (see get_rotation_cache_key). On a miss, the
+    rotation is generated and cached, and the least recently used rotations are evicted so at most max_entries stay
+    cached. Caching is disabled if cache_dir is None.
+
+    :param config: dict The config that describes how to choose the rotation (e.g. the output of parse_config).
+    :param layer_index: LayerIndex The index of the layers to choose the rotation from.
+    :param seed: int The seed for the random.Random that chooses the layers.
+    :param cache_dir: pathlib.Path The directory to cache rotations in (in its 'rotations' subdirectory).
+    :param max_entries: int The maximum number of rotations to keep cached.
+    :param rotation_kwargs: Any other keyword arguments to pass to get_map_rotation (e.g. solver).
+    """
+    def generate():
+        return get_map_rotation(config, layer_index.layers, layer_index=layer_index, rng=random.Random(seed),
+                                **rotation_kwargs)
+
+    if cache_dir is None:
+        return generate()
+    rotations_dir = pathlib.Path(cache_dir) / 'rotations'
+    cache_path = rotations_dir / f'{get_rotation_cache_key(config, layer_index, seed, **rotation_kwargs)}.json'
+
+    # Cached rotations are stored as the ids of their layers.
+    try:
+        with open(cache_path, 'r') as f:
+            rotation = [layer_index.layers[layer_id] for layer_id in json.load(f)]
+    except (OSError, ValueError, TypeError, IndexError):
+        rotation = None
+    if rotation is not None:
+        record_metric('rotation_cache_hits_total', 1)
+        # Mark the rotation as recently used.
+        with contextlib.suppress(OSError):
+            os.utime(cache_path)
+        return rotation
+
+    rotation = generate()
+    try:
+        rotations_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump([layer_index.id_of(layer) for layer in rotation], f)
+        os.replace(temp_path, cache_path)
+        # Evict the least recently used rotations.
+        cached_paths = sorted(rotations_dir.glob('*.json'), key=lambda path: path.stat().st_mtime_ns)
+        for cached_path in cached_paths[:-max_entries]:
+            with contextlib.suppress(FileNotFoundError):
+                cached_path.unlink()
+    except OSError as e:
+        logging.warning(f'Could not cache the rotation in {rotations_dir}: {e}')
+    return rotation
+
+
+def _as_utc(timestamp):
+    """ Returns the given datetime, taking naive datetimes (without a timezone) to be in UTC. """
+    return timestamp.replace(tzinfo=datetime.timezone.utc) if timestamp.tzinfo is None else timestamp
+
+
+def append_play_history(history_path, map_rotation, server=None, seed=None, played_at=None):
+    """
+    Appends the given map rotation to the play history file at history_path (created if missing). The history file is
+    append-only, with one JSON line per rotation in the order they were played, so read_play_history can read the most
+    recent rotations from the end of the file without reading the rest.
+
+    :param history_path: str The path to the play history file.
+    :param map_rotation: list(dict) The rotation that was written out.
+    :param server: str The name of the server the rotation is for (None for a single server).
+    :param seed: int The seed the rotation was generated with (if any).
+    :param played_at: datetime.datetime When the rotation was written out (in UTC if naive). Defaults to now.
+    """
+    played_at = _as_utc(played_at) if played_at else datetime.datetime.now(datetime.timezone.utc)
+    entry = {'played_at': played_at.isoformat(timespec='seconds'), 'server': server, 'seed': seed,
+             'layers': get_layers(map_rotation), 'maps': [layer['map'] for layer in map_rotation]}
+    # Write the whole line at once so concurrent writers don't interleave their lines.
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(entry, separators=(',', ':')) + '\n')
 
-    # Make a copy of the layers so we can sample from it without replacement.
-    remaining_layers = copy.deepcopy(all_layers)
 
-    # The chosen rotation will be stored here (as a list of layer dicts).
-    chosen_rotation = []
+def read_play_history(history_path, days, server=None, now=None):
+    """
+    Returns the rotations (as dicts, oldest first) played in the last given number of days from the play history file
+    at history_path (see append_play_history). The file is memory-mapped and read backwards from its end, stopping at
+    the first rotation older than that, so only the recent rotations are read no matter how long the history is.
+
+    :param history_path: str The path to the play history file. A missing file is an empty history.
+    :param days: float The number of days to look back.
+    :param server: str Only return the rotations of this server (all servers if None).
+    :param now: datetime.datetime The time to look back from (in UTC if naive). Defaults to now.
+    """
+    cutoff = (_as_utc(now) if now else datetime.datetime.now(datetime.timezone.utc)) - datetime.timedelta(days=days)
+    entries = []
+    try:
+        with open(history_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            end = len(mapped)
+            while end > 0:
+                # Find the start of the last line before end (skipping its trailing newline).
+                start = mapped.rfind(b'\n', 0, end - 1) + 1
+                line, end = mapped[start:end], start
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    # Timestamps without a timezone (e.g. from hand-edited histories) are in UTC.
+                    played_at = _as_utc(datetime.datetime.fromisoformat(entry['played_at']))
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f'Skipping invalid line in the play history {history_path}: {line!r}')
+                    continue
+                if played_at < cutoff:
+                    break
+                if server is None or entry.get('server') == server:
+                    entries.append(entry)
+    except FileNotFoundError:
+        return []
+    except ValueError:
+        # An empty file can't be memory-mapped.
+        return []
+    entries.reverse()
+    return entries
 
-    # Get the config section for starting_maps.
-    starting_maps_config = rotation_config.get('starting_maps', [])
 
-    # Fill up the chosen_rotation from remaining_layers by applying starting_maps_config.
-    # NOTE(bsubei): both chosen_rotation and remaining_layers are passed by reference and mutated in the function.
-    populate_chosen_rotation(
-        chosen_rotation, remaining_layers, starting_maps_config)
+def get_recently_played(history_path, days, server=None, seed=None):
+    """
+    Returns the keyword arguments for get_map_rotation that avoid the layers and maps played in the last given number
+    of days (see read_play_history): 'played_layers' (sorted list of layer names) and 'played_maps' (list of the maps
+    played, oldest first). Rotations generated with the given seed are ignored, so generating a seeded rotation again
+    gives the same rotation even after it was added to the history.
+    """
+    entries = [entry for entry in read_play_history(history_path, days, server)
+               if seed is None or entry.get('seed') != seed]
+    return {
+        'played_layers': sorted({layer for entry in entries for layer in entry.get('layers', [])}),
+        'played_maps': [map_name for entry in entries for map_name in entry.get('maps', [])],
+    }
 
-    # Now do it again number_of_repeats times for regular_maps_config.
-    number_of_repeats = rotation_config.get('number_of_repeats', 1)
-    regular_maps_config = rotation_config.get('regular_maps')
-    for _ in range(number_of_repeats):
-        populate_chosen_rotation(
-            chosen_rotation, remaining_layers, regular_maps_config)
 
-    return chosen_rotation
+def get_numbered_filepath(filepath, number, total):
+    """ Returns the given filepath with the given number (zero-padded to fit total) appended to its name. """
+    filepath = pathlib.Path(filepath)
+    return filepath.with_name(f'{filepath.stem}_{number:0{len(str(total))}d}{filepath.suffix}')
 
 
 def get_layers_string(map_rotation):
@@ -237,33 +2182,203 @@ def get_layers(map_rotation):
 
 
 def write_rotation(map_rotation, output_filepath):
-    """ Writes out given map rotation (list of dicts) to the given output filepath as a map rotation. """
-    with open(output_filepath, 'w') as f:
-        f.write(get_layers_string(map_rotation))
+    """
+    Writes out the given map rotation (an iterable of layer dicts, e.g. a list or iter_map_rotation) to the given output
+    filepath as a map rotation. The layers are streamed to a temporary file as they come, which then atomically
+    replaces the output file, so the game server never reads a half-written rotation (and a failed rotation leaves the
+    old one in place).
+    """
+    output_filepath = pathlib.Path(output_filepath)
+    temp_path = output_filepath.with_name(f'{output_filepath.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_path, 'w') as f:
+            for number, layer in enumerate(map_rotation):
+                # Layers are separated by newlines (without one at the end, like get_layers_string).
+                f.write(f'\n{layer["layer"]}' if number else layer['layer'])
+        os.replace(temp_path, output_filepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def read_rotation(rotation_filepath, layer_index):
+    """
+    Reads a map rotation file (e.g. one written by write_rotation) and returns its layers, as layers from the given
+    LayerIndex. Blank lines and comment lines (starting with //) are ignored.
+
+    :param rotation_filepath: str The path to the map rotation file.
+    :param layer_index: LayerIndex The index of the layers the rotation was chosen from.
+    :raises ValueError: If the rotation has a layer that is not in the index (e.g. a bugged or removed layer).
+    """
+    map_rotation = []
+    with open(rotation_filepath, 'r') as f:
+        for line in f:
+            layer_name = line.strip()
+            if not layer_name or layer_name.startswith('//'):
+                continue
+            layer_ids = layer_index.get_ids(('layer',), [layer_name])
+            if not layer_ids:
+                raise ValueError(f'Unknown layer {layer_name} in {rotation_filepath}!')
+            map_rotation.append(layer_index.layers[min(layer_ids)])
+    return map_rotation
+
+
+class DiscordOutcome(collections.namedtuple('DiscordOutcome', ['url', 'ok', 'messages_sent', 'attempts', 'error'])):
+    """
+    The outcome of posting a rotation to one Discord webhook: whether every message was posted, how many were, the
+    number of HTTP requests made (including retries), and the error that made it give up (or None).
+    """
+    __slots__ = ()
+
+
+def get_discord_messages(map_rotation, max_length=DISCORD_MESSAGE_MAX_LENGTH):
+    """
+    Returns the Discord messages (list of str) announcing the given map rotation. Rotations too long for one message
+    are split between layers into several messages, each at most max_length characters long.
+    """
+    header = f'The map rotation for {datetime.date.today()} is:\n'
+    messages = []
+    lines = []
+    length = len(header)
+    for layer in get_layers(map_rotation):
+        # Every message wraps its layers in a code block (6 characters), and each layer after the first adds a newline.
+        if lines and length + len(lines) + len(layer) + 6 > max_length:
+            messages.append(header + '```' + '\n'.join(lines) + '```')
+            header, lines, length = '', [], 0
+        lines.append(layer)
+        length += len(layer)
+    messages.append(header + '```' + '\n'.join(lines) + '```')
+    return messages
+
+
+def get_redacted_webhook_url(discord_webhook_url):
+    """ Returns the given webhook URL without its token, so it can be logged. """
+    return discord_webhook_url.rsplit('/', 1)[0] + '/...'
+
+
+def post_to_discord_webhook(discord_webhook_url, messages, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS,
+                            max_retries=DISCORD_MAX_RETRIES, max_retry_wait=DISCORD_MAX_RETRY_WAIT_SECONDS):
+    """
+    Posts the given messages in order to the given Discord webhook and returns a DiscordOutcome. When rate limited
+    (HTTP 429), waits for the 'retry_after' seconds Discord asks for before retrying. Server and network errors are
+    retried with exponential backoff. Gives up after max_retries retries of one message, or if Discord asks to wait
+    longer than max_retry_wait seconds. Never raises.
+    """
+    from urllib import error, request
+
+    attempts = 0
+    for messages_sent, message in enumerate(messages):
+        payload = json.dumps({'content': message}).encode('utf-8')
+        for retry in range(max_retries + 1):
+            attempts += 1
+            post = request.Request(discord_webhook_url, data=payload, method='POST',
+                                   headers={'Content-Type': 'application/json', 'User-Agent': DISCORD_USER_AGENT})
+            try:
+                with request.urlopen(post, timeout=timeout):
+                    break
+            except error.HTTPError as e:
+                if e.code == 429:
+                    try:
+                        wait = float(json.loads(e.read())['retry_after'])
+                    except (ValueError, KeyError, TypeError):
+                        wait = float(e.headers.get('Retry-After') or DISCORD_RETRY_BACKOFF_SECONDS)
+                elif e.code >= 500:
+                    wait = DISCORD_RETRY_BACKOFF_SECONDS * 2 ** retry
+                else:
+                    return DiscordOutcome(discord_webhook_url, False, messages_sent, attempts, e)
+                last_error = e
+            except (error.URLError, OSError) as e:
+                wait = DISCORD_RETRY_BACKOFF_SECONDS * 2 ** retry
+                last_error = e
+            if retry == max_retries or wait > max_retry_wait:
+                return DiscordOutcome(discord_webhook_url, False, messages_sent, attempts, last_error)
+            record_metric('discord_retries_total', 1)
+            time.sleep(wait)
+    return DiscordOutcome(discord_webhook_url, True, len(messages), attempts, None)
+
+
+class DiscordPoster:
+    """
+    Posts rotations to Discord webhooks in the background, so writing rotations never waits on Discord. Posts to at
+    most max_workers webhooks at once (the messages to one webhook are posted in order). Failed posts are logged as
+    errors. Use as a context manager, or call close, to wait for every post before exiting.
+    """
 
+    def __init__(self, max_workers=DISCORD_MAX_CONCURRENCY, **post_kwargs):
+        """
+        :param max_workers: int The maximum number of webhooks to post to at once.
+        :param post_kwargs: Any other keyword arguments to pass to post_to_discord_webhook (e.g. timeout).
+        """
+        import concurrent.futures
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='discord')
+        self._post_kwargs = post_kwargs
+        # The futures of the posts that have not finished yet.
+        self._pending = set()
+
+    def post(self, map_rotation, discord_webhook_urls):
+        """
+        Starts posting the given map rotation to the given webhook URL(s) (str, list(str) or None) and returns the
+        futures of their DiscordOutcomes.
+        """
+        if isinstance(discord_webhook_urls, str):
+            discord_webhook_urls = [discord_webhook_urls]
+        messages = get_discord_messages(map_rotation)
+        futures = [self._executor.submit(post_to_discord_webhook, url, messages, **self._post_kwargs)
+                   for url in discord_webhook_urls or []]
+        for future in futures:
+            self._pending.add(future)
+            future.add_done_callback(self._finish)
+        return futures
+
+    def _finish(self, future):
+        self._pending.discard(future)
+        outcome = future.result()
+        record_metric('discord_posts_total', 1, ok=str(outcome.ok).lower())
+        if not outcome.ok:
+            logging.error(f'Could not post the rotation to Discord webhook {get_redacted_webhook_url(outcome.url)}'
+                          f' ({outcome.messages_sent} messages sent, {outcome.attempts} attempts): {outcome.error}')
+
+    def wait(self):
+        """ Waits for every post started so far to finish. """
+        import concurrent.futures
 
-def send_rotation_to_discord(map_rotation, discord_webhook_url):
-    """ Sends the map rotation as a message to the discord channel for the given webhook URL. """
-    if discord_webhook_url:
-        # Need to pretty up the discord message string first.
-        discord_message = 'The map rotation for {} is:\n```{}```'.format(
-            datetime.date.today(), get_layers_string(map_rotation))
-        webhook = DiscordWebhook(
-            url=discord_webhook_url, content=discord_message)
-        webhook.execute()
+        concurrent.futures.wait(list(self._pending))
 
+    def close(self):
+        """ Waits for every post to finish and stops the background threads. """
+        self._executor.shutdown(wait=True)
 
-def validate_helper(config, layers):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def send_rotation_to_discord(map_rotation, discord_webhook_urls):
+    """
+    Sends the map rotation as a message to the discord channel of each given webhook URL (str, list(str) or None), and
+    waits for the posts to finish. Returns the DiscordOutcome of each webhook. Use a DiscordPoster to post in the
+    background instead.
+    """
+    if not discord_webhook_urls:
+        return []
+    with DiscordPoster() as poster:
+        futures = poster.post(map_rotation, discord_webhook_urls)
+    return [future.result() for future in futures]
+
+
+def validate_helper(config, layers, layer_schema=None):
     """
     A helper function to validate that each filter in the given config is a valid field name for every map layer (with
     special exceptions for the keyword 'any' or the 'team' filter key. Raises InvalidExceptionConfig if config invalid.
+    Also warns about filter values that no layer has (e.g. misspelled values). The layer_schema (see LayerSchema) is
+    computed from the layers if not given.
     """
-
-    # A helper conditional that returns whether a given key is 'team' and the layers have this key.
-    def key_is_team(key):
-        return (key == 'team' and
-                all(layer.get('team1') is not None for layer in layers) and
-                all(layer.get('team2') is not None for layer in layers))
+    if layer_schema is None:
+        layer_schema = LayerSchema(layers)
 
     for filter_config in config:
         # In the special case of strings, only the keyword 'any' is valid.
@@ -273,31 +2388,45 @@ def validate_helper(config, layers):
             else:
                 raise InvalidConfigException(f'Invalid values for config section: {filter_config}!')
         # Otherwise, only dict types are valid configs.
-        if not isinstance(filter_config, collections.Mapping):
+        if not isinstance(filter_config, collections.abc.Mapping):
             raise InvalidConfigException(f'Given config {filter_config} has invalid type/structure!')
 
         # Make sure every key in the config exists in **all** the layers. Otherwise, the config is invalid.
         # NOTE(bsubei): this is validating the layers as much as the config (both must be fully compatible).
         # NOTE(bsubei): 'team' is a special key that we allow as long as 'team1' and 'team2' keys exist in layers.
-        for key in filter_config.keys():
-            if not key_is_team(key) and not all(layer.get(key) is not None for layer in layers):
+        for key, value in filter_config.items():
+            if not layer_schema.is_filter_key(key):
                 raise InvalidConfigException(f'Key {key} is not a valid key to filter by in {filter_config}!')
+            # Values that no layer has are valid (the filter just won't match them), but are likely mistakes.
+            for v in value if isinstance(value, list) else [value]:
+                if not layer_schema.matches_any_layer(key, v):
+                    expected_types = ', '.join(sorted(layer_schema.types.get(key, ())))
+                    logging.warning(f'No layer has the value {v!r} for key {key} (of type {expected_types}) in '
+                                    f'{filter_config}!')
     # Only after checking that every filter config is not invalid can we be sure that it is valid (and we do nothing).
 
 
-def validate_config(config, layers):
+def validate_config(config, layers, layer_schema=None):
     """
     Raises InvalidConfigException if the given config is invalid. Uses the given layers to make sure the config is
     compatible.
 
     :param config: dict The config that describes how to choose the rotation. See README.md for expected format.
     :param layers: list(dict) The list of layers to check the config against.
+    :param layer_schema: LayerSchema The schema of the given layers, to validate many configs without rescanning the
+                         layers. If not given, the layers are checked and their schema is computed.
     :raises InvalidConfigException: The exception raised if the config is invalid.
     """
-    # Validate that the given layers is valid (we need to use its fields to ensure the config is valid).
-    if (not isinstance(layers, list) or
-            len(layers) < 1 or
-            not all(isinstance(layer, collections.Mapping) for layer in layers)):
+    # Validate that the given layers is valid (we need to use its fields to ensure the config is valid). A given schema
+    # was already computed from valid layers.
+    if layer_schema is None:
+        if (not isinstance(layers, list) or
+                len(layers) < 1 or
+                not all(isinstance(layer, collections.abc.Mapping) for layer in layers)):
+            raise InvalidConfigException(
+                'The given layers to check the config against is invalid!')
+        layer_schema = LayerSchema(layers)
+    elif layer_schema.num_layers < 1:
         raise InvalidConfigException(
             'The given layers to check the config against is invalid!')
 
@@ -321,35 +2450,763 @@ def validate_config(config, layers):
         raise InvalidConfigException(
             'Invalid "number_of_repeats" value in config! Please use a positive integer.')
 
+    # The weights section is optional, but each of its entries must be a dict of filters with a positive 'weight'.
+    weights_config = config.get('weights') or []
+    if not isinstance(weights_config, list):
+        raise InvalidConfigException('Given "weights" key is invalid! Should be a list!')
+    for weight_config in weights_config:
+        if not isinstance(weight_config, collections.abc.Mapping):
+            raise InvalidConfigException(f'Given weight {weight_config} has invalid type/structure!')
+        weight = weight_config.get('weight')
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 < weight < math.inf:
+            raise InvalidConfigException(
+                f'Missing or invalid "weight" value in {weight_config}! Please use a positive number.')
+
     # Validate the starting_maps section of the config.
-    validate_helper(starting_maps_config, layers)
+    validate_helper(starting_maps_config, layers, layer_schema)
     # Validate the regular_maps section of the config.
-    validate_helper(regular_maps_config, layers)
+    validate_helper(regular_maps_config, layers, layer_schema)
+    # Validate the filters of the weights section of the config.
+    validate_helper([{key: value for key, value in weight_config.items() if key != 'weight'}
+                     for weight_config in weights_config], layers, layer_schema)
+
+
+def load_yaml(f):
+    """ Safely loads the YAML document in the given file object or string (with the faster libyaml if available). """
+    import yaml
+
+    return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
-def parse_config(config_path, layers):
+def get_config_cache_key(config_bytes, layers_hash):
+    """ Returns the key (str) of a parsed config in the config cache, for the config file's contents and the layers. """
+    key_json = json.dumps({'version': CONFIG_CACHE_VERSION, 'layers': layers_hash,
+                           'config': hashlib.sha256(config_bytes).hexdigest()}, sort_keys=True)
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+
+def parse_config(config_path, layers, layer_schema=None, cache_dir=None, layers_hash=None,
+                 max_cached_configs=MAX_CACHED_CONFIGS):
     """
     Returns a rotation config from the given config_path after validating against the given layers. Raises
     InvalidConfigException if config is invalid.
 
+    If a cache_dir and the layers_hash are given, the parsed and validated config is cached on disk as JSON, keyed by
+    the contents of the config file and the layers, so parsing the same config for the same layers again skips parsing
+    the YAML. Cached configs are still validated (so their warnings are logged again). The least recently used configs
+    are evicted so at most max_cached_configs stay cached.
+
     :param config_path: str The path to the config file.
     :param layers: list(dict) The list of layers to check against.
+    :param layer_schema: LayerSchema The schema of the given layers (see validate_config).
+    :param cache_dir: pathlib.Path The directory to cache parsed configs in (in its 'configs' subdirectory). Caching is
+                      disabled if None.
+    :param layers_hash: str The hash of the contents of the given layers (see LayerIndex.layers_hash).
+    :param max_cached_configs: int The maximum number of parsed configs to keep cached.
     :raises InvalidConfigException: The exception raised if the config is invalid.
     """
-    with open(config_path, 'r') as f:
-        config = yaml.load(f)
-    validate_config(config, layers)
+    if cache_dir is None or layers_hash is None:
+        with timed_stage('parse_config'):
+            with open(config_path, 'r') as f:
+                config = load_yaml(f)
+        with timed_stage('validate_config'):
+            validate_config(config, layers, layer_schema)
+        return config
+
+    with open(config_path, 'rb') as f:
+        config_bytes = f.read()
+    configs_dir = pathlib.Path(cache_dir) / 'configs'
+    cache_path = configs_dir / f'{get_config_cache_key(config_bytes, layers_hash)}.json'
+    try:
+        with open(cache_path, 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = None
+    if config is not None:
+        record_metric('config_cache_hits_total', 1)
+        # Mark the config as recently used.
+        with contextlib.suppress(OSError):
+            os.utime(cache_path)
+        with timed_stage('validate_config'):
+            validate_config(config, layers, layer_schema)
+        return config
+
+    with timed_stage('parse_config'):
+        config = load_yaml(config_bytes)
+    with timed_stage('validate_config'):
+        validate_config(config, layers, layer_schema)
+    # Only cache configs that are the same when read back from JSON (e.g. not ones with YAML dates or non-string keys).
+    try:
+        config_json = json.dumps(config)
+    except (TypeError, ValueError):
+        return config
+    if json.loads(config_json) != config:
+        return config
+    try:
+        configs_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as f:
+            f.write(config_json)
+        os.replace(temp_path, cache_path)
+        # Evict the least recently used configs.
+        cached_paths = sorted(configs_dir.glob('*.json'), key=lambda path: path.stat().st_mtime_ns)
+        for cached_path in cached_paths[:-max_cached_configs]:
+            with contextlib.suppress(FileNotFoundError):
+                cached_path.unlink()
+    except OSError as e:
+        logging.warning(f'Could not cache the config {config_path}: {e}')
     return config
 
 
+def get_matching_bound(demands, resources):
+    """
+    Returns an upper bound on how many of the given demands can be met at once when every resource (e.g. a layer) can
+    only be used once, by Hall's theorem: for any set of groups, the number of demands met is at most the resources
+    they share plus the demands of the other groups. Resources are counted by which groups they belong to, so checking
+    a set of groups is a pass over the distinct group combinations instead of over the resources. The bound is exact
+    (it is the size of a maximum matching) if there are at most MAX_ANALYSIS_FILTERS groups.
+
+    :param demands: list(int) The number of demands of each group (e.g. the number of slots with the same filter).
+    :param resources: list(set) The resources each group can use (e.g. the ids of the layers that pass the filter).
+    :return: tuple(int, list(int)) The bound, and the groups (as positions in the given lists) that limit it the most
+             (an empty list if every demand can be met).
+    """
+    owner_masks = collections.Counter()
+    owners = {}
+    for group, group_resources in enumerate(resources):
+        for resource in group_resources:
+            owners[resource] = owners.get(resource, 0) | (1 << group)
+    owner_masks.update(owners.values())
+
+    num_groups = len(demands)
+    if num_groups <= MAX_ANALYSIS_FILTERS:
+        subsets = range(1, 1 << num_groups)
+    else:
+        subsets = [1 << group for group in range(num_groups)] + [(1 << num_groups) - 1]
+    worst_deficiency, worst_subset = 0, 0
+    for subset in subsets:
+        num_resources = sum(count for mask, count in owner_masks.items() if mask & subset)
+        deficiency = sum(demands[group] for group in range(num_groups) if subset >> group & 1) - num_resources
+        if deficiency > worst_deficiency:
+            worst_deficiency, worst_subset = deficiency, subset
+    return sum(demands) - worst_deficiency, [group for group in range(num_groups) if worst_subset >> group & 1]
+
+
+def analyze_config(config, layer_index, num_min_layers_before_duplicate_map=NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP):
+    """
+    Checks whether the given config can give a complete rotation that follows all the global filter rules, without
+    generating any rotation. Uses each filter's candidates from the layer index to find:
+
+    - The number of candidate layers (and maps) of each slot of the config.
+    - Whether the config runs out of layers (since no layer is used twice), and the first slot that must then be
+      skipped, using get_matching_bound over the slots' filters.
+    - Whether any run of nearby slots can't have distinct maps (the duplicate map rule), using get_matching_bound over
+      each distinct run of slot filters and their candidate maps.
+
+    These are necessary conditions, so a config with problems can never give a complete valid rotation, but a config
+    without problems is only very likely to.
+
+    :param config: dict or RotationPlan The config to analyze (see get_map_rotation).
+    :param layer_index: LayerIndex The index of the layers to choose from.
+    :param num_min_layers_before_duplicate_map: The allowed distance between layers with duplicate maps.
+    :return: dict The analysis: the 'slots' of the config (with their 'section', 'filter', 'candidates' and 'maps'),
+             the total 'num_slots' of the rotation, the 'max_filled_slots' that can be filled without reusing a layer,
+             the 'first_exhausted_slot' (the position in the rotation of the first slot that must be skipped, or None),
+             a list of 'problems' (as messages), and whether it is 'feasible' (has no problems).
+    """
+    plan = config if isinstance(config, RotationPlan) else compile_config(config)
+    slots = plan.slots()
+    window = max(1, num_min_layers_before_duplicate_map)
+    # Slots with the same filter are one group, with the filter's candidates as its layers and maps.
+    filters = list(dict.fromkeys(slots))
+    group_of = {slot_filter: group for group, slot_filter in enumerate(filters)}
+    candidate_ids = [layer_index.candidate_ids(slot_filter) for slot_filter in filters]
+    candidate_maps = [frozenset(layer_index.layers[layer_id]['map'] for layer_id in layer_ids)
+                      for layer_ids in candidate_ids]
+    problems = []
+
+    slot_reports = []
+    for section, section_filters in (('starting_maps', plan.starting_maps), ('regular_maps', plan.regular_maps)):
+        for slot_filter in section_filters:
+            group = group_of[slot_filter]
+            slot_reports.append({'section': section, 'filter': slot_filter.description,
+                                 'candidates': len(candidate_ids[group]), 'maps': len(candidate_maps[group])})
+            if not candidate_ids[group]:
+                problems.append(f'No layers pass the filter {slot_filter.description} in {section}!')
+
+    # Find how many slots can be filled without reusing a layer, and if not all of them, the first slot that must be
+    # skipped (the bound of the first few slots only grows with more slots, so binary search for it).
+    def get_prefix_bound(num_slots):
+        demands = [0] * len(filters)
+        for slot_filter in slots[:num_slots]:
+            demands[group_of[slot_filter]] += 1
+        return get_matching_bound(demands, candidate_ids)
+
+    max_filled_slots, limiting_groups = get_prefix_bound(len(slots))
+    first_exhausted_slot = None
+    if max_filled_slots < len(slots):
+        low, high = 0, len(slots)
+        while low < high:
+            middle = (low + high) // 2
+            if get_prefix_bound(middle + 1)[0] < middle + 1:
+                high = middle
+            else:
+                low = middle + 1
+        first_exhausted_slot = low
+        num_layers = len(frozenset().union(*(candidate_ids[group] for group in limiting_groups)))
+        num_limited_slots = sum(1 for slot_filter in slots if group_of[slot_filter] in limiting_groups)
+        problems.append(
+            f'Runs out of layers: the {num_limited_slots} slots with the filters '
+            f'{", ".join(filters[group].description for group in limiting_groups)} only have {num_layers} layers, '
+            f'so at least {len(slots) - max_filled_slots} slots will be skipped (starting at slot '
+            f'{first_exhausted_slot + 1} of {len(slots)})!')
+
+    # Every run of window + 1 slots in a row needs distinct maps. The runs repeat with the regular_maps, so each
+    # distinct run of filters is only checked once.
+    checked_runs = set()
+    for start in range(max(1, len(slots) - window)):
+        run_filters = slots[start:start + window + 1]
+        # Slots without any layers were already reported.
+        if run_filters in checked_runs or not all(candidate_ids[group_of[slot_filter]] for slot_filter in run_filters):
+            continue
+        checked_runs.add(run_filters)
+        run_maps = [candidate_maps[group_of[slot_filter]] for slot_filter in run_filters]
+        max_distinct_maps, _ = get_matching_bound([1] * len(run_filters), run_maps)
+        if max_distinct_maps < len(run_filters):
+            problems.append(
+                f'Not enough distinct maps for slots {start + 1} to {start + len(run_filters)} (filters '
+                f'{", ".join(slot_filter.description for slot_filter in run_filters)}), so a map will be duplicated '
+                f'within {window} layers!')
+
+    return {'slots': slot_reports, 'num_slots': len(slots), 'max_filled_slots': max_filled_slots,
+            'first_exhausted_slot': first_exhausted_slot, 'problems': problems, 'feasible': not problems}
+
+
+def get_analysis_report(name, analysis):
+    """ Returns the given analysis of a config (see analyze_config) as human readable text, titled with its name. """
+    lines = [f'{name}: {"OK" if analysis["feasible"] else "INFEASIBLE"} ({analysis["max_filled_slots"]} of '
+             f'{analysis["num_slots"]} slots can be filled)']
+    for slot_report in analysis['slots']:
+        lines.append(f'  {slot_report["section"]} {slot_report["filter"]}: {slot_report["candidates"]} layers, '
+                     f'{slot_report["maps"]} maps')
+    lines.extend(f'  {problem}' for problem in analysis['problems'])
+    return '\n'.join(lines)
+
+
+def parse_fleet_manifest(manifest_path):
+    """
+    Returns the list of servers in the given fleet manifest, as dicts with a 'name' (defaults to the config's filename
+    without its extension), a 'config' path, an 'output' path and an optional 'discord_webhook_url' (one URL or a
+    list of them). Relative paths are relative to the manifest's directory. Raises InvalidConfigException if the
+    manifest is invalid. See fleet.example.yml for an example manifest.
+
+    :param manifest_path: str The path to the fleet manifest file.
+    :raises InvalidConfigException: The exception raised if the manifest is invalid.
+    """
+    manifest_path = pathlib.Path(manifest_path)
+    with open(manifest_path, 'r') as f:
+        manifest = load_yaml(f)
+    servers = manifest.get('servers') if isinstance(manifest, collections.abc.Mapping) else None
+    if not isinstance(servers, list) or len(servers) < 1:
+        raise InvalidConfigException(f'Missing or invalid "servers" list in fleet manifest {manifest_path}!')
+
+    parsed_servers = []
+    for server in servers:
+        if (not isinstance(server, collections.abc.Mapping) or
+                not isinstance(server.get('config'), str) or
+                not isinstance(server.get('output'), str)):
+            raise InvalidConfigException(f'Fleet server {server} must have "config" and "output" paths!')
+        config_path = manifest_path.parent / server['config']
+        parsed_servers.append({
+            'name': str(server.get('name') or config_path.stem),
+            'config': config_path,
+            'output': manifest_path.parent / server['output'],
+            'discord_webhook_url': server.get('discord_webhook_url'),
+        })
+    return parsed_servers
+
+
+def run_fleet(manifest_path, layers, workers=None, layer_schema=None, seed=None, history_path=None,
+              history_days=DEFAULT_HISTORY_DAYS, cache_dir=None, layers_hash=None, **rotation_kwargs):
+    """
+    Generates and writes a rotation for every server in the given fleet manifest (see parse_fleet_manifest), sharing
+    the given layers across all of them. Configs are validated against one shared LayerSchema, rotations are
+    generated across a pool of worker processes, and the rotations are written out while they are posted to Discord
+    in the background (see DiscordPoster). A server with an invalid config is skipped with an error, without affecting
+    the others.
+
+    :param manifest_path: str The path to the fleet manifest file.
+    :param layers: list(dict) The list of layers to choose the rotations from.
+    :param workers: int The number of worker processes. Defaults to the number of CPUs. Uses no extra processes if 1.
+    :param layer_schema: LayerSchema The schema of the given layers. Computed once if not given.
+    :param seed: int The seed to derive each server's rotation seed from. Random if not given.
+    :param history_path: str The path to the play history file (see get_recently_played). Each server avoids the
+                         layers and maps it played in the last history_days days, and its new rotation is added to it.
+    :param history_days: float The number of days of play history to avoid.
+    :param cache_dir, layers_hash: The config cache directory and the hash of the layers, to cache the parsed configs
+                                   (see parse_config).
+    :param rotation_kwargs: Any other keyword arguments to pass to get_map_rotation (e.g. solver).
+    :return: dict Maps the output path of every server that got a rotation to its rotation.
+    """
+    import yaml
+
+    servers = parse_fleet_manifest(manifest_path)
+    if layer_schema is None:
+        layer_schema = LayerSchema(layers)
+
+    valid_servers = []
+    plans = []
+    for server in servers:
+        try:
+            config = parse_config(server['config'], layers, layer_schema, cache_dir, layers_hash)
+        except (InvalidConfigException, OSError, yaml.YAMLError) as e:
+            logging.error(f'Skipping fleet server with output {server["output"]} due to invalid config: {e}')
+            continue
+        valid_servers.append(server)
+        plans.append(compile_config(config))
+
+    seed_generator = random.Random(seed)
+    tasks = []
+    for plan_number, server in enumerate(valid_servers):
+        rotation_seed = seed_generator.getrandbits(64)
+        task_kwargs = {}
+        if history_path:
+            task_kwargs = get_recently_played(history_path, history_days, server['name'],
+                                              rotation_seed if seed is not None else None)
+        tasks.append((plan_number, rotation_seed, task_kwargs))
+    all_layer_ids = _run_rotation_tasks(plans, layers, tasks, workers, rotation_kwargs)
+    rotations = [[layers[layer_id] for layer_id in layer_ids] for layer_ids in all_layer_ids]
+
+    with DiscordPoster() as poster:
+        for server, rotation, task in zip(valid_servers, rotations, tasks):
+            try:
+                write_rotation(rotation, server['output'])
+            except OSError as e:
+                logging.error(f'Could not write the rotation for {server["output"]}: {e}')
+                continue
+            if history_path:
+                append_play_history(history_path, rotation, server['name'], task[1] if seed is not None else None)
+            poster.post(rotation, server['discord_webhook_url'])
+    return {server['output']: rotation for server, rotation in zip(valid_servers, rotations)}
+
+
+class RotationService:
+    """
+    A long-running service that keeps the layers (with their index and schema) and the compiled configs of one or more
+    servers in memory, so each rotation it generates only runs get_map_rotation. Call reload to pick up changes to the
+    layers file (or download) and the config files: only the changed configs are parsed again, unless the layers
+    changed, in which case every config is validated again against the new layers. See make_service_server for the
+    HTTP API, and serve_forever to run the service with polling for changes and scheduled rotations.
+    """
+
+    def __init__(self, servers, input_filepath=None, input_url=None, cache_dir=DEFAULT_CACHE_DIR,
+                 max_age=DEFAULT_CACHE_MAX_AGE_SECONDS, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS, use_snapshot=True,
+                 history_path=None, history_days=DEFAULT_HISTORY_DAYS, **rotation_kwargs):
+        """
+        :param servers: list(dict) The servers to serve rotations for (see parse_fleet_manifest). Each has a 'name',
+                        a 'config' path, and an optional 'output' path and 'discord_webhook_url' for scheduled
+                        rotations.
+        :param input_filepath: str The filepath of the JSON layers file (or None to use input_url).
+        :param input_url: str The URL of the JSON layers file.
+        :param cache_dir, max_age, timeout, use_snapshot: See get_layer_index.
+        :param history_path: str The path to the play history file (see get_recently_played). Rotations avoid the
+                             layers and maps their server played in the last history_days days, and scheduled
+                             rotations are added to it.
+        :param history_days: float The number of days of play history to avoid.
+        :param rotation_kwargs: Any other keyword arguments to pass to get_map_rotation (e.g. solver).
+        """
+        self.servers = list(servers)
+        self.input_filepath = input_filepath
+        self.input_url = input_url
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.timeout = timeout
+        self.use_snapshot = use_snapshot
+        self.history_path = history_path
+        self.history_days = history_days
+        self.rotation_kwargs = rotation_kwargs
+        self.layer_index = None
+        # Maps each server name to its server (the first one, if several servers share a name).
+        self._servers_by_name = {}
+        for server in self.servers:
+            self._servers_by_name.setdefault(server['name'], server)
+        # Maps config paths to their compiled RotationPlan, and the modification time they were parsed at.
+        self._plans = {}
+        self._config_mtimes = {}
+        self._layers_key = None
+        # Held while swapping in reloaded layers and plans (never while loading them), so requests always see layers
+        # and plans that match. Reloads are serialized by their own lock.
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.discord_poster = DiscordPoster()
+        self.reload()
+
+    @property
+    def names(self):
+        """ The names of the servers that have a valid config. """
+        return [name for name, server in self._servers_by_name.items() if str(server['config']) in self._plans]
+
+    def _get_layers_key(self):
+        """ Returns a key that changes whenever the layers change. """
+        if self.input_filepath:
+            stat = os.stat(self.input_filepath)
+            return f'{stat.st_mtime_ns}:{stat.st_size}'
+        if self.cache_dir is None:
+            # Without a cache, ask the server whether the layers changed instead of downloading them on every poll.
+            version = get_url_version(self.input_url, self.timeout)
+            if version is not None:
+                return version
+        # Downloads are cached for max_age (see fetch_url), so this only hits the server once in a while.
+        return hashlib.sha256(fetch_url(self.input_url, self.cache_dir, self.max_age, self.timeout)).hexdigest()
+
+    def reload(self):
+        """
+        Reloads the layers if they changed, and parses every config that changed (or every config, if the layers
+        changed). A config that is invalid or missing is logged as an error, and its server keeps its previous plan
+        unless the layers changed.
+
+        :return: list(str) The config paths that were parsed again.
+        """
+        with self._reload_lock:
+            layers_key = self._get_layers_key()
+            layers_changed = layers_key != self._layers_key
+            if layers_changed:
+                with timed_stage('reload_layers'):
+                    layer_index = get_layer_index(self.input_filepath, self.input_url, self.cache_dir, self.max_age,
+                                                  self.timeout, use_snapshot=self.use_snapshot)
+                # The old plans were validated against the old layers, so they all need to be validated again.
+                plans, config_mtimes = {}, {}
+            else:
+                layer_index = self.layer_index
+                plans, config_mtimes = dict(self._plans), dict(self._config_mtimes)
+
+            import yaml
+
+            reloaded = []
+            for config_path in dict.fromkeys(str(server['config']) for server in self.servers):
+                try:
+                    mtime = os.stat(config_path).st_mtime_ns
+                except OSError as e:
+                    logging.error(f'Could not read the config {config_path}: {e}')
+                    continue
+                if mtime == config_mtimes.get(config_path):
+                    continue
+                config_mtimes[config_path] = mtime
+                reloaded.append(config_path)
+                try:
+                    config = parse_config(config_path, layer_index.layers, layer_index.schema, self.cache_dir,
+                                          layer_index.layers_hash)
+                except (InvalidConfigException, OSError, yaml.YAMLError) as e:
+                    logging.error(f'Could not reload the config {config_path}: {e}')
+                    continue
+                plans[config_path] = compile_config(config)
+
+            with self._lock:
+                self.layer_index = layer_index
+                self._plans, self._config_mtimes = plans, config_mtimes
+                self._layers_key = layers_key
+        if layers_changed:
+            logging.info(f'Loaded {len(layer_index)} layers.')
+        if reloaded:
+            logging.info(f'Reloaded the configs {reloaded}.')
+        return reloaded
+
+    def get_rotation(self, name, seed=None):
+        """
+        Returns a new map rotation (list of layers) for the server with the given name, chosen with random.Random(seed)
+        if a seed is given, and avoiding the server's play history if there is one. Raises KeyError if there is no such
+        server, or if its config is invalid.
+        """
+        with self._lock:
+            plan = self._plans[str(self._servers_by_name[name]['config'])]
+            layer_index = self.layer_index
+        rng = random if seed is None else random.Random(seed)
+        played = get_recently_played(self.history_path, self.history_days, name, seed) if self.history_path else {}
+        with timed_stage('generate'):
+            return get_map_rotation(plan, layer_index.layers, layer_index=layer_index, rng=rng,
+                                    **{**self.rotation_kwargs, **played})
+
+    def write_rotations(self):
+        """
+        Generates and writes a new rotation for every server with an 'output' path, adds them to the play history (if
+        any), and posts them to Discord in the background (see DiscordPoster).
+        """
+        for server in self.servers:
+            if not server.get('output'):
+                continue
+            try:
+                rotation = self.get_rotation(server['name'])
+                write_rotation(rotation, server['output'])
+                if self.history_path:
+                    append_play_history(self.history_path, rotation, server['name'])
+            except Exception as e:
+                logging.error(f'Could not write the rotation for {server["output"]}: {e}')
+                continue
+            self.discord_poster.post(rotation, server.get('discord_webhook_url'))
+
+    def _repeat(self, interval, function):
+        """ Calls the given function every interval seconds until stop is called, logging any errors it raises. """
+        while not self._stop.wait(interval):
+            try:
+                function()
+            except Exception as e:
+                logging.error(f'{function.__name__} failed: {e}')
+
+    def stop(self):
+        """ Stops polling for changes and writing scheduled rotations, and waits for any posts to Discord. """
+        self._stop.set()
+        self.discord_poster.close()
+
+    def serve_forever(self, address, poll_interval=DEFAULT_SERVICE_POLL_SECONDS, schedule_interval=None):
+        """
+        Serves rotations at the given address (see make_service_server) until interrupted, while reloading changes
+        every poll_interval seconds and writing rotations (see write_rotations) every schedule_interval seconds.
+        """
+        threads = [threading.Thread(target=self._repeat, args=(poll_interval, self.reload), daemon=True)]
+        if schedule_interval:
+            threads.append(threading.Thread(target=self._repeat, args=(schedule_interval, self.write_rotations),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        with make_service_server(self, address) as server:
+            logging.info(f'Serving rotations for {self.names} at {address}.')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.stop()
+
+
+class _RotationRequestHandler:
+    """
+    Handles the HTTP API of a RotationService (the server's service attribute), when mixed into a
+    http.server.BaseHTTPRequestHandler (see make_service_server):
+        GET /configs                         The names of the servers, as a JSON list.
+        GET /rotation?config=<name>          A new rotation for the named server, in the MapRotation.cfg format (the
+                                             config can be left out if there is only one server).
+        GET /rotation?config=<name>&format=json    The same rotation, as a JSON list of layer names.
+        GET /rotation?config=<name>&seed=<int>     The rotation for the given seed (the same for the same seed).
+        POST /reload                         Reloads changes now, and returns the reloaded configs as a JSON list.
+    """
+
+    def do_GET(self):
+        from urllib import parse
+
+        url = parse.urlparse(self.path)
+        query = parse.parse_qs(url.query)
+        service = self.server.service
+        if url.path == '/configs':
+            self._respond(200, json.dumps(service.names), 'application/json')
+        elif url.path == '/rotation':
+            names = service.names
+            name = query.get('config', names if len(names) == 1 else [None])[0]
+            try:
+                seed = int(query['seed'][0]) if 'seed' in query else None
+            except ValueError:
+                self._respond(400, f'Invalid seed {query["seed"][0]}! Expected an integer.\n')
+                return
+            try:
+                rotation = service.get_rotation(name, seed)
+            except KeyError:
+                self._respond(404, f'Unknown or invalid config {name}! Expected one of {names}.\n')
+                return
+            if query.get('format', ['cfg'])[0] == 'json':
+                self._respond(200, json.dumps(get_layers(rotation)), 'application/json')
+            else:
+                self._respond(200, get_layers_string(rotation))
+        else:
+            self._respond(404, f'Unknown path {url.path}!\n')
+
+    def do_POST(self):
+        from urllib import parse
+
+        if parse.urlparse(self.path).path == '/reload':
+            self._respond(200, json.dumps(self.server.service.reload()), 'application/json')
+        else:
+            self._respond(404, f'Unknown path {self.path}!\n')
+
+    def _respond(self, status, body, content_type='text/plain'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # NOTE(bsubei): the default logs every request to stderr (and fails for Unix socket clients, which have no
+        # address), so log them at debug level instead.
+        logging.debug(f'{self.command} {self.path}: {format % args}')
+
+
+def make_service_server(service, address):
+    """
+    Returns an HTTP server (not yet serving) for the API of the given RotationService (see _RotationRequestHandler).
+
+    :param service: RotationService The service to generate the rotations with.
+    :param address: str Either 'host:port' (port 0 picks a free port), or the path of a Unix socket to create.
+    """
+    import http.server
+    import socketserver
+
+    handler = type('RotationRequestHandler', (_RotationRequestHandler, http.server.BaseHTTPRequestHandler), {})
+    if '/' in address:
+        # Remove the socket left behind by a previous run.
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(address)
+        # An HTTP server on a Unix socket that handles each request in a new thread.
+        server_class = type('ThreadingUnixHTTPServer', (socketserver.ThreadingMixIn, socketserver.UnixStreamServer),
+                            {'daemon_threads': True})
+        server = server_class(address, handler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or 'localhost', int(port)), handler)
+    server.service = service
+    return server
+
+
+def serve(args):
+    """ Run the rotation service (see RotationService) with the given parsed commandline args until interrupted. """
+    if args.fleet_manifest:
+        servers = parse_fleet_manifest(args.fleet_manifest)
+    else:
+        servers = [{'name': args.config_filepath.stem, 'config': args.config_filepath,
+                    'output': args.output_filepath, 'discord_webhook_url': args.discord_webhook_url}]
+    service = RotationService(servers, args.input_filepath, args.input_url,
+                              None if args.no_cache else args.cache_dir, args.cache_max_age, args.request_timeout,
+                              use_snapshot=not args.no_snapshot, history_path=args.history_file,
+                              history_days=args.history_days, solver=args.solver,
+                              solver_budget_seconds=args.solver_budget, engine=args.engine)
+    service.serve_forever(args.serve, args.poll_interval, args.schedule_interval)
+
+
+def dry_run(args, layer_index):
+    """
+    Analyzes the configs given by the parsed commandline args (see analyze_config) and prints a report of each. Returns
+    whether every config is valid and feasible.
+    """
+    import yaml
+
+    if args.dry_run:
+        config_paths = args.dry_run
+    elif args.fleet_manifest:
+        config_paths = list(dict.fromkeys(server['config'] for server in parse_fleet_manifest(args.fleet_manifest)))
+    else:
+        config_paths = [args.config_filepath]
+
+    all_feasible = True
+    for config_path in config_paths:
+        try:
+            config = parse_config(config_path, layer_index.layers, layer_index.schema,
+                                  None if args.no_cache else args.cache_dir, layer_index.layers_hash)
+        except (InvalidConfigException, OSError, yaml.YAMLError) as e:
+            print(f'{config_path}: INVALID ({e})')
+            all_feasible = False
+            continue
+        with timed_stage('analyze'):
+            analysis = analyze_config(config, layer_index)
+        print(get_analysis_report(config_path, analysis))
+        all_feasible = all_feasible and analysis['feasible']
+    return all_feasible
+
+
+def run(args):
+    """ Run the script with the given parsed commandline args and write out the map rotation(s). """
+    if args.serve:
+        serve(args)
+        return
+    cache_dir = None if args.no_cache else args.cache_dir
+    layer_index = get_layer_index(args.input_filepath, args.input_url, cache_dir, args.cache_max_age,
+                                  args.request_timeout, use_snapshot=not args.no_snapshot)
+    layers = layer_index.layers
+    record_metric('layers', len(layers))
+    if args.dry_run is not None:
+        if not dry_run(args, layer_index):
+            sys.exit(1)
+        return
+    if args.fleet_manifest:
+        with timed_stage('fleet'):
+            run_fleet(args.fleet_manifest, layers, workers=args.workers, layer_schema=layer_index.schema,
+                      seed=args.seed, history_path=args.history_file, history_days=args.history_days,
+                      cache_dir=cache_dir, layers_hash=layer_index.layers_hash, solver=args.solver,
+                      solver_budget_seconds=args.solver_budget, engine=args.engine)
+        return
+    config = parse_config(args.config_filepath, layers, layer_index.schema, cache_dir, layer_index.layers_hash)
+    rotation_kwargs = {'solver': args.solver, 'solver_budget_seconds': args.solver_budget, 'engine': args.engine}
+    if args.reroll:
+        with timed_stage('reroll'):
+            map_rotation = read_rotation(args.output_filepath, layer_index)
+            out_of_range_positions = sorted(position for position in set(args.reroll) if position > len(map_rotation))
+            if out_of_range_positions:
+                logging.error(f'Positions {out_of_range_positions} are out of range for the rotation of '
+                              f'{len(map_rotation)} layers in {args.output_filepath}! Positions are from 1 to '
+                              f'{len(map_rotation)}.')
+                sys.exit(1)
+            chosen_map_rotation = reroll_rotation(
+                map_rotation, [position - 1 for position in args.reroll], config, layers, layer_index=layer_index,
+                rng=random.Random(args.seed) if args.seed is not None else random)
+        with timed_stage('write'):
+            write_rotation(chosen_map_rotation, args.output_filepath)
+        with timed_stage('discord'):
+            send_rotation_to_discord(chosen_map_rotation, args.discord_webhook_url)
+        return
+    if args.fairness:
+        with timed_stage('fairness'):
+            report = analyze_fairness(config, layers, args.fairness, seed=args.seed, workers=args.workers,
+                                      **rotation_kwargs)
+        report_json = json.dumps(report, indent=2)
+        if args.fairness_report:
+            args.fairness_report.write_text(report_json + '\n')
+        else:
+            print(report_json)
+        return
+    if args.history_file:
+        with timed_stage('read_history'):
+            rotation_kwargs.update(get_recently_played(args.history_file, args.history_days, seed=args.seed))
+    if args.num_rotations > 1:
+        with timed_stage('generate'):
+            rotations = generate_rotations(config, layers, args.num_rotations, seed=args.seed, workers=args.workers,
+                                           **rotation_kwargs)
+        with timed_stage('write'):
+            for number, rotation in enumerate(rotations, start=1):
+                write_rotation(rotation, get_numbered_filepath(args.output_filepath, number, args.num_rotations))
+        if args.discord_webhook_url:
+            logging.warning('Not posting to Discord since more than one rotation was generated!')
+        return
+    if (args.seed is None and not args.history_file and not args.discord_webhook_url and args.solver == 'greedy' and
+            args.engine == 'python'):
+        # Nothing else needs the rotation, so stream its layers to the output file as they are chosen.
+        with timed_stage('generate'):
+            write_rotation(iter_map_rotation(config, layers, layer_index=layer_index), args.output_filepath)
+        return
+    with timed_stage('generate'):
+        if args.seed is None:
+            chosen_map_rotation = get_map_rotation(config, layers, layer_index=layer_index, **rotation_kwargs)
+        else:
+            chosen_map_rotation = get_cached_map_rotation(
+                config, layer_index, args.seed, cache_dir, **rotation_kwargs)
+    with timed_stage('write'):
+        write_rotation(chosen_map_rotation, args.output_filepath)
+        if args.history_file:
+            append_play_history(args.history_file, chosen_map_rotation, seed=args.seed)
+    with timed_stage('discord'):
+        send_rotation_to_discord(chosen_map_rotation, args.discord_webhook_url)
+
+
 def main():
-    """ Run the script and write out a map rotation. """
+    """ Run the script and write out a map rotation (and the run's metrics if requested). """
     args = parse_cli()
-    layers = get_json_layers(args.input_filepath, args.input_url)
-    config = parse_config(args.config_filepath, layers)
-    chosen_map_rotation = get_map_rotation(config, layers)
-    write_rotation(chosen_map_rotation, args.output_filepath)
-    send_rotation_to_discord(chosen_map_rotation, args.discord_webhook_url)
+    if not args.metrics:
+        run(args)
+        return
+    with RunMetrics() as metrics:
+        try:
+            with timed_stage('total'):
+                run(args)
+        finally:
+            metrics.write(args.metrics, args.metrics_format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+
+# Copyright (C) 2020 Basheer Subei
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# A testing class to test the benchmarks package (synthetic data generators and the benchmark runner).
+#
+
+import logging
+import squad_map_randomizer
+from benchmarks import run, synthetic
+
+
+class TestBenchmarks:
+    """ Test class (uses pytest) for the benchmarks package. """
+
+    def test_make_layers(self):
+        """ Tests that synthetic layers are valid, unique and have the requested cardinalities. """
+        layers = synthetic.make_layers(500, num_maps=10, num_gamemodes=4, num_teams=5, seed=1)
+        assert len(layers) == 500
+        assert len({layer['layer'] for layer in layers}) == 500
+        assert len({layer['map'] for layer in layers}) == 10
+        assert len({layer['gamemode'] for layer in layers}) == 4
+        assert {layer['team1'] for layer in layers} | {layer['team2'] for layer in layers} <= {
+            f'Team {i}' for i in range(5)}
+        # The same seed gives the same layers.
+        assert synthetic.make_layers(500, num_maps=10, num_gamemodes=4, num_teams=5, seed=1) == layers
+
+    def test_make_config(self):
+        """ Tests that synthetic configs are valid for the layers they were made for. """
+        layers = synthetic.make_layers(200)
+        for tightness in [0, 0.5, 1]:
+            config = synthetic.make_config(layers, num_slots=8, number_of_repeats=3, tightness=tightness)
+            squad_map_randomizer.validate_config(config, layers)
+            assert len(config['regular_maps']) == 8
+            assert config['number_of_repeats'] == 3
+
+    def test_make_history(self, tmp_path):
+        """ Tests that synthetic play histories have one rotation per server per day. """
+        layers = synthetic.make_layers(100)
+        history_path = tmp_path / 'history.jsonl'
+        synthetic.make_history(history_path, layers, num_days=30, num_servers=3, rotation_length=5)
+        assert len(squad_map_randomizer.read_play_history(history_path, 30)) == 90
+        entries = squad_map_randomizer.read_play_history(history_path, 2.5, server='Server 1')
+        assert len(entries) == 3
+        assert all(len(entry['layers']) == 5 for entry in entries)
+
+    def test_run_benchmarks(self):
+        """ Tests that the benchmarks run every stage and flag regressions against a baseline. """
+        results = run.run_benchmarks(sizes=[50], config_names=['default'], min_seconds=0)
+        assert 'get_map_rotation[default,50]' in results
+        assert all(result['seconds'] > 0 and result['peak_bytes'] >= 0 for result in results.values())
+
+        # Only benchmarks slower than the baseline by more than the tolerance are regressions.
+        baseline = {name: {'seconds': result['seconds']} for name, result in results.items()}
+        assert run.compare_to_baseline(results, baseline) == []
+        baseline['get_map_rotation[default,50]']['seconds'] /= 10
+        assert run.compare_to_baseline(results, baseline) == ['get_map_rotation[default,50]']
+        assert 'get_map_rotation[default,50]' in run.format_results(results, baseline)
+
+    def test_main_baseline(self, tmp_path, capsys):
+        """ Tests that the benchmarks warn when there is no baseline, and compare against a saved one. """
+        baseline_path = tmp_path / 'baseline.json'
+        argv = ['--sizes', '50', '--configs', 'default', '--min-seconds', '0', '--baseline', str(baseline_path)]
+        assert run.main(argv) == 0
+        assert 'there is no baseline' in capsys.readouterr().err
+
+        assert run.main(argv + ['--save-baseline']) == 0
+        assert baseline_path.exists()
+        assert run.main(argv + ['--tolerance', '1000']) == 0
+        assert 'there is no baseline' not in capsys.readouterr().err
+        # Logging is only disabled while the benchmarks run.
+        assert logging.root.manager.disable == logging.NOTSET
@@ -15,14 +15,29 @@
 # A testing class to test the squad_map_randomizer script.
 #
 
+import collections
+import datetime
+import http.server
+import json
+import logging
 import os
+import pickle
 import pytest
 import random
+import subprocess
+import sys
+import threading
+from urllib import error, request
 from unittest import mock
 import yaml
 
 import squad_map_randomizer
 
+# The modules that importing squad_map_randomizer must not import (they are imported only when needed).
+HEAVY_MODULES = {'yaml', 'numpy', 'discord_webhook', 'requests', 'urllib.request', 'http.server', 'concurrent.futures'}
+# The maximum number of seconds importing squad_map_randomizer may take (it takes a few tens of milliseconds).
+STARTUP_BUDGET_SECONDS = 0.25
+
 
 # Below are helper predicates used in the filters.
 def is_skirmish(layer):
@@ -103,7 +118,93 @@ class TestSquadMapRandomizer:
             "map_size": "medium",
         }
         """
-        return squad_map_randomizer.get_json_layers(None, squad_map_randomizer.DEFAULT_LAYERS_URL)
+        return squad_map_randomizer.get_json_layers(None, squad_map_randomizer.DEFAULT_LAYERS_URL, cache_dir=None)
+
+    @pytest.fixture
+    def layers_server(self):
+        """
+        The fixture function to serve a small layers JSON file from a local HTTP server (a stand-in for GitHub that
+        supports ETags). Returns the server, the URL of the layers file and the headers of every request the server got.
+        """
+        layers = [
+            {'map': 'Al Basrah', 'layer': 'Al Basrah AAS v1', 'gamemode': 'AAS', 'bugged': False},
+            {'map': 'Belaya', 'layer': 'Belaya AAS v1', 'gamemode': 'AAS', 'bugged': True},
+        ]
+        body = json.dumps(layers).encode('utf-8')
+        etag = '"layers-v1"'
+        requests_headers = []
+
+        class LayersHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_headers.append(dict(self.headers))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), LayersHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server, f'http://127.0.0.1:{server.server_port}/layers.json', requests_headers
+        server.shutdown()
+        server.server_close()
+
+    @pytest.fixture
+    def discord_server(self):
+        """
+        The fixture function to run a fake Discord webhook server. Returns the base URL of its webhooks, the list of
+        (path, message) it received, and an event that its '/slow' webhook waits for before responding. The '/ok'
+        webhook always succeeds, '/ratelimited' is rate limited once, '/bad' rejects messages and '/error' fails.
+        """
+        received = []
+        slow_event = threading.Event()
+        rate_limited = []
+
+        class WebhookHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['content']
+                if self.path == '/slow':
+                    slow_event.wait(10)
+                if self.path == '/ratelimited' and not rate_limited:
+                    rate_limited.append(message)
+                    self._respond(429, json.dumps({'retry_after': 0.01, 'global': False}).encode('utf-8'))
+                elif self.path == '/bad':
+                    self._respond(400, b'{"message": "Cannot send an empty message"}')
+                elif self.path == '/error':
+                    self._respond(500, b'')
+                else:
+                    received.append((self.path, message))
+                    self._respond(204, b'')
+
+            def _respond(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield f'http://127.0.0.1:{server.server_port}', received, slow_event
+        slow_event.set()
+        server.shutdown()
+        server.server_close()
 
     @pytest.fixture
     def default_config(self):
@@ -203,6 +304,698 @@ class TestSquadMapRandomizer:
             rotation, squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
         assert not has_duplicate_layers(rotation)
 
+    def test_get_nonduplicate_map(self):
+        """ Tests that get_nonduplicate_map only picks a recently played map when there is no other choice. """
+        chosen_rotation = [{'map': 'A', 'layer': 'A v1'}, {'map': 'B', 'layer': 'B v1'}]
+        available_layers = [{'map': 'A', 'layer': 'A v2'}] * 50 + [{'map': 'C', 'layer': 'C v1'}]
+        # With a single valid candidate among many invalid ones, the valid one is always chosen without errors.
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            for _ in range(20):
+                assert squad_map_randomizer.get_nonduplicate_map(
+                    available_layers, chosen_rotation, 3)['layer'] == 'C v1'
+            assert mock_error.call_count == 0
+
+        # The same holds when the caller maintains the recent maps window.
+        recent_maps = squad_map_randomizer.RecentMaps(1)
+        recent_maps.add('A')
+        recent_maps.add('C')
+        assert 'A' not in recent_maps and 'C' in recent_maps
+        assert squad_map_randomizer.get_nonduplicate_map(
+            available_layers[-2:], chosen_rotation, 1, recent_maps)['layer'] == 'A v2'
+
+        # With no valid candidates, an error is printed and a layer is chosen anyways.
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            assert squad_map_randomizer.get_nonduplicate_map(
+                available_layers[:1], chosen_rotation, 3)['layer'] == 'A v2'
+            assert mock_error.call_count == 1
+
+    @pytest.mark.parametrize('execution_number', range(20))
+    def test_get_map_rotation_backtrack(self, execution_number):
+        """ Tests that the backtrack solver finds complete valid rotations where the greedy solver can fail. """
+        random.seed(execution_number)
+        layers = [{'map': 'X', 'layer': 'X v1'}, {'map': 'Y', 'layer': 'Y v1'}]
+        # Greedy fills the 'any' slot first and takes the only X layer half the time, starving the second slot.
+        config = {'regular_maps': ['any', {'map': 'X'}]}
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            rotation = squad_map_randomizer.get_map_rotation(config, layers, solver='backtrack')
+            assert mock_error.call_count == 0
+        assert [layer['layer'] for layer in rotation] == ['Y v1', 'X v1']
+
+        # When the budget runs out, it falls back to the greedy result.
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            rotation = squad_map_randomizer.get_map_rotation(config, layers, solver='backtrack', solver_max_steps=0)
+            assert mock_warning.call_count == 1
+        assert 1 <= len(rotation) <= 2
+
+    def test_get_map_rotation_backtrack_complex(self, default_layers):
+        """ Tests that the backtrack solver gives complete valid rotations for the complex example config. """
+        config = squad_map_randomizer.parse_config(
+            squad_map_randomizer.EXAMPLES_CONFIG_DIR / 'complex_example.yml', default_layers)
+        plan = squad_map_randomizer.compile_config(config)
+        for seed in range(10):
+            random.seed(seed)
+            rotation = squad_map_randomizer.get_map_rotation(config, default_layers, solver='backtrack')
+            assert len(rotation) == len(plan.slots())
+            assert all(slot_filter.matches(layer) for slot_filter, layer in zip(plan.slots(), rotation))
+            assert not has_close_duplicate_maps(rotation, squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+            assert not has_duplicate_layers(rotation)
+
+        with pytest.raises(ValueError):
+            squad_map_randomizer.get_map_rotation(config, default_layers, solver='does not exist')
+
+    def test_get_matching_bound(self):
+        """ Tests that the matching bound finds how many demands can be met when each resource is used once. """
+        assert squad_map_randomizer.get_matching_bound([2, 1], [{1, 2}, {3}]) == (3, [])
+        # Both groups share the only two resources.
+        assert squad_map_randomizer.get_matching_bound([2, 1], [{1, 2}, {1, 2}]) == (2, [0, 1])
+        assert squad_map_randomizer.get_matching_bound([1, 1, 1], [{1}, {1, 2}, set()]) == (2, [2])
+
+    def test_analyze_config(self, default_config, default_layers):
+        """ Tests that config analysis finds the slots that run out of layers or maps, without generating anything. """
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        analysis = squad_map_randomizer.analyze_config(default_config, layer_index)
+        assert analysis['feasible'] and not analysis['problems']
+        assert analysis['num_slots'] == analysis['max_filled_slots'] == 22
+        assert analysis['first_exhausted_slot'] is None
+        assert [slot['candidates'] for slot in analysis['slots']] == [
+            len(layer_index.filter_ids(filter_config))
+            for filter_config in default_config['starting_maps'] + default_config['regular_maps']]
+        for path in os.scandir(squad_map_randomizer.EXAMPLES_CONFIG_DIR):
+            config = squad_map_randomizer.parse_config(path, default_layers)
+            assert squad_map_randomizer.analyze_config(config, layer_index)['feasible']
+
+        # Running out of skirmish layers skips the slots after the last one.
+        num_skirmish = sum(map(is_skirmish, default_layers))
+        config = {'regular_maps': ['any', {'gamemode': 'Skirmish'}], 'number_of_repeats': num_skirmish + 1}
+        analysis = squad_map_randomizer.analyze_config(config, layer_index)
+        assert not analysis['feasible']
+        assert analysis['max_filled_slots'] == 2 * num_skirmish + 1
+        assert analysis['first_exhausted_slot'] == 2 * num_skirmish + 1
+        random.seed(0)
+        assert len(squad_map_randomizer.get_map_rotation(config, default_layers)) == 2 * num_skirmish + 1
+
+        # Nearby slots with only one map between them must duplicate it, even with plenty of layers.
+        config = {'regular_maps': [{'map': default_layers[0]['map']}, 'any', {'map': default_layers[0]['map']}]}
+        analysis = squad_map_randomizer.analyze_config(config, layer_index)
+        assert not analysis['feasible'] and analysis['max_filled_slots'] == 3
+        assert len(analysis['problems']) == 1
+        assert squad_map_randomizer.analyze_config(config, layer_index, num_min_layers_before_duplicate_map=0)[
+            'feasible']
+
+    def test_generate_rotations(self, default_config, default_layers):
+        """ Tests that generate_rotations gives the same independent rotations regardless of the number of workers. """
+        rotations = squad_map_randomizer.generate_rotations(default_config, default_layers, 6, seed=42, workers=1)
+        assert len(rotations) == 6
+        assert all(len(rotation) == 22 for rotation in rotations)
+        assert all(layer in default_layers for layer in rotations[0])
+        # The rotations are independent of each other.
+        assert len({tuple(squad_map_randomizer.get_layers(rotation)) for rotation in rotations}) > 1
+
+        # The same seed gives the same rotations, even across multiple processes.
+        assert squad_map_randomizer.generate_rotations(
+            default_config, default_layers, 6, seed=42, workers=2) == rotations
+        # Keyword arguments are passed on to get_map_rotation.
+        rotations = squad_map_randomizer.generate_rotations(
+            {'regular_maps': ['any', {'map': 'Chora'}]}, default_layers, 3, seed=1, workers=1, solver='backtrack')
+        assert all(len(rotation) == 2 and rotation[1]['map'] == 'Chora' for rotation in rotations)
+
+    def test_generate_rotations_numpy(self, default_config, default_layers):
+        """ Tests that the numpy engine generates rotations that follow the same rules as the python engine. """
+        pytest.importorskip('numpy')
+        rotations = squad_map_randomizer.generate_rotations(default_config, default_layers, 200, seed=7, engine='numpy')
+        assert len(rotations) == 200
+        plan = squad_map_randomizer.compile_config(default_config)
+        for rotation in rotations:
+            assert len(rotation) == 22
+            assert all(slot_filter.matches(layer) for slot_filter, layer in zip(plan.slots(), rotation))
+            assert not has_duplicate_layers(rotation)
+            assert not has_close_duplicate_maps(rotation, squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+        assert len({tuple(squad_map_randomizer.get_layers(rotation)) for rotation in rotations}) > 1
+        # The same seed gives the same rotations.
+        assert squad_map_randomizer.generate_rotations(
+            default_config, default_layers, 200, seed=7, engine='numpy') == rotations
+
+        # Rotations are generated in chunks sized by the memory budget (a chunk is at least one rotation).
+        assert squad_map_randomizer.get_numpy_chunk_size(10 ** 9) == 1
+        chunk_size = squad_map_randomizer.get_numpy_chunk_size(len(default_layers))
+        budget = squad_map_randomizer.NUMPY_ENGINE_MEMORY_BYTES // squad_map_randomizer.NUMPY_ENGINE_BYTES_PER_LAYER
+        assert 1 < chunk_size * len(default_layers) <= budget
+        with mock.patch('squad_map_randomizer.get_numpy_chunk_size', return_value=3) as mock_chunk_size, \
+                mock.patch('squad_map_randomizer.get_map_rotation_ids_numpy',
+                           wraps=squad_map_randomizer.get_map_rotation_ids_numpy) as mock_generate:
+            rotations = squad_map_randomizer.generate_rotations(default_config, default_layers, 7, engine='numpy')
+            assert mock_chunk_size.call_count == 1
+            assert [args[0][2] for args in mock_generate.call_args_list] == [3, 3, 1]
+        assert len(rotations) == 7 and all(len(rotation) == 22 for rotation in rotations)
+
+    @pytest.mark.parametrize('engine', squad_map_randomizer.ENGINES)
+    def test_analyze_fairness(self, default_config, default_layers, engine):
+        """ Tests that the fairness report counts every chosen layer and broken rule, the same for any workers. """
+        if engine == 'numpy':
+            pytest.importorskip('numpy')
+        report = squad_map_randomizer.analyze_fairness(default_config, default_layers, 300, seed=3, workers=2,
+                                                       batch_size=70, engine=engine)
+        assert report['rotations'] == report['complete_rotations'] == 300
+        assert report['skipped_slots'] == report['duplicate_map_violations'] == 0
+        assert sum(report['layers'].values()) == sum(report['maps'].values()) == 300 * 22
+        assert sum(report['teams'].values()) == 2 * 300 * 22
+        assert len(report['positions']) == 22
+        assert report['positions'][0]['gamemodes'] == {'Skirmish': 300}
+        assert list(report['layers'].values()) == sorted(report['layers'].values(), reverse=True)
+        assert squad_map_randomizer.analyze_fairness(default_config, default_layers, 300, seed=3, workers=1,
+                                                     batch_size=70, engine=engine) == report
+
+        # Skipped slots and duplicated maps are counted instead of logged.
+        config = {'regular_maps': [{'map': default_layers[0]['map']}] * 2, 'number_of_repeats': 20}
+        num_layers_of_map = sum(layer['map'] == default_layers[0]['map'] for layer in default_layers)
+        report = squad_map_randomizer.analyze_fairness(config, default_layers, 10, workers=1, engine=engine)
+        assert report['complete_rotations'] == 0
+        assert report['skipped_slots'] == 10 * (40 - num_layers_of_map)
+        assert report['duplicate_map_violations'] == 10 * (num_layers_of_map - 1)
+
+        # Logging that the caller disabled stays disabled.
+        logging.disable(logging.CRITICAL)
+        try:
+            squad_map_randomizer.analyze_fairness(config, default_layers, 1, workers=1, engine=engine)
+            assert logging.root.manager.disable == logging.CRITICAL
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_get_map_rotation_numpy(self, default_layers):
+        """ Tests that get_map_rotation with the numpy engine reports errors like the python engine. """
+        pytest.importorskip('numpy')
+        impossible_config = {'number_of_repeats': 10, 'regular_maps': [{'map': 'Chora'}]}
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            rotation = squad_map_randomizer.get_map_rotation(impossible_config, default_layers, engine='numpy')
+            assert mock_error.call_count == 9
+            assert all('Could not get a valid map without duplicates!' in args[0][0]
+                       for args in mock_error.call_args_list)
+        assert not has_duplicate_layers(rotation)
+
+        config_with_team = {'number_of_repeats': 5, 'regular_maps': [{'team': ['misspelled_name']}, {'team': ['US']}]}
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            rotation = squad_map_randomizer.get_map_rotation(config_with_team, default_layers, engine='numpy')
+            assert mock_error.call_count == 5
+        assert len(rotation) == 5
+        assert all('US' in [layer['team1'], layer['team2']] for layer in rotation)
+
+        with pytest.raises(ValueError):
+            squad_map_randomizer.get_map_rotation(config_with_team, default_layers, engine='numpy', solver='backtrack')
+
+    def test_get_map_rotation_numpy_missing(self, default_config, default_layers):
+        """ Tests that the numpy engine falls back to the python engine when NumPy is not installed. """
+        with mock.patch('squad_map_randomizer._import_numpy', return_value=None), \
+                mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            rotation = squad_map_randomizer.get_map_rotation(default_config, default_layers, engine='numpy')
+            assert mock_warning.call_count == 1
+        assert len(rotation) == 22
+
+        # Generating many rotations only warns once.
+        with mock.patch('squad_map_randomizer._import_numpy', return_value=None), \
+                mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            rotations = squad_map_randomizer.generate_rotations(default_config, default_layers, 5, seed=1, workers=1,
+                                                                engine='numpy')
+            assert mock_warning.call_count == 1
+            squad_map_randomizer.analyze_fairness(default_config, default_layers, 5, workers=1, engine='numpy')
+            assert mock_warning.call_count == 2
+        assert rotations == squad_map_randomizer.generate_rotations(default_config, default_layers, 5, seed=1,
+                                                                    workers=1)
+
+    def test_startup(self):
+        """ Tests that importing the script loads no heavy dependencies and stays within the startup time budget. """
+        code = ('import sys, time\n'
+                'start = time.perf_counter()\n'
+                'import squad_map_randomizer\n'
+                'print(time.perf_counter() - start)\n'
+                'print(" ".join(sys.modules))\n')
+        output = subprocess.run([sys.executable, '-c', code], cwd=squad_map_randomizer.CURRENT_DIR, check=True,
+                                capture_output=True, text=True).stdout.splitlines()
+        import_seconds, modules = float(output[0]), set(output[1].split())
+        assert not modules & HEAVY_MODULES
+        assert import_seconds < STARTUP_BUDGET_SECONDS
+
+    def test_get_map_rotation_seeded(self, default_config, default_layers):
+        """ Tests that rotations chosen with seeded random number generators are reproducible. """
+        rotation = squad_map_randomizer.get_map_rotation(default_config, default_layers, rng=random.Random(42))
+        for solver in squad_map_randomizer.SOLVERS:
+            assert (squad_map_randomizer.get_map_rotation(default_config, default_layers, solver=solver,
+                                                          rng=random.Random(7)) ==
+                    squad_map_randomizer.get_map_rotation(default_config, default_layers, solver=solver,
+                                                          rng=random.Random(7)))
+        # The rotation does not depend on the global random state.
+        random.seed(1)
+        assert squad_map_randomizer.get_map_rotation(default_config, default_layers, rng=random.Random(42)) == rotation
+
+    def test_get_cached_map_rotation(self, default_config, default_layers, tmp_path):
+        """ Tests that seeded rotations are cached on disk, and the least recently used ones are evicted. """
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        rotation = squad_map_randomizer.get_cached_map_rotation(default_config, layer_index, 1, tmp_path)
+        assert rotation == squad_map_randomizer.get_map_rotation(default_config, default_layers, rng=random.Random(1))
+
+        # The same seed, config and layers are loaded from the cache.
+        with mock.patch('squad_map_randomizer.get_map_rotation') as mock_get_map_rotation:
+            assert squad_map_randomizer.get_cached_map_rotation(default_config, layer_index, 1, tmp_path) == rotation
+            assert mock_get_map_rotation.call_count == 0
+
+        # A different seed, config, layers or solver is a different rotation.
+        other_index = squad_map_randomizer.LayerIndex(default_layers[:-1])
+        keys = {squad_map_randomizer.get_rotation_cache_key(default_config, layer_index, 1),
+                squad_map_randomizer.get_rotation_cache_key(default_config, layer_index, 2),
+                squad_map_randomizer.get_rotation_cache_key({'regular_maps': ['any']}, layer_index, 1),
+                squad_map_randomizer.get_rotation_cache_key(default_config, other_index, 1),
+                squad_map_randomizer.get_rotation_cache_key(default_config, layer_index, 1, solver='backtrack')}
+        assert len(keys) == 5
+
+        # Only the most recently used rotations are kept.
+        rotations_dir = tmp_path / 'rotations'
+        os.utime(next(rotations_dir.iterdir()), ns=(0, 0))
+        for seed in range(2, 5):
+            squad_map_randomizer.get_cached_map_rotation(default_config, layer_index, seed, tmp_path, max_entries=2)
+        assert len(list(rotations_dir.iterdir())) == 2
+        with mock.patch('squad_map_randomizer.get_map_rotation') as mock_get_map_rotation:
+            squad_map_randomizer.get_cached_map_rotation(default_config, layer_index, 4, tmp_path)
+            assert mock_get_map_rotation.call_count == 0
+            squad_map_randomizer.get_cached_map_rotation(default_config, layer_index, 1, tmp_path)
+            assert mock_get_map_rotation.call_count == 1
+
+    def test_play_history(self, default_layers, tmp_path):
+        """ Tests that the play history returns only the recent rotations, reading backwards from the end. """
+        history_path = tmp_path / 'history.jsonl'
+        now = datetime.datetime(2020, 6, 10, 12, tzinfo=datetime.timezone.utc)
+        assert squad_map_randomizer.read_play_history(history_path, 2, now=now) == []
+        history_path.write_text('')
+        assert squad_map_randomizer.read_play_history(history_path, 2, now=now) == []
+
+        # An invalid line before the recent window is never read, so it is never warned about.
+        history_path.write_text('not json\n')
+        for days_ago, server in [(5, 'a'), (3, 'a'), (1, 'b'), (1, 'a'), (0, 'a')]:
+            squad_map_randomizer.append_play_history(history_path, default_layers[days_ago:days_ago + 2], server,
+                                                     played_at=now - datetime.timedelta(days=days_ago))
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            entries = squad_map_randomizer.read_play_history(history_path, 2, now=now)
+            assert mock_warning.call_count == 0
+        assert [entry['server'] for entry in entries] == ['b', 'a', 'a']
+        assert entries[-1]['layers'] == squad_map_randomizer.get_layers(default_layers[0:2])
+        assert entries[-1]['maps'] == [layer['map'] for layer in default_layers[0:2]]
+        assert len(squad_map_randomizer.read_play_history(history_path, 2, server='a', now=now)) == 2
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            assert len(squad_map_randomizer.read_play_history(history_path, 10, now=now)) == 5
+            assert mock_warning.call_count == 1
+
+        # Timestamps without a timezone (written by hand, or given as naive datetimes) are in UTC.
+        history_path.write_text(json.dumps({'played_at': '2020-06-09T12:00:00', 'layers': [], 'maps': []}) + '\n')
+        squad_map_randomizer.append_play_history(history_path, default_layers[:1],
+                                                 played_at=datetime.datetime(2020, 6, 10, 11))
+        assert json.loads(history_path.read_text().splitlines()[-1])['played_at'] == '2020-06-10T11:00:00+00:00'
+        assert len(squad_map_randomizer.read_play_history(history_path, 2, now=now)) == 2
+        assert len(squad_map_randomizer.read_play_history(history_path, 0.5, now=now.replace(tzinfo=None))) == 1
+
+        # Rotations generated with the given seed are not avoided.
+        history_path.write_text('')
+        squad_map_randomizer.append_play_history(history_path, default_layers[:2], seed=1)
+        squad_map_randomizer.append_play_history(history_path, default_layers[2:3], seed=2)
+        assert squad_map_randomizer.get_recently_played(history_path, 1, seed=1) == {
+            'played_layers': [default_layers[2]['layer']], 'played_maps': [default_layers[2]['map']]}
+        assert len(squad_map_randomizer.get_recently_played(history_path, 1)['played_maps']) == 3
+
+    @pytest.mark.parametrize('solver,engine', [('greedy', 'python'), ('backtrack', 'python'), ('greedy', 'numpy')])
+    def test_get_map_rotation_played(self, default_config, default_layers, solver, engine):
+        """ Tests that rotations avoid recently played layers, and recently played maps at their start. """
+        if engine == 'numpy':
+            pytest.importorskip('numpy')
+        for seed in range(10):
+            played_rotation = squad_map_randomizer.get_map_rotation(default_config, default_layers,
+                                                                    rng=random.Random(seed))
+            played_maps = [layer['map'] for layer in played_rotation]
+            rotation = squad_map_randomizer.get_map_rotation(
+                default_config, default_layers, solver=solver, engine=engine, rng=random.Random(seed),
+                played_layers=squad_map_randomizer.get_layers(played_rotation), played_maps=played_maps)
+            assert len(rotation) == 22
+            assert not set(squad_map_randomizer.get_layers(rotation)) & set(
+                squad_map_randomizer.get_layers(played_rotation))
+            assert not has_close_duplicate_maps(played_rotation[-3:] + rotation,
+                                                squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+
+    @pytest.mark.parametrize('solver,engine', [('greedy', 'python'), ('backtrack', 'python'), ('greedy', 'numpy')])
+    @pytest.mark.parametrize('weighted', [False, True])
+    def test_get_map_rotation_played_duplicates(self, solver, engine, weighted):
+        """ Tests that recently played layers are chosen over layers that would break the duplicate map rule. """
+        if engine == 'numpy':
+            pytest.importorskip('numpy')
+        layers = [squad_map_randomizer.Layer({'map': map_name, 'layer': layer_name})
+                  for map_name, layer_name in [('A', 'A1'), ('A', 'A2'), ('B', 'B1')]]
+        config = {'regular_maps': ['any', 'any']}
+        if weighted:
+            config['weights'] = [{'map': 'A', 'weight': 2}]
+        for seed in range(10):
+            with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+                rotation = squad_map_randomizer.get_map_rotation(config, layers, solver=solver, engine=engine,
+                                                                 rng=random.Random(seed), played_layers=['B1'])
+                mock_error.assert_not_called()
+            assert sorted(layer['map'] for layer in rotation) == ['A', 'B']
+
+    def test_alias_table(self):
+        """ Tests that alias tables draw ids by weight, and weighted samplers only return ids left in the pool. """
+        weights = [0.0, 1.0, 2.0, 7.0]
+        alias_table = squad_map_randomizer.AliasTable.from_weights([1, 2, 3], weights)
+        rng = random.Random(0)
+        counts = collections.Counter(alias_table.draw(rng) for _ in range(10000))
+        assert set(counts) == {1, 2, 3}
+        assert 600 < counts[1] < 1400 and 1600 < counts[2] < 2400 and 6500 < counts[3] < 7500
+
+        pool = squad_map_randomizer.LayerPool(4)
+        sampler = squad_map_randomizer.WeightedSampler(alias_table, weights)
+        pool.remove(3)
+        assert all(sampler.sample(rng, pool) in {1, 2} for _ in range(50))
+        # After too many rejections, the table is pruned to the ids that are left.
+        assert sampler.sample(rng, pool, is_valid=lambda layer_id: False) is None
+        assert sampler.alias_table.ids == (1, 2)
+        assert sampler.sample(rng, pool, is_valid=lambda layer_id: layer_id != 2) == 1
+        pool.remove(1)
+        pool.remove(2)
+        assert sampler.sample(rng, pool) is None
+
+    @pytest.mark.parametrize('solver,engine', [('greedy', 'python'), ('backtrack', 'python'), ('greedy', 'numpy')])
+    def test_get_map_rotation_weighted(self, default_layers, solver, engine):
+        """ Tests that layers are chosen in proportion to their weights from the config and the layers themselves. """
+        if engine == 'numpy':
+            pytest.importorskip('numpy')
+        config = {'regular_maps': [{'gamemode': ['AAS', 'RAAS']}], 'weights': [{'gamemode': 'RAAS', 'weight': 9}]}
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        num_aas = sum(map(is_aas, default_layers))
+        num_raas = sum(map(is_raas, default_layers))
+        expected_raas_share = 9 * num_raas / (9 * num_raas + num_aas)
+        rng = random.Random(0)
+        rotations = [squad_map_randomizer.get_map_rotation(config, default_layers, layer_index=layer_index,
+                                                           solver=solver, engine=engine, rng=rng)
+                     for _ in range(1000)]
+        raas_share = sum(is_raas(rotation[0]) for rotation in rotations) / len(rotations)
+        assert abs(raas_share - expected_raas_share) < 0.05
+
+        # A 'weight' field in the layers multiplies the config's weights (and invalid ones are ignored).
+        weighted_layers = [dict(layer, weight=0 if is_aas(layer) else 1) for layer in default_layers]
+        assert squad_map_randomizer.LayerIndex(weighted_layers).weights() is None
+        weighted_layers = [dict(layer, weight=10) if layer['map'] == 'Narva' else layer for layer in default_layers]
+        weights = squad_map_randomizer.LayerIndex(weighted_layers).weights(
+            squad_map_randomizer.compile_config(config).weights)
+        for layer, weight in zip(weighted_layers, weights):
+            assert weight == (10 if layer['map'] == 'Narva' else 1) * (9 if is_raas(layer) else 1)
+
+        # Weighted rotations still follow the global filter rules.
+        rotation = squad_map_randomizer.get_map_rotation(
+            dict(config, number_of_repeats=30), weighted_layers, solver=solver, engine=engine, rng=rng)
+        assert len(rotation) == 30
+        assert not has_duplicate_layers(rotation)
+        assert not has_close_duplicate_maps(rotation, squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+
+    def test_iter_map_rotation(self, default_config, default_layers, tmp_path):
+        """ Tests that streamed rotations match get_map_rotation, and are written atomically. """
+        rotation = squad_map_randomizer.get_map_rotation(default_config, default_layers, rng=random.Random(4))
+        layers_iterator = squad_map_randomizer.iter_map_rotation(default_config, default_layers, rng=random.Random(4))
+        assert next(layers_iterator) is rotation[0]
+        assert [rotation[0]] + list(layers_iterator) == rotation
+
+        rotation_path = tmp_path / 'MapRotation.cfg'
+        squad_map_randomizer.write_rotation(
+            squad_map_randomizer.iter_map_rotation(default_config, default_layers, rng=random.Random(4)), rotation_path)
+        assert rotation_path.read_text() == squad_map_randomizer.get_layers_string(rotation)
+
+        # A rotation that fails halfway leaves the old rotation in place (and no temporary file).
+        def failing_rotation():
+            yield rotation[1]
+            raise RuntimeError('Something went wrong!')
+
+        with pytest.raises(RuntimeError):
+            squad_map_randomizer.write_rotation(failing_rotation(), rotation_path)
+        assert rotation_path.read_text() == squad_map_randomizer.get_layers_string(rotation)
+        assert os.listdir(tmp_path) == ['MapRotation.cfg']
+
+    def test_reroll_rotation(self, default_config, default_layers, tmp_path):
+        """ Tests that re-rolling only changes the given positions, and the new layers follow every rule. """
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        plan = squad_map_randomizer.compile_config(default_config)
+        rotation_path = tmp_path / 'MapRotation.cfg'
+        for seed in range(20):
+            rotation = squad_map_randomizer.get_map_rotation(default_config, default_layers, rng=random.Random(seed))
+            squad_map_randomizer.write_rotation(rotation, rotation_path)
+            assert squad_map_randomizer.read_rotation(rotation_path, layer_index) == rotation
+
+            positions = [0, 5, 6, 21]
+            rerolled = squad_map_randomizer.reroll_rotation(rotation, positions, default_config, default_layers,
+                                                            layer_index=layer_index, rng=random.Random(seed))
+            for position, (old_layer, new_layer) in enumerate(zip(rotation, rerolled)):
+                if position in positions:
+                    assert new_layer is not old_layer
+                    assert plan.slots()[position].matches(new_layer)
+                else:
+                    assert new_layer is old_layer
+            assert not set(squad_map_randomizer.get_layers(rerolled)) & {rotation[p]['layer'] for p in positions}
+            assert not has_duplicate_layers(rerolled)
+            assert not has_close_duplicate_maps(rerolled, squad_map_randomizer.NUM_MIN_LAYERS_BEFORE_DUPLICATE_MAP)
+
+        with pytest.raises(ValueError):
+            squad_map_randomizer.reroll_rotation(rotation, [22], default_config, default_layers)
+        with pytest.raises(ValueError):
+            squad_map_randomizer.reroll_rotation(rotation[:-1], [0], default_config, default_layers)
+
+        # On the commandline, positions start from 1 and positions out of range are reported without re-rolling.
+        for position in ['0', '-1', 'first']:
+            with mock.patch('sys.argv', ['squad_map_randomizer.py', '--reroll', position]), \
+                    mock.patch('sys.stderr'), pytest.raises(SystemExit):
+                squad_map_randomizer.parse_cli()
+        with mock.patch('sys.argv', ['squad_map_randomizer.py', '--reroll', '1', '23', '-o', str(rotation_path)]):
+            args = squad_map_randomizer.parse_cli()
+        assert args.reroll == [1, 23]
+        with mock.patch('squad_map_randomizer.get_layer_index', return_value=layer_index), \
+                mock.patch('squad_map_randomizer.logging.error') as mock_error, pytest.raises(SystemExit):
+            squad_map_randomizer.run(args)
+        assert 'Positions [23] are out of range' in mock_error.call_args[0][0]
+        assert squad_map_randomizer.read_rotation(rotation_path, layer_index) == rotation
+
+        rotation_path.write_text('// A comment\nNot A Layer v1\n')
+        with pytest.raises(ValueError):
+            squad_map_randomizer.read_rotation(rotation_path, layer_index)
+
+    def test_get_numbered_filepath(self):
+        """ Tests that batch output filepaths are numbered and zero-padded. """
+        assert (squad_map_randomizer.get_numbered_filepath('/tmp/MapRotation.cfg', 3, 30) ==
+                squad_map_randomizer.pathlib.Path('/tmp/MapRotation_03.cfg'))
+
+    def test_run_fleet(self, default_layers, tmp_path):
+        """ Tests that run_fleet writes a rotation for every server with a valid config and skips the others. """
+        invalid_config_path = tmp_path / 'invalid_config.yml'
+        invalid_config_path.write_text('regular_maps:\n  - THIS_DOES_NOT_EXIST: 1\n')
+        manifest_path = tmp_path / 'fleet.yml'
+        manifest_path.write_text(yaml.safe_dump({'servers': [
+            {'config': str(squad_map_randomizer.DEFAULT_CONFIG_FILEPATH), 'output': 'server1.cfg',
+             'discord_webhook_url': 'https://example.com/webhook'},
+            {'config': str(invalid_config_path), 'output': 'server2.cfg'},
+            {'config': str(squad_map_randomizer.EXAMPLES_CONFIG_DIR / 'any_three_maps.yml'), 'output': 'server3.cfg'},
+        ]}))
+
+        with mock.patch('squad_map_randomizer.DiscordPoster.post') as mock_send, \
+                mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            rotations = squad_map_randomizer.run_fleet(manifest_path, default_layers, workers=2)
+            assert mock_error.call_count == 1
+            assert mock_send.call_count == 2
+            mock_send.assert_any_call(rotations[tmp_path / 'server1.cfg'], 'https://example.com/webhook')
+
+        # Relative output paths are relative to the manifest.
+        assert set(rotations) == {tmp_path / 'server1.cfg', tmp_path / 'server3.cfg'}
+        assert not (tmp_path / 'server2.cfg').exists()
+        assert len((tmp_path / 'server1.cfg').read_text().splitlines()) == 22
+        assert (tmp_path / 'server3.cfg').read_text() == squad_map_randomizer.get_layers_string(
+            rotations[tmp_path / 'server3.cfg'])
+
+        # With a play history, each server avoids the layers it played before.
+        history_path = tmp_path / 'history.jsonl'
+        with mock.patch('squad_map_randomizer.DiscordPoster.post'), mock.patch('squad_map_randomizer.logging.error'):
+            first_rotations = squad_map_randomizer.run_fleet(manifest_path, default_layers, workers=1,
+                                                             history_path=history_path)
+            second_rotations = squad_map_randomizer.run_fleet(manifest_path, default_layers, workers=1,
+                                                              history_path=history_path)
+        entries = squad_map_randomizer.read_play_history(history_path, 1)
+        assert [entry['server'] for entry in entries] == ['default_config', 'any_three_maps'] * 2
+        first_layers = set(squad_map_randomizer.get_layers(first_rotations[tmp_path / 'server1.cfg']))
+        assert not first_layers & set(squad_map_randomizer.get_layers(second_rotations[tmp_path / 'server1.cfg']))
+
+        # A manifest without servers is invalid.
+        manifest_path.write_text('servers: []\n')
+        with pytest.raises(squad_map_randomizer.InvalidConfigException):
+            squad_map_randomizer.run_fleet(manifest_path, default_layers)
+        manifest_path.write_text('servers:\n  - config: only_a_config.yml\n')
+        with pytest.raises(squad_map_randomizer.InvalidConfigException):
+            squad_map_randomizer.run_fleet(manifest_path, default_layers)
+
+    def test_get_discord_messages(self, default_layers):
+        """ Tests that long rotations are split into several Discord messages under the length limit. """
+        messages = squad_map_randomizer.get_discord_messages(default_layers[:5])
+        assert len(messages) == 1
+        assert messages[0].startswith('The map rotation for ')
+        assert messages[0].endswith('```' + squad_map_randomizer.get_layers_string(default_layers[:5]) + '```')
+
+        long_rotation = default_layers * 3
+        messages = squad_map_randomizer.get_discord_messages(long_rotation)
+        assert len(messages) > 1
+        assert all(len(message) <= squad_map_randomizer.DISCORD_MESSAGE_MAX_LENGTH for message in messages)
+        assert all(message.endswith('```') for message in messages)
+        # Every layer is in exactly one message, in order.
+        layers = [line.strip('`') for message in messages for line in message.split('```', 1)[1].splitlines()]
+        assert layers == squad_map_randomizer.get_layers(long_rotation)
+
+    @mock.patch('squad_map_randomizer.DISCORD_RETRY_BACKOFF_SECONDS', 0)
+    def test_post_to_discord_webhook(self, default_layers, discord_server):
+        """ Tests that posts to Discord retry after rate limits and errors, and report each webhook's outcome. """
+        base_url, received, _ = discord_server
+        messages = ['first', 'second']
+
+        outcome = squad_map_randomizer.post_to_discord_webhook(f'{base_url}/ok', messages)
+        assert outcome == (f'{base_url}/ok', True, 2, 2, None)
+        assert received == [('/ok', 'first'), ('/ok', 'second')]
+
+        # The rate limited message is posted again after waiting, and in order.
+        outcome = squad_map_randomizer.post_to_discord_webhook(f'{base_url}/ratelimited', messages)
+        assert outcome.ok and outcome.attempts == 3
+        assert received[2:] == [('/ratelimited', 'first'), ('/ratelimited', 'second')]
+
+        # Rejected messages are not retried, and server errors are retried until giving up.
+        outcome = squad_map_randomizer.post_to_discord_webhook(f'{base_url}/bad', messages)
+        assert not outcome.ok and outcome.attempts == 1 and outcome.error.code == 400
+        outcome = squad_map_randomizer.post_to_discord_webhook(f'{base_url}/error', messages, max_retries=2)
+        assert not outcome.ok and outcome.attempts == 3 and outcome.messages_sent == 0
+
+        # The poster posts in the background, to several webhooks at once, and logs the failures.
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            with squad_map_randomizer.DiscordPoster() as poster:
+                futures = poster.post(default_layers[:5], [f'{base_url}/ok', f'{base_url}/bad'])
+            assert [future.result().ok for future in futures] == [True, False]
+            assert mock_error.call_count == 1
+            # The webhook token is not logged.
+            assert f'{base_url}/...' in mock_error.call_args[0][0]
+
+        outcomes = squad_map_randomizer.send_rotation_to_discord(default_layers[:5], f'{base_url}/ok')
+        assert [outcome.ok for outcome in outcomes] == [True]
+        assert squad_map_randomizer.send_rotation_to_discord(default_layers[:5], None) == []
+
+    def test_run_fleet_does_not_wait_on_discord(self, default_layers, discord_server, tmp_path):
+        """ Tests that run_fleet writes every rotation before a slow Discord webhook responds. """
+        base_url, received, slow_event = discord_server
+        manifest_path = tmp_path / 'fleet.yml'
+        manifest_path.write_text(yaml.safe_dump({'servers': [
+            {'config': str(squad_map_randomizer.DEFAULT_CONFIG_FILEPATH), 'output': f'server{number}.cfg',
+             'discord_webhook_url': [f'{base_url}/slow', f'{base_url}/ok']}
+            for number in range(3)]}))
+
+        def write_rotation(map_rotation, output_filepath):
+            # Every rotation is written before the slow webhook is allowed to respond.
+            assert not slow_event.is_set()
+            original_write_rotation(map_rotation, output_filepath)
+
+        original_write_rotation = squad_map_randomizer.write_rotation
+        with mock.patch('squad_map_randomizer.write_rotation', side_effect=write_rotation):
+            threading.Timer(0.5, slow_event.set).start()
+            rotations = squad_map_randomizer.run_fleet(manifest_path, default_layers, workers=1)
+        assert len(rotations) == 3
+        assert len([path for path, _ in received if path == '/slow']) == 3
+
+    def test_rotation_service(self, default_layers, tmp_path):
+        """ Tests that RotationService reloads only what changed and serves rotations over its HTTP API. """
+        layers_path = tmp_path / 'layers.json'
+        layers_path.write_text(json.dumps([layer.to_dict() for layer in default_layers]))
+        config_path = tmp_path / 'config.yml'
+        config_path.write_text('regular_maps:\n  - gamemode: AAS\nnumber_of_repeats: 3\n')
+        servers = [
+            {'name': 'default', 'config': squad_map_randomizer.DEFAULT_CONFIG_FILEPATH},
+            {'name': 'aas', 'config': config_path, 'output': tmp_path / 'aas.cfg'},
+        ]
+        service = squad_map_randomizer.RotationService(servers, input_filepath=str(layers_path),
+                                                       cache_dir=tmp_path / 'cache')
+        assert service.names == ['default', 'aas']
+        assert len(service.get_rotation('default')) == 22
+        with pytest.raises(KeyError):
+            service.get_rotation('missing')
+
+        # Nothing changed, so nothing is parsed again.
+        with mock.patch('squad_map_randomizer.parse_config') as mock_parse:
+            assert service.reload() == []
+            assert mock_parse.call_count == 0
+
+        # Only the changed config is parsed again.
+        config_path.write_text('regular_maps:\n  - gamemode: RAAS\nnumber_of_repeats: 4\n')
+        os.utime(config_path, ns=(0, 0))
+        assert service.reload() == [str(config_path)]
+        rotation = service.get_rotation('aas')
+        assert len(rotation) == 4 and all(is_raas(layer) for layer in rotation)
+
+        # Changed layers are loaded again, and every config is validated against them.
+        fewer_layers = [layer for layer in default_layers if layer['map'] != default_layers[0]['map']]
+        layers_path.write_text(json.dumps([layer.to_dict() for layer in fewer_layers]))
+        with mock.patch('squad_map_randomizer.logging.error') as mock_error:
+            assert len(service.reload()) == 2
+            assert mock_error.call_count == 0
+        assert service.layer_index.layers == fewer_layers
+        assert default_layers[0]['map'] not in {layer['map'] for layer in service.get_rotation('default')}
+
+        # Rotations are served while the layers are being loaded again.
+        loading, loaded = threading.Event(), threading.Event()
+
+        def slow_get_layer_index(*args, **kwargs):
+            loading.set()
+            loaded.wait(5)
+            return squad_map_randomizer.LayerIndex(fewer_layers)
+
+        os.utime(layers_path, ns=(0, 0))
+        with mock.patch('squad_map_randomizer.get_layer_index', side_effect=slow_get_layer_index):
+            reload_thread = threading.Thread(target=service.reload)
+            reload_thread.start()
+            assert loading.wait(5)
+            assert len(service.get_rotation('aas')) == 4
+            assert reload_thread.is_alive()
+            loaded.set()
+            reload_thread.join()
+
+        # Scheduled rotations are written for servers with an output.
+        service.write_rotations()
+        assert (tmp_path / 'aas.cfg').exists()
+        assert not (tmp_path / 'default.cfg').exists()
+
+        # The HTTP API serves the same rotations.
+        server = squad_map_randomizer.make_service_server(service, 'localhost:0')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://localhost:{server.server_address[1]}'
+        try:
+            with request.urlopen(f'{base_url}/configs') as response:
+                assert json.load(response) == ['default', 'aas']
+            with request.urlopen(f'{base_url}/rotation?config=default') as response:
+                assert len(response.read().decode('utf-8').splitlines()) == 22
+            with request.urlopen(f'{base_url}/rotation?config=aas&format=json') as response:
+                assert len(json.load(response)) == 4
+            with request.urlopen(f'{base_url}/rotation?config=default&format=json&seed=5') as response:
+                assert json.load(response) == squad_map_randomizer.get_layers(service.get_rotation('default', 5))
+            with pytest.raises(error.HTTPError) as e:
+                request.urlopen(f'{base_url}/rotation?config=missing')
+            assert e.value.code == 404
+            with request.urlopen(request.Request(f'{base_url}/reload', method='POST')) as response:
+                assert json.load(response) == []
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.stop()
+
+    def test_rotation_service_url(self, layers_server):
+        """ Tests that without a cache, RotationService checks whether downloaded layers changed without a download. """
+        _, url, requests_headers = layers_server
+        servers = [{'name': 'default', 'config': squad_map_randomizer.DEFAULT_CONFIG_FILEPATH}]
+        with mock.patch('squad_map_randomizer.logging.error'):
+            service = squad_map_randomizer.RotationService(servers, input_url=url, cache_dir=None)
+        try:
+            assert len(service.layer_index) == 1
+            assert len(requests_headers) == 1
+            service.reload()
+            assert len(requests_headers) == 1
+        finally:
+            service.stop()
+
     def test_get_map_rotation_any(self, default_layers):
         """ Tests that we can call get_map_rotation correctly with a config with the 'any' keyword. """
         # Test case with a config containing the special 'any' keyword (signifying no filters for this layer).
@@ -260,13 +1053,310 @@ class TestSquadMapRandomizer:
             assert all(layer['team1'] == 'US' or layer['team2']
                        == 'US' for layer in rotation)
 
+    def test_get_json_layers_cache(self, layers_server, tmp_path):
+        """ Tests that layers fetched from a URL are cached, revalidated with their ETag, and used when offline. """
+        server, url, requests_headers = layers_server
+        # The first fetch downloads the layers (without the bugged layer).
+        layers = squad_map_randomizer.get_json_layers(None, url, cache_dir=tmp_path)
+        assert [layer['layer'] for layer in layers] == ['Al Basrah AAS v1']
+        assert len(requests_headers) == 1
+
+        # A fresh cache is used without asking the server.
+        assert squad_map_randomizer.get_json_layers(None, url, cache_dir=tmp_path) == layers
+        assert len(requests_headers) == 1
+
+        # A stale cache is revalidated with the ETag, and the server says it didn't change.
+        assert squad_map_randomizer.get_json_layers(None, url, cache_dir=tmp_path, max_age=0) == layers
+        assert len(requests_headers) == 2
+        assert requests_headers[1]['If-None-Match'] == '"layers-v1"'
+
+        # A cache directory that can't be created only gives warnings, and the layers are still loaded.
+        not_a_dir = tmp_path / 'not_a_dir'
+        not_a_dir.write_text('')
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            layer_index = squad_map_randomizer.get_layer_index(None, url, cache_dir=not_a_dir / 'cache')
+            assert layer_index.layers == layers
+            assert any('Could not cache the download' in args[0][0] for args in mock_warning.call_args_list)
+        assert len(requests_headers) == 3
+
+        # Cache metadata without a valid fetch time is a cache miss, so the layers are downloaded again.
+        (metadata_path,) = tmp_path.glob('*.json')
+        for metadata in [{'url': url, 'etag': '"layers-v1"'}, {'url': url, 'fetched_at': 'yesterday'}, []]:
+            metadata_path.write_text(json.dumps(metadata))
+            assert squad_map_randomizer.get_json_layers(None, url, cache_dir=tmp_path) == layers
+            assert 'If-None-Match' not in requests_headers[-1]
+            assert isinstance(json.loads(metadata_path.read_text())['fetched_at'], float)
+        assert len(requests_headers) == 6
+
+        # When the server is down, the cached copy is used with a warning.
+        server.shutdown()
+        server.server_close()
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            assert squad_map_randomizer.get_json_layers(None, url, cache_dir=tmp_path, max_age=0, timeout=1) == layers
+            assert mock_warning.call_count == 1
+
+        # Without a cache, the error is raised.
+        with pytest.raises(error.URLError):
+            squad_map_randomizer.get_json_layers(None, url, cache_dir=None, timeout=1)
+
+    def test_get_layer_index_snapshot(self, default_layers, tmp_path):
+        """ Tests that layers are loaded from an up to date snapshot, and the snapshot is rebuilt when it is stale. """
+        layers_path = tmp_path / 'layers.json'
+        layers_path.write_text(json.dumps([layer.to_dict() for layer in default_layers]))
+        snapshot_path = tmp_path / 'layers.json.snapshot'
+
+        # The first load parses the JSON and writes the snapshot.
+        layer_index = squad_map_randomizer.get_layer_index(str(layers_path), None)
+        assert layer_index.layers == default_layers
+        assert snapshot_path.exists()
+
+        # The next load maps the snapshot without parsing any JSON, and gives a working index with interned strings.
+        with mock.patch('squad_map_randomizer.parse_json_layers') as mock_parse:
+            snapshot_index = squad_map_randomizer.get_layer_index(str(layers_path), None)
+            assert mock_parse.call_count == 0
+        assert snapshot_index.schema.filter_keys == layer_index.schema.filter_keys
+        assert snapshot_index.schema.domains == layer_index.schema.domains
+        assert snapshot_index.layers_hash == layer_index.layers_hash
+        # The layers are only built when they are used (and are sent to worker processes as a plain list).
+        assert isinstance(snapshot_index.layers, squad_map_randomizer.SnapshotLayers)
+        assert snapshot_index.layers[-1] == default_layers[-1] and snapshot_index.layers[:2] == default_layers[:2]
+        assert pickle.loads(pickle.dumps(snapshot_index.layers)) == default_layers
+        assert snapshot_index.layers == default_layers
+        assert snapshot_index.filter_ids({'map_size': 'large'}) == layer_index.filter_ids({'map_size': 'large'})
+        assert all(snapshot_index.id_of(layer) == i for i, layer in enumerate(snapshot_index.layers))
+        same_map_layers = [layer for layer in snapshot_index.layers if layer['map'] == 'Chora']
+        assert same_map_layers[0]['map'] is same_map_layers[1]['map']
+
+        # Changing the layers file makes the snapshot stale, so it is rebuilt.
+        layers_path.write_text(json.dumps([layer.to_dict() for layer in default_layers[:10]]))
+        assert squad_map_randomizer.get_layer_index(str(layers_path), None).layers == default_layers[:10]
+        with mock.patch('squad_map_randomizer.parse_json_layers') as mock_parse:
+            assert squad_map_randomizer.get_layer_index(str(layers_path), None).layers == default_layers[:10]
+            assert mock_parse.call_count == 0
+
+        # A corrupt snapshot is ignored and rebuilt.
+        snapshot_path.write_bytes(b'garbage')
+        assert squad_map_randomizer.get_layer_index(str(layers_path), None).layers == default_layers[:10]
+        # So is a truncated one.
+        stat = os.stat(layers_path)
+        source_key = f'{stat.st_mtime_ns}:{stat.st_size}'
+        assert squad_map_randomizer.read_layers_snapshot(snapshot_path, source_key).layers == default_layers[:10]
+        snapshot_path.write_bytes(snapshot_path.read_bytes()[:-8])
+        assert squad_map_randomizer.read_layers_snapshot(snapshot_path, source_key) is None
+        assert squad_map_randomizer.read_layers_snapshot(snapshot_path, 'wrong key') is None
+
+    def test_layer(self):
+        """ Tests that Layer behaves like a read-only dict of its fields while using less memory. """
+        fields = {'map': 'Al Basrah', 'layer': 'Al Basrah AAS v1', 'gamemode': 'AAS', 'team1': 'US', 'team2': 'INS',
+                  'helicopters': False, 'bugged': False, 'map_size': 'medium', 'custom_field': 7}
+        layer = squad_map_randomizer.Layer(fields)
+        assert layer == fields
+        assert layer.to_dict() == fields
+        assert list(layer) == list(fields)
+        assert len(layer) == len(fields)
+        assert layer['custom_field'] == 7
+        assert layer.get('helicopters') is False
+
+        # Missing fields (standard or not) behave like missing dict keys.
+        assert layer.get('night') is None and layer.get('not a field', 'default') == 'default'
+        with pytest.raises(KeyError):
+            layer['night']
+        with pytest.raises(KeyError):
+            layer['not a field']
+        assert 'night' not in layer and 'map' in layer
+
+        # String values are interned, so equal values are the same object.
+        other_layer = squad_map_randomizer.Layer({'map': ''.join(['Al ', 'Basrah'])})
+        assert other_layer['map'] is layer['map']
+
+        # A layer has no per-instance dict.
+        assert not hasattr(layer, '__dict__')
+
+    def test_layer_index(self, default_layers):
+        """ Tests that LayerIndex filters the same layers as scanning every layer, without duplicating any layer. """
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        assert len(layer_index) == len(default_layers)
+
+        # The 'any' keyword matches every layer.
+        assert layer_index.filter_ids('any') == set(range(len(default_layers)))
+
+        # Multiple keys are "AND"ed together and multiple values are "OR"ed together.
+        filter_config = {'gamemode': ['AAS', 'RAAS'], 'map_size': 'large', 'helicopters': True}
+        expected_ids = {i for i, layer in enumerate(default_layers)
+                        if (is_aas(layer) or is_raas(layer)) and is_large_map(layer) and is_helicopters(layer)}
+        assert expected_ids
+        assert layer_index.filter_ids(filter_config) == expected_ids
+
+        # The 'team' key matches either team, and a layer where both teams match is only returned once.
+        team_ids = layer_index.filter_ids({'team': ['US', 'INS']})
+        assert team_ids == {i for i, layer in enumerate(default_layers)
+                            if layer['team1'] in ['US', 'INS'] or layer['team2'] in ['US', 'INS']}
+        assert any(default_layers[i]['team1'] in ['US', 'INS'] and default_layers[i]['team2'] in ['US', 'INS']
+                   for i in team_ids)
+
+        # Values that no layer has match nothing.
+        assert layer_index.filter_ids({'map': 'does not exist'}) == set()
+
+        # Layers can be mapped back to their ids.
+        assert all(layer_index.id_of(layer) == i for i, layer in enumerate(default_layers))
+
+    def test_layer_pool(self):
+        """ Tests that LayerPool removes ids in constant time and only ever returns ids that are still available. """
+        pool = squad_map_randomizer.LayerPool(5)
+        assert len(pool) == 5
+        pool.remove(0)
+        pool.remove(4)
+        assert len(pool) == 3
+        assert 0 not in pool and 4 not in pool and 2 in pool
+        with pytest.raises(KeyError):
+            pool.remove(0)
+
+        # Available candidates are found whether the pool or the candidates are the smaller set.
+        assert sorted(pool.available({0, 2})) == [2]
+        assert sorted(pool.available(set(range(5)))) == [1, 2, 3]
+
+        # Removing everything empties the pool.
+        for layer_id in [1, 2, 3]:
+            pool.remove(layer_id)
+        assert len(pool) == 0
+        assert pool.available(set(range(5))) == []
+
+    def test_compile_config(self, default_config, default_layers):
+        """ Tests that compiled configs are cached, reusable and give the same rotations as the raw config. """
+        plan = squad_map_randomizer.compile_config(default_config)
+        assert isinstance(plan, squad_map_randomizer.RotationPlan)
+        assert len(plan.slots()) == 22
+        # Compiling an equal config again returns the cached plan.
+        assert squad_map_randomizer.compile_config(dict(default_config)) is plan
+
+        # The compiled filters agree with the raw filters.
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        for filter_config, slot_filter in zip(default_config['regular_maps'], plan.regular_maps):
+            assert layer_index.candidate_ids(slot_filter) == layer_index.filter_ids(filter_config)
+            assert all(slot_filter.matches(default_layers[i]) for i in layer_index.candidate_ids(slot_filter))
+        assert squad_map_randomizer.compile_filter('ANY').matches(default_layers[0])
+
+        # Executing the plan gives the same rotation as executing the config it was compiled from.
+        random.seed(0)
+        rotation_from_config = squad_map_randomizer.get_map_rotation(default_config, default_layers)
+        random.seed(0)
+        rotation_from_plan = squad_map_randomizer.get_map_rotation(plan, default_layers, layer_index=layer_index)
+        assert rotation_from_config == rotation_from_plan
+
+    def test_run_metrics(self, default_layers, tmp_path):
+        """ Tests that RunMetrics collects the metrics recorded while generating rotations and writes them out. """
+        config = {'number_of_repeats': 2, 'regular_maps': [{'team': ['misspelled_name']}, {'map': 'Chora'}]}
+        with squad_map_randomizer.RunMetrics() as metrics, mock.patch('squad_map_randomizer.logging.error'):
+            with squad_map_randomizer.timed_stage('generate'):
+                squad_map_randomizer.get_map_rotation(config, default_layers)
+        # The hook is unregistered after the with block.
+        squad_map_randomizer.record_metric('ignored', 1)
+
+        names = [name for _, name, _, _ in metrics.samples]
+        assert 'ignored' not in names
+        assert names.count('slot_candidates') == 4
+        assert names.count('skipped_slots_total') == 2
+        slot_candidates = [(labels['slot'], value) for _, name, value, labels in metrics.samples
+                           if name == 'slot_candidates']
+        assert slot_candidates[0] == (0, 0) and slot_candidates[1][1] > 0
+
+        # The metrics can be written as JSON lines.
+        json_path = tmp_path / 'metrics.jsonl'
+        metrics.write(json_path)
+        lines = [json.loads(line) for line in json_path.read_text().splitlines()]
+        assert len(lines) == len(metrics.samples)
+        assert lines[-1]['name'] == 'stage_seconds' and lines[-1]['labels'] == {'stage': 'generate'}
+
+        # Or as a Prometheus textfile, where counters are summed (and always present).
+        prometheus_path = tmp_path / 'metrics.prom'
+        metrics.write(prometheus_path, 'prometheus')
+        prometheus_lines = prometheus_path.read_text().splitlines()
+        assert 'squad_map_randomizer_skipped_slots_total 2' in prometheus_lines
+        assert 'squad_map_randomizer_solver_fallbacks_total 0' in prometheus_lines
+        assert 'squad_map_randomizer_slot_candidates{slot="0"} 0' in prometheus_lines
+        assert any(line.startswith('squad_map_randomizer_stage_seconds{stage="generate"} ')
+                   for line in prometheus_lines)
+
+    def test_run_metrics_prometheus_format(self):
+        """ Tests that the Prometheus textfile groups the samples of each metric under a single '# TYPE' line. """
+        metrics = squad_map_randomizer.RunMetrics()
+        names = ['slot_candidates', 'skipped_slots_total', 'slot_candidates', 'skipped_slots_total']
+        for slot, name in enumerate(names):
+            metrics(name, slot, {'slot': slot})
+        metrics('stage_seconds', 0.5, {'stage': 'a "quoted" \\ stage'})
+        metrics('stage_seconds', 1.5, {'stage': 'a "quoted" \\ stage'})
+
+        # Parse the textfile into its metric types and the metric names of its samples (in order).
+        types = collections.OrderedDict()
+        sample_names = []
+        for line in metrics.get_prometheus_text().splitlines():
+            if line.startswith('#'):
+                comment, keyword, name, metric_type = line.split(' ')
+                assert (comment, keyword) == ('#', 'TYPE') and name not in types
+                types[name] = metric_type
+            else:
+                name = line.split('{')[0].split(' ')[0]
+                # Every sample comes after the '# TYPE' line of its metric.
+                assert name == list(types)[-1]
+                sample_names.append(name)
+
+        prefix = squad_map_randomizer.METRICS_PREFIX
+        assert types[f'{prefix}skipped_slots_total'] == 'counter'
+        assert types[f'{prefix}slot_candidates'] == 'gauge'
+        assert set(types) == {f'{prefix}{name}' for name in squad_map_randomizer.METRICS_COUNTERS} | {
+            f'{prefix}slot_candidates', f'{prefix}stage_seconds'}
+        # The samples of each metric are grouped together.
+        assert sample_names.count(f'{prefix}slot_candidates') == 2
+        assert sample_names.count(f'{prefix}skipped_slots_total') == 3
+        assert [name for i, name in enumerate(sample_names) if i == 0 or name != sample_names[i - 1]] == list(types)
+        assert f'{prefix}stage_seconds{{stage="a \\"quoted\\" \\\\ stage"}} 1.5' in \
+            metrics.get_prometheus_text().splitlines()
+
+    def test_layer_schema(self, default_layers):
+        """ Tests that the layer schema has the fields every layer has (plus 'team') and their values and types. """
+        layer_schema = squad_map_randomizer.LayerSchema(default_layers)
+        assert {'map', 'layer', 'gamemode', 'map_size', 'helicopters', 'team1', 'team2', 'team'} <= \
+            layer_schema.filter_keys
+        assert layer_schema.domains['map_size'] == {'small', 'medium', 'large'}
+        assert layer_schema.domains['team'] == (
+            {layer['team1'] for layer in default_layers} | {layer['team2'] for layer in default_layers})
+        assert layer_schema.types['helicopters'] == {'bool'}
+        assert layer_schema.matches_any_layer('map_size', 'large')
+        assert not layer_schema.matches_any_layer('map_size', 'larg')
+        assert not layer_schema.matches_any_layer('map_size', ['unhashable'])
+
+        # The schema computed from a LayerIndex is the same.
+        index_schema = squad_map_randomizer.LayerIndex(default_layers).schema
+        assert index_schema.filter_keys == layer_schema.filter_keys
+        assert index_schema.domains == layer_schema.domains
+        assert index_schema.types == layer_schema.types
+
+        # Fields missing (or None) in any layer can't be filtered by.
+        assert squad_map_randomizer.LayerSchema(
+            [{'map': 'A', 'team1': 'US'}, {'map': 'B', 'night': None}]).filter_keys == {'map'}
+        assert squad_map_randomizer.LayerSchema([]).filter_keys == set()
+
+        # Validating with a precomputed schema doesn't scan the layers, and warns about values no layer has.
+        with mock.patch('squad_map_randomizer.LayerSchema') as mock_schema:
+            squad_map_randomizer.validate_config({'regular_maps': [{'map_size': 'large'}]}, default_layers,
+                                                 layer_schema)
+            assert mock_schema.call_count == 0
+        with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+            squad_map_randomizer.validate_config(
+                {'regular_maps': [{'map_size': ['large', 'larg']}, {'team': 'US'}]}, default_layers, layer_schema)
+            assert mock_warning.call_count == 1
+            assert "'larg'" in mock_warning.call_args[0][0]
+        with pytest.raises(squad_map_randomizer.InvalidConfigException):
+            squad_map_randomizer.validate_config(
+                {'regular_maps': [{'THIS_DOES_NOT_EXIST': 1}]}, default_layers, layer_schema)
+
     def test_is_config_valid_examples(self, default_layers):
         """ Tests that all the example configs successfully validate. """
         # Test that all example configs validate successfully.
         for path in os.scandir(squad_map_randomizer.EXAMPLES_CONFIG_DIR):
             with open(path, 'r') as f:
                 squad_map_randomizer.validate_config(
-                    yaml.load(f), default_layers)
+                    yaml.safe_load(f), default_layers)
 
     def test_is_config_valid(self, default_config, default_layers):
         """ Tests that all sorts of configs successfully validate. """
@@ -383,9 +1473,65 @@ class TestSquadMapRandomizer:
                     {'map': 'not used really'},
                 ]}, default_layers)
 
+        # Test that the optional 'weights' field must be a list of filters with positive weights.
+        squad_map_randomizer.validate_config(
+            {'regular_maps': ['any'], 'weights': [{'gamemode': 'RAAS', 'weight': 2.5}, {'weight': 3}]}, default_layers)
+        for weights in ['RAAS', ['RAAS'], [{'gamemode': 'RAAS'}], [{'gamemode': 'RAAS', 'weight': 0}],
+                        [{'gamemode': 'RAAS', 'weight': 'heavy'}], [{'gamemode': 'RAAS', 'weight': True}],
+                        [{'THIS_DOES_NOT_EXIST': 'RAAS', 'weight': 2}]]:
+            with pytest.raises(squad_map_randomizer.InvalidConfigException):
+                squad_map_randomizer.validate_config({'regular_maps': ['any'], 'weights': weights}, default_layers)
+
     def test_parse_config(self, default_config, default_layers):
         """ Tests that we can call parse_config correctly. """
         # We expect the default config above to exactly match the one parsed from configs/default_config.yml.
         with mock.patch('squad_map_randomizer.validate_config'):
             assert squad_map_randomizer.parse_config(
                 squad_map_randomizer.DEFAULT_CONFIG_FILEPATH, default_layers) == default_config
+
+    def test_parse_config_cache(self, default_config, default_layers, tmp_path):
+        """ Tests that cached configs skip parsing (but not validation), and are keyed by the config and layers. """
+        layer_index = squad_map_randomizer.LayerIndex(default_layers)
+        config_path = tmp_path / 'config.yml'
+        config_path.write_text(yaml.safe_dump(default_config))
+        cache_dir = tmp_path / 'cache'
+
+        def parse(layers_hash=layer_index.layers_hash):
+            return squad_map_randomizer.parse_config(config_path, default_layers, layer_index.schema, cache_dir,
+                                                     layers_hash)
+
+        with mock.patch('squad_map_randomizer.validate_config', wraps=squad_map_randomizer.validate_config) as validate:
+            assert parse() == default_config
+            assert validate.call_count == 1
+            # A hit skips parsing, but is still validated.
+            with mock.patch('squad_map_randomizer.load_yaml') as load_yaml:
+                assert parse() == default_config
+                load_yaml.assert_not_called()
+            assert validate.call_count == 2
+
+            # Other layers, or a changed config, are misses.
+            with mock.patch('squad_map_randomizer.load_yaml', wraps=squad_map_randomizer.load_yaml) as load_yaml:
+                parse(layers_hash='other layers')
+                config_path.write_text(yaml.safe_dump(dict(default_config, number_of_repeats=2)))
+                assert parse()['number_of_repeats'] == 2
+                assert load_yaml.call_count == 2
+        assert len(list((cache_dir / 'configs').iterdir())) == 3
+
+        # So the warnings about values no layer has are logged on every hit.
+        config_path.write_text(yaml.safe_dump({'regular_maps': [{'map': ['Chora', 'misspelled_name']}]}))
+        for _ in range(2):
+            with mock.patch('squad_map_randomizer.logging.warning') as mock_warning:
+                parse()
+                assert any('misspelled_name' in args[0][0] for args in mock_warning.call_args_list)
+        assert len(list((cache_dir / 'configs').iterdir())) == 4
+
+        # A corrupt cache entry is a miss, and invalid configs are never cached.
+        config_path.write_text(yaml.safe_dump(dict(default_config, number_of_repeats=2)))
+        for cached_path in (cache_dir / 'configs').iterdir():
+            cached_path.write_bytes(b'not json')
+        assert parse()['number_of_repeats'] == 2
+        config_path.write_text(yaml.safe_dump({'regular_maps': []}))
+        for _ in range(2):
+            with pytest.raises(squad_map_randomizer.InvalidConfigException):
+                parse()
+        assert len(list((cache_dir / 'configs').iterdir())) == 4